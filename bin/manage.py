@@ -11,9 +11,15 @@ from flask_migrate import Migrate, MigrateCommand, upgrade
 import alembic
 import alembic.config
 from ipsec_me import create_app, db
-from ipsec_me.models import User, Role, VPNServer, UserType
+from ipsec_me.models import User, Role, VPNServer, UserType, PooledKey, Certificate, DeviceBase, CertificateAuthority, CASelection
+from datetime import datetime, timedelta
 
-app = create_app()
+## Commands that serve requests or exercise the views need the whole
+## application, everything else gets by with the lighter "cli" profile.
+## The modules behind single commands are imported by those commands.
+WEB_COMMANDS = ("shell", "runserver", "publicserver", "benchmark")
+
+app = create_app(profile="web" if set(sys.argv[1:2]) & set(WEB_COMMANDS) else "cli")
 migrate = Migrate(app, db, directory="ipsec_me/migrations")
 
 
@@ -62,18 +68,294 @@ def user_del(email):
 @manager.option('-u', '--user', help='VPN user', required=False, nargs='*')
 @manager.option('-a', '--admin-user', help='VPN admin user', required=False, nargs='*')
 @manager.option('-b', '--base-dn', help='VPN CA base DN', required=False, default="")
-def vpn_create(name, hostname, user, admin_user, base_dn):
+@manager.option('-i', '--intermediates', help='number of intermediate CAs under a root CA', type=int, default=0)
+@manager.option('-c', '--ca-selection', help='how to choose the signing CA: ' + ", ".join(s.value for s in CASelection), required=False, default=None)
+def vpn_create(name, hostname, user, admin_user, base_dn, intermediates=0, ca_selection=None):
     "Create a VPN"
-    v = VPNServer.create(name=name, external_hostname=hostname, CA_params={'base_dn': base_dn})
-    for email in user:
-        u = User.find(email=email)
-        v.add_user(u, user_type=UserType.USER)
-    for email in admin_user:
-        u = User.find(email=email)
-        v.add_user(u, user_type=UserType.ADMIN)
+    v = VPNServer.create(name=name, external_hostname=hostname, CA_params={'base_dn': base_dn},
+        intermediate_CAs=intermediates, ca_selection=CASelection(ca_selection) if ca_selection else None)
+    for emails, user_type in ((user, UserType.USER), (admin_user, UserType.ADMIN)):
+        users = [User.find(email=email) for email in emails or []]
+        for email in [email for email, u in zip(emails or [], users) if u is None]:
+            print("User not found: {0}".format(email))
+        v.add_users([u for u in users if u is not None], user_type=user_type)
     print("Created")
 
 
+@manager.option('-n', '--name', help='VPN name', required=True)
+def vpn_ca_list(name):
+    "list the CAs of a VPN"
+    v = VPNServer.find(name=name)
+    if v is None:
+        print("VPN not found")
+        return
+    print("CA selection: {0}".format(v.ca_selection.value))
+    for ca in v.trusted_CAs():
+        print("{0}  {1:8}  next serial {2:<8}  {3}{4}".format(ca.id, "issuing" if ca.issuing else "-",
+            ca.next_serial_number, ca.DN, "  (for {0})".format(ca.device_types) if ca.device_types else ""))
+
+
+@manager.option('-n', '--name', help='VPN name', required=True)
+@manager.option('-r', '--rdn', help='RDN of the new CA, e.g. "CN=VPN CA 2"', required=True)
+@manager.option('-p', '--parent', help='id of the CA to sign the new intermediate CA, default self-signed', required=False, default=None)
+@manager.option('-t', '--device-types', help='device types the CA signs for with the device_type selection', required=False, nargs='*')
+def vpn_ca_add(name, rdn, parent=None, device_types=None):
+    "add an issuing CA to a VPN, e.g. to roll over to a new CA"
+    v = VPNServer.find(name=name)
+    if v is None:
+        print("VPN not found")
+        return
+    parent_ca = CertificateAuthority.find(id=parent) if parent else None
+    if parent and parent_ca is None:
+        print("Parent CA not found")
+        return
+    # New CAs share the base DN of the existing ones
+    base_dn = (parent_ca or v.CAs[0]).base_dn if parent_ca or v.CAs else ""
+    ca = CertificateAuthority.create(rdn=rdn, base_dn=base_dn, parent=parent_ca, device_types=device_types or ())
+    v.CAs.append(ca)
+    v.save()
+    print("Added CA {0}".format(ca.id))
+
+
+@manager.option('-i', '--id', dest='ca_id', help='CA id', required=True)
+@manager.option('-u', '--undo', help='sign with the CA again', action='store_true', default=False)
+def vpn_ca_retire(ca_id, undo=False):
+    "stop signing new certificates with a CA, it stays trusted"
+    ca = CertificateAuthority.find(id=ca_id)
+    if ca is None:
+        print("CA not found")
+        return
+    ca.issuing = undo
+    ca.save()
+    print("Issuing" if undo else "Retired")
+
+
+@manager.option('-n', '--name', help='VPN name', required=True)
+@manager.option('-c', '--ca-selection', help=", ".join(s.value for s in CASelection), required=True)
+def vpn_ca_selection(name, ca_selection):
+    "set how a VPN chooses the CA to sign new certificates"
+    v = VPNServer.find(name=name)
+    if v is None:
+        print("VPN not found")
+        return
+    v.ca_selection = CASelection(ca_selection)
+    v.save()
+
+
+@manager.option('-n', '--name', help='VPN name', required=True)
+@manager.option('-d', '--directory', help='output directory, e.g. /etc', required=False, default=None)
+@manager.option('-f', '--full', help='rewrite all files, not only the changed ones', action='store_true', default=False)
+@manager.option('-s', '--secrets', help='write ipsec.secrets with all device secrets to stdout', action='store_true', default=False)
+def vpn_export(name, directory=None, full=False, secrets=False):
+    "export the strongSwan configuration of a VPN"
+    v = VPNServer.find(name=name)
+    if v is None:
+        print("VPN not found")
+        return
+
+    from ipsec_me.export import StrongSwanExporter, stream_ipsec_secrets
+    if secrets:
+        for chunk in stream_ipsec_secrets(v):
+            sys.stdout.write(chunk)
+    elif directory:
+        exporter = StrongSwanExporter(v, directory)
+        full = exporter.export(full=full)
+        print("{0} export: {1} files written, {2} removed".format("Full" if full else "Incremental", exporter.written, exporter.removed))
+    else:
+        print("Either --directory or --secrets is required")
+
+
+@manager.command
+def journal_prune():
+    "delete change journal entries older than JOURNAL_RETENTION"
+    from ipsec_me.models import ChangeJournal
+    count = ChangeJournal.prune(datetime.utcnow() - timedelta(seconds=app.config['JOURNAL_RETENTION']))
+    print("Deleted {0} change journal entries".format(count))
+
+
+@manager.option('-s', '--socket', help='Unix socket to listen on, default SIGNING_SOCKET', required=False, default=None)
+@manager.option('-w', '--workers', help='number of signing processes', type=int, required=False, default=None)
+def signing_daemon(socket=None, workers=None):
+    "hold the CA keys and sign for the web workers"
+    from ipsec_me.signing import SigningDaemon
+
+    def load_keys():
+        with app.app_context():
+            try:
+                return CertificateAuthority.signing_keys()
+            finally:
+                db.session.remove()
+
+    path = socket or app.config['SIGNING_SOCKET']
+    if not path:
+        print("Either --socket or SIGNING_SOCKET is required")
+        return
+    SigningDaemon(path, load_keys, workers=workers or app.config['SIGNING_WORKERS'],
+        batch_size=app.config['SIGNING_BATCH_SIZE']).run()
+
+
+@manager.option('-o', '--output', help='write the results as JSON to this file', required=False, default=None)
+@manager.option('-b', '--baseline', help='JSON results to compare against', required=False, default=None)
+@manager.option('-t', '--tolerance', help='allowed slowdown against the baseline, as a fraction', type=float, default=0.25)
+@manager.option('-n', '--iterations', help='timed calls per benchmark', type=int, default=20)
+@manager.option('-v', '--vpns', help='VPNs on the index page', type=int, default=5)
+@manager.option('-d', '--devices', help='devices per VPN on the index page', type=int, default=10)
+@manager.option('-s', '--only', help='only run benchmarks starting with these names', required=False, nargs='*')
+def benchmark(output=None, baseline=None, tolerance=0.25, iterations=20, vpns=5, devices=10, only=None):
+    "run the benchmarks against an empty database, fail on regressions against a baseline"
+    from ipsec_me.benchmark import Benchmark, compare, load_results, save_results
+    results = Benchmark(iterations=iterations, vpns=vpns, devices=devices).run(only=only)
+    for name, stats in sorted(results['benchmarks'].items()):
+        print("{0:55} p50 {1:10.3f} ms  p90 {2:10.3f} ms  p99 {3:10.3f} ms".format(name, stats['p50'], stats['p90'], stats['p99']))
+    if output:
+        save_results(results, output)
+
+    if baseline:
+        regressions = compare(results, load_results(baseline), tolerance=tolerance)
+        for regression in regressions:
+            print("REGRESSION {0}".format(regression))
+        if regressions:
+            sys.exit(1)
+
+
+@manager.option('-i', '--id', dest='certificate_id', help='certificate id', required=False)
+@manager.option('-f', '--fingerprint', help='SHA-256 fingerprint', required=False)
+@manager.option('-s', '--serial', help='serial number in hex', required=False)
+@manager.option('-o', '--openssl', help='render with the openssl command line tool', action='store_true', default=False)
+def cert_show(certificate_id=None, fingerprint=None, serial=None, openssl=False):
+    "show a certificate in human readable form"
+    if certificate_id:
+        certificate = Certificate.find(id=certificate_id)
+    elif fingerprint:
+        certificate = Certificate.find(fingerprint=fingerprint.lower())
+    elif serial:
+        certificates = Certificate.find_by_serial(int(serial.replace(':', ''), 16))
+        if len(certificates) > 1:
+            print("Serial number issued by several CAs, use --id:")
+            for certificate in certificates:
+                print("{0}  {1}".format(certificate.id, certificate.issuer_dn))
+            return
+        certificate = certificates[0] if certificates else None
+    else:
+        certificate = None
+
+    if certificate:
+        print(certificate.prettyPrint(use_openssl=openssl))
+    else:
+        print("Certificate not found")
+
+
+@manager.option('-d', '--days', help='report certificates expiring within this many days', type=int, default=30)
+def cert_expiring(days=30):
+    "list the certificates expiring soon"
+    for certificate in Certificate.expiring(datetime.utcnow() + timedelta(days=days)):
+        print("{0:%Y-%m-%d %H:%M}  {1:>40}  {2}".format(certificate.not_after, certificate.serial_number, certificate.subject_dn))
+
+
+@manager.option('-i', '--id', dest='device_id', help='device id', required=True)
+@manager.option('-r', '--reason', help='revocation reason, e.g. keyCompromise', required=False, default=None)
+def device_revoke(device_id, reason=None):
+    "revoke the certificate of a device"
+    from cryptography.x509 import ReasonFlags
+    device = DeviceBase.find(id=device_id)
+    if device is None or getattr(device, 'certificate', None) is None:
+        print("Device not found")
+        return
+    entry = device.revoke(reason=ReasonFlags(reason) if reason else None)
+    delta = device.issuing_ca().get_delta_crl()
+    print("Revoked serial number {0}, listed in delta CRL number {1}".format(entry.serial_number, delta.crl_number))
+
+
+@manager.option('-w', '--workers', help='number of key generation processes', required=False, type=int, default=None)
+def keypool_fill(workers):
+    "generate keys until the key pool is full"
+    from ipsec_me.keypool import KeyPoolFiller
+    filler = KeyPoolFiller(workers=workers)
+    try:
+        filler.fill()
+    finally:
+        filler.close()
+
+
+@manager.option('-w', '--workers', help='number of key generation processes', required=False, type=int, default=None)
+@manager.option('-i', '--interval', help='seconds between refills', required=False, type=float, default=None)
+def keypool_run(workers, interval):
+    "keep the key pool filled, runs until interrupted"
+    from ipsec_me.keypool import KeyPoolFiller
+    KeyPoolFiller(workers=workers).run(interval=interval)
+
+
+@manager.command
+def keypool_status():
+    "show key pool depth and refill/drain rates"
+    for key_type, stats in sorted(PooledKey.stats().items()):
+        print("{0}: {depth}/{target} keys, refill {refill_rate:.1f}/h, drain {drain_rate:.1f}/h".format(key_type, **stats))
+
+
+@manager.command
+def provisioning_run():
+    "run all pending provisioning jobs, e.g. after a restart"
+    from ipsec_me.provisioning import ProvisioningQueue
+    ProvisioningQueue(app, workers=0).submit_pending()
+
+
+@manager.command
+def crl_refresh():
+    "cut due full CRLs and sign expiring delta CRLs once"
+    from ipsec_me.models.revocation import crl_engine
+    print("Signed {0} CRLs".format(crl_engine.refresh_all()))
+
+
+@manager.option('-i', '--interval', help='seconds between refreshes', required=False, type=float, default=None)
+def crl_run(interval):
+    "keep the CRLs current, runs until interrupted"
+    from ipsec_me.models.revocation import crl_engine
+    crl_engine.run(interval=interval)
+
+
+@manager.command
+def ocsp_refresh():
+    "sign missing and expiring OCSP responses once"
+    from ipsec_me.ocsp import OCSPRefresher
+    print("Signed {0} OCSP responses".format(OCSPRefresher().refresh()))
+
+
+@manager.option('-i', '--interval', help='seconds between refreshes', required=False, type=float, default=None)
+def ocsp_run(interval):
+    "keep the OCSP responses signed, runs until interrupted"
+    from ipsec_me.ocsp import OCSPRefresher
+    OCSPRefresher().run(interval=interval)
+
+
+@manager.option('-p', '--profile', help='app profile to time, cli or web', required=False, default="cli")
+@manager.option('-n', '--limit', help='number of modules to list', type=int, default=15)
+def import_report(profile="cli", limit=15):
+    "show where the startup time goes, needs Python 3.7"
+    from ipsec_me.importtime import import_report
+    try:
+        report = import_report(profile=profile)
+    except RuntimeError as e:
+        print(e)
+        return
+    print("import ipsec_me: {0:8.3f} s".format(report.import_seconds))
+    print("create_app({0!r}): {1:8.3f} s".format(profile, report.create_app_seconds))
+    print("\nSlowest packages:")
+    for name, seconds in report.by_package()[:limit]:
+        print("{0:8.3f} s  {1}".format(seconds, name))
+    print("\nSlowest modules:")
+    for name, self_seconds, cumulative, level in report.slowest()[:limit]:
+        print("{0:8.3f} s  {1}".format(self_seconds, name))
+
+
+@manager.option('-t', '--to', dest='storage', help='binary or char', choices=("binary", "char"), required=True)
+def guid_storage(storage):
+    "convert all GUID columns of an existing database, then set GUID_STORAGE accordingly"
+    from ipsec_me.models.utils import convert_guid_storage
+    with db.engine.begin() as connection:
+        convert_guid_storage(connection, db.metadata, binary=storage == "binary")
+    print("Converted, set GUID_STORAGE = {0!r} before starting the application again".format(storage))
+
+
 @manager.command
 def drop_db():
     "drop all databases, instantiate schemas"
@@ -4,14 +4,21 @@
 from flask_diamond import Diamond
 from flask_diamond.facets.administration import AdminModelView
 from flask_diamond.facets.database import db
-from flask_bootstrap import Bootstrap
-from flask_babel import Babel
-from flask_qrcode import QRcode
 from werkzeug.routing import BaseConverter, NotFound
 from itsdangerous import Signer, BadData
-from hmac import compare_digest
-from .models import User, Role, VPNServer, CertificateAuthority, DeviceBase, VPNUser, GenericPskXauthDevice, GenericUserCertificateDevice
+from .models import User, Role, VPNServer, CertificateAuthority, DeviceBase, VPNUser, GenericPskXauthDevice, GenericUserCertificateDevice, PooledKey, Certificate
 from .config import DefaultConfig
+from .provisioning import ProvisioningQueue
+from .registry import device_registry
+from .ocsp import ocsp_responder
+from .artifacts import artifact_cache
+from .models.certificate import parsed_cache
+from .models.chain import chain_cache
+from .models.revocation import crl_engine
+from .models.utils import GUID
+from .metrics import metrics, cache_collector, gauge_collector
+from .replicas import replica_router
+from .admission import issuance_limiter
 
 # declare these globalish objects before initializing models
 application = None
@@ -22,7 +29,7 @@ class VPNServerConverter(BaseConverter):
         return str(value.id)
 
     def to_python(self, value):
-        retval = VPNServer.find(id=str(value))
+        retval = replica_router.fallback(lambda: VPNServer.find(id=str(value)))
         if retval is None:
             raise NotFound
         return retval
@@ -32,7 +39,7 @@ class DeviceClassConverter(BaseConverter):
         return str(value.DEVICE_TYPE)
 
     def to_python(self, value):
-        retval = DeviceBase.class_from_type(str(value))
+        retval = device_registry.device_class(str(value))
         if retval is None:
             raise NotFound
         return retval
@@ -42,7 +49,7 @@ class DeviceConverter(BaseConverter):
         return str(value.id)
 
     def to_python(self, value):
-        retval = DeviceBase.find(id=str(value))
+        retval = replica_router.fallback(lambda: DeviceBase.find(id=str(value)))
         if retval is None:
             raise NotFound
         return retval
@@ -59,11 +66,10 @@ class DeviceSecureConverter(BaseConverter):
         except BadData:
             raise NotFound
         device_id, certificate_hash = data.decode("US-ASCII").split('.', 2)
-        retval = DeviceBase.find(id=str(device_id))
+        retval = replica_router.fallback(
+            lambda: GenericUserCertificateDevice.find_by_fingerprint(id=str(device_id), fingerprint=certificate_hash))
         if retval is None:
             raise NotFound
-        if not compare_digest(certificate_hash, retval.certificate.get_hexhash()):
-            raise NotFound
         return retval
 
 class ipsec_me(Diamond):
@@ -79,6 +85,13 @@ class ipsec_me(Diamond):
         self.app.config.from_object('ipsec_me.DefaultConfig')
         self.app.config.from_envvar('SETTINGS')
 
+    def init_database(self):
+        "Initialize database, GUID storage must be known before the first query"
+        GUID.binary = self.app.config['GUID_STORAGE'] == "binary"
+        result = self.super("database")
+        replica_router.init_app(self.app)
+        return result
+
     def init_accounts(self):
         "initialize accounts with the User and Role classes imported from .models"
         return self.super("accounts", user=User, role=Role)
@@ -104,6 +117,9 @@ class ipsec_me(Diamond):
                 category="Models")
             )
 
+        from .views.administration.modelviews import CertificateModelView
+        admin.add_view(CertificateModelView(Certificate, db.session, name="Certificate", category="Models"))
+
         return admin
 
     def init_blueprints(self):
@@ -121,11 +137,49 @@ class ipsec_me(Diamond):
         from .views.frontend import frontend_blueprint
         self.app.register_blueprint(frontend_blueprint)
 
-    def init_request_handlers(self): pass
-
-
-def create_app():
+        device_registry.resolve(self.app.jinja_env)
+
+    def init_request_handlers(self):
+        "Time requests and the operations within, served at /metrics, and limit concurrent issuance"
+        metrics.init_app(self.app)
+        metrics.add_collector(cache_collector({
+            'certificate': parsed_cache,
+            'chain': chain_cache,
+            'artifact': artifact_cache,
+            'crl': crl_engine.cache,
+            'ocsp': ocsp_responder.cache,
+        }))
+        metrics.add_collector(gauge_collector("ipsec_me_keypool_depth", "Unused keys in the key pool", PooledKey.depth, "key_type"))
+
+        issuance_limiter.init_app(self.app)
+        metrics.add_collector(issuance_limiter.collect)
+
+    def init_caches(self):
+        "Size the process-wide caches according to the configuration"
+        parsed_cache.resize(self.app.config['CERTIFICATE_CACHE_SIZE'])
+        chain_cache.resize(self.app.config['CHAIN_CACHE_SIZE'])
+        crl_engine.cache.resize(self.app.config['CRL_CACHE_SIZE'])
+        ocsp_responder.cache.resize(self.app.config['OCSP_CACHE_SIZE'])
+        artifact_cache.resize(self.app.config['ARTIFACT_CACHE_SIZE'])
+
+    def init_provisioning(self):
+        "Worker pool for asynchronous device provisioning"
+        self.app.extensions['provisioning'] = ProvisioningQueue(self.app, workers=self.app.config['PROVISIONING_WORKERS'])
+
+
+PROFILES = ("web", "cli")
+
+def create_app(profile="web"):
+    """Create the application once per process, later calls return it whatever the profile.
+
+    The "cli" profile only loads what manage.py commands need: configuration,
+    logs, database, caches and accounts. It skips blueprints, the admin
+    interface, request handling and the template extensions, and with them
+    most of the startup time.
+    """
     global application
+    if profile not in PROFILES:
+        raise ValueError("Unknown app profile {0}".format(profile))
     if not application:
         application = ipsec_me()
 
@@ -137,6 +191,11 @@ def create_app():
         application.facet("configuration")
         application.facet("logs")
         application.facet("database")
+        application.facet("caches")
+        if profile == "cli":
+            application.facet("accounts")
+            return application.app
+
         application.facet("marshalling")
         application.facet("blueprints")
         application.facet("accounts")
@@ -145,12 +204,16 @@ def create_app():
         application.facet("error_handlers")
         application.facet("request_handlers")
         application.facet("administration")
+        application.facet("provisioning")
         # application.facet("rest", api_map=api_map)
         # application.facet("webassets")
         # application.facet("email")
         application.facet("debugger")
         # application.facet("task_queue")
 
+        from flask_bootstrap import Bootstrap
+        from flask_babel import Babel
+        from flask_qrcode import QRcode
         Bootstrap(application.app)
         Babel(application.app)
         QRcode(application.app)
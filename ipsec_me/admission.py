@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+# ipsec-me (c) Henryk Plötz
+
+from flask import Response, has_request_context
+from contextlib import contextmanager
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+
+from .metrics import metrics
+
+## How often a request waiting for a global permit tries the lock files again
+_POLL_INTERVAL = 0.05
+
+class Overloaded(Exception):
+    "Too many certificates are being issued, answered with 503 and Retry-After"
+
+    def __init__(self, retry_after):
+        super(Overloaded, self).__init__("Too many certificates are being issued")
+        self.retry_after = retry_after
+
+
+class IssuanceLimiter(object):
+    """Bounds the number of key generations and certificate signatures running at once.
+
+    Each process has ISSUANCE_PERMITS permits. ISSUANCE_GLOBAL_PERMITS bounds
+    all processes on the host together, a permit is an flock()ed file in
+    ISSUANCE_LOCK_DIR and is released by the kernel if the process dies.
+
+    Requests wait for a permit for at most ISSUANCE_QUEUE_TIMEOUT seconds.
+    With ISSUANCE_MAX_QUEUE requests already waiting, further ones fail at
+    once. Both raise :class:`Overloaded`. Provisioning workers and commands
+    outside of requests wait as long as it takes. Before init_app every
+    permit is granted at once, e.g. in manage.py commands.
+    """
+
+    def __init__(self):
+        self.config = None
+        self._semaphore = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.waiting = 0
+        self.active = 0
+        self.rejected = 0
+
+    def init_app(self, app):
+        self.config = app.config
+        permits = app.config['ISSUANCE_PERMITS'] or multiprocessing.cpu_count()
+        self._semaphore = threading.BoundedSemaphore(permits)
+
+        lock_dir = app.config['ISSUANCE_LOCK_DIR'] or os.path.join(tempfile.gettempdir(), "ipsec-me-issuance")
+        if app.config['ISSUANCE_GLOBAL_PERMITS']:
+            os.makedirs(lock_dir, exist_ok=True)
+        self._lock_files = [os.path.join(lock_dir, "permit-{0}.lock".format(i))
+            for i in range(app.config['ISSUANCE_GLOBAL_PERMITS'] or 0)]
+
+        app.register_error_handler(Overloaded, self._overloaded)
+
+    def _overloaded(self, error):
+        response = Response("Too many certificates are being issued, please try again later\n", status=503, mimetype='text/plain')
+        response.headers['Retry-After'] = str(error.retry_after)
+        return response
+
+    def _reject(self):
+        with self._lock:
+            self.rejected += 1
+        raise Overloaded(self.config['ISSUANCE_RETRY_AFTER'])
+
+    def admit(self):
+        "Fail fast with Overloaded if the queue is full, before a request starts issuing"
+        if self._semaphore is not None and has_request_context() and self.waiting >= self.config['ISSUANCE_MAX_QUEUE']:
+            self._reject()
+
+    @contextmanager
+    def permit(self):
+        "Hold a permit for the block, nested blocks of a thread share it"
+        if self._semaphore is None or getattr(self._local, 'depth', 0):
+            self._local.depth = getattr(self._local, 'depth', 0) + 1
+            try:
+                yield
+            finally:
+                self._local.depth -= 1
+            return
+
+        self.admit()
+        deadline = time.monotonic() + self.config['ISSUANCE_QUEUE_TIMEOUT'] if has_request_context() else None
+        start = time.perf_counter()
+        lock_file = None
+        with self._lock:
+            self.waiting += 1
+        try:
+            acquired = self._semaphore.acquire(timeout=None if deadline is None else max(deadline - time.monotonic(), 0))
+            if acquired:
+                try:
+                    lock_file = self._acquire_global(deadline)
+                except BaseException:
+                    self._semaphore.release()
+                    raise
+                if lock_file is False:
+                    self._semaphore.release()
+                    acquired = False
+        finally:
+            with self._lock:
+                self.waiting -= 1
+        metrics.observe("issuance_wait", time.perf_counter() - start)
+        if not acquired:
+            self._reject()
+
+        with self._lock:
+            self.active += 1
+        self._local.depth = 1
+        try:
+            yield
+        finally:
+            self._local.depth = 0
+            with self._lock:
+                self.active -= 1
+            if lock_file is not None:
+                lock_file.close()
+            self._semaphore.release()
+
+    def _acquire_global(self, deadline):
+        "An open and locked permit file, None without global permits, False on timeout"
+        if not self._lock_files:
+            return None
+        import fcntl
+        while True:
+            for path in self._lock_files:
+                # Each open() is locked separately, also against other threads of this process
+                lock_file = open(path, "a")
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return lock_file
+                except BlockingIOError:
+                    lock_file.close()
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(_POLL_INTERVAL)
+
+    def collect(self):
+        "Collector for the metrics, see :meth:`Metrics.add_collector`"
+        lines = ["# HELP ipsec_me_issuance_permits Issuance permits in use and requests waiting for one",
+            "# TYPE ipsec_me_issuance_permits gauge"]
+        for state, value in (("active", self.active), ("waiting", self.waiting)):
+            lines.append('ipsec_me_issuance_permits{{state="{0}"}} {1}'.format(state, value))
+        lines.extend(["# HELP ipsec_me_issuance_rejected_total Requests answered with 503 because of the issuance queue",
+            "# TYPE ipsec_me_issuance_rejected_total counter",
+            "ipsec_me_issuance_rejected_total {0}".format(self.rejected)])
+        return lines
+
+issuance_limiter = IssuanceLimiter()
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# ipsec-me (c) Henryk Plötz
+
+from datetime import datetime
+from hashlib import sha256
+from flask_diamond.facets.database import db
+
+from .models import VPNServer, VPNUser
+from .cache import LRUCache
+
+## Provisioning payloads, keyed by (device id, certificate fingerprint, certificate status,
+## VPN server updated_at, artifact type). Everything in the key comes from the database, so
+## a change made by any process or manage.py command is seen by all of them.
+artifact_cache = LRUCache()
+
+class Artifact(object):
+    def __init__(self, body, mimetype):
+        self.body = body
+        self.mimetype = mimetype
+        self.etag = sha256(body).hexdigest()
+        self.last_modified = datetime.utcnow()
+
+def server_version(device):
+    "updated_at of the VPN server of device, in one query"
+    return db.session.query(VPNServer.updated_at) \
+        .join(VPNUser, VPNUser.vpn_server_id == VPNServer.id) \
+        .filter(VPNUser.id == device.vpn_user_id).scalar()
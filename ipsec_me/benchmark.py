@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+# ipsec-me (c) Henryk Plötz
+
+import flask
+from flask import current_app
+from flask_diamond.facets.database import db
+from datetime import datetime
+import json
+import math
+import platform
+import time
+
+from .models import User, Role, VPNServer, CERTIFICATE_SETTINGS_IPSEC_DEVICE
+from .models.keys import generate_private_key, rsa_key_type, KEY_TYPE_EC_P256, KEY_TYPE_EC_P384, KEY_TYPE_ED25519
+from .artifacts import artifact_cache
+from . import DeviceSecureConverter
+
+KEY_TYPES = (rsa_key_type(2048), rsa_key_type(3072), rsa_key_type(4096), KEY_TYPE_EC_P256, KEY_TYPE_EC_P384, KEY_TYPE_ED25519)
+
+## Provisioning views and the device type they are measured with
+PROVISIONING_ENDPOINTS = (
+    ('device_generic_pkcs12', "generic_user_certificate"),
+    ('device_generic_ca', "generic_user_certificate"),
+    ('device_generic_cert', "generic_user_certificate"),
+    ('device_generic_key', "generic_user_certificate"),
+    ('device_android_strongswan_profile', "android_strongswan"),
+    ('device_ios10_profile', "ios_10"),
+)
+
+PERCENTILES = (50, 90, 99)
+
+USER_EMAIL = "benchmark@example.com"
+USER_PASSWORD = "benchmark"
+
+def percentile(samples, p):
+    "Nearest-rank percentile of sorted samples"
+    index = max(0, min(len(samples) - 1, int(math.ceil(p / 100.0 * len(samples))) - 1))
+    return samples[index]
+
+def summarize(samples):
+    "Statistics of a list of durations in seconds, as milliseconds"
+    samples = sorted(samples)
+    result = {
+        'iterations': len(samples),
+        'min': samples[0] * 1000,
+        'mean': sum(samples) / len(samples) * 1000,
+        'max': samples[-1] * 1000,
+    }
+    for p in PERCENTILES:
+        result['p{0}'.format(p)] = percentile(samples, p) * 1000
+    return result
+
+def compare(results, baseline, tolerance=0.25, metric='p50'):
+    """Regressions of results against a baseline, as a list of messages.
+
+    A benchmark regressed when its metric is more than tolerance (a fraction)
+    above the baseline. Benchmarks missing from either side are ignored.
+    """
+    regressions = []
+    for name, stats in sorted(results['benchmarks'].items()):
+        reference = baseline['benchmarks'].get(name)
+        if reference is None or not reference[metric]:
+            continue
+        ratio = stats[metric] / reference[metric]
+        if ratio > 1 + tolerance:
+            regressions.append("{0}: {1} {2:.3f} ms, baseline {3:.3f} ms (+{4:.0%})".format(
+                name, metric, stats[metric], reference[metric], ratio - 1))
+    return regressions
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+def save_results(results, path):
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+class Benchmark(object):
+    """Times the certificate issuance and provisioning hot paths.
+
+    Runs against the configured database, which must be empty: the tables
+    are created for the run and dropped afterwards. Every benchmark runs
+    iterations times after one untimed warm-up call, the index page is
+    measured with vpns VPNs of devices devices each. Needs an application
+    context.
+    """
+
+    def __init__(self, iterations=20, vpns=5, devices=10):
+        self.iterations = iterations
+        self.vpns = vpns
+        self.devices = devices
+        self.results = {}
+
+    def measure(self, name, function, setup=None, iterations=None):
+        "Time function, setup is called untimed before each call"
+        samples = []
+        for i in range(-1, iterations or self.iterations):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            function()
+            if i >= 0:
+                samples.append(time.perf_counter() - start)
+        self.results[name] = summarize(samples)
+        current_app.logger.info("Benchmark {0}: p50 {1:.3f} ms".format(name, self.results[name]['p50']))
+
+    def run(self, only=None):
+        "Run all benchmarks, or those whose name starts with one of only, returns the results"
+        if db.engine.table_names():
+            raise RuntimeError("The benchmarks need an empty database, {0} is not".format(db.engine.url))
+
+        config = current_app.config
+        csrf, config['WTF_CSRF_ENABLED'] = config.get('WTF_CSRF_ENABLED', True), False
+        db.create_all()
+        try:
+            self.populate()
+            for name in ('keygen', 'create_child', 'get_pkcs12', 'provision', 'index', 'device_secure'):
+                if not only or any(name.startswith(prefix) or prefix.startswith(name) for prefix in only):
+                    getattr(self, "bench_" + name)()
+        finally:
+            config['WTF_CSRF_ENABLED'] = csrf
+            db.session.remove()
+            db.drop_all()
+
+        if only:
+            self.results = dict((name, stats) for name, stats in self.results.items()
+                if any(name.startswith(prefix) for prefix in only))
+
+        return {
+            'created_at': datetime.utcnow().isoformat() + "Z",
+            'python': platform.python_version(),
+            'database': db.engine.name,
+            'iterations': self.iterations,
+            'scale': {'vpns': self.vpns, 'devices': self.devices},
+            'benchmarks': self.results,
+        }
+
+    def populate(self):
+        Role.add_default_roles()
+        self.user = User.register(email=USER_EMAIL, password=USER_PASSWORD, roles=["User"])
+
+        self.vpn_servers = []
+        for n in range(self.vpns):
+            vpn_server = VPNServer.create(name="Benchmark VPN {0}".format(n), external_hostname="vpn{0}.example.com".format(n))
+            vpn_user = vpn_server.add_user(self.user)
+            for m in range(self.devices):
+                vpn_user.add_device(name="Device {0}".format(m), device_type="generic_psk_xauth")
+            self.vpn_servers.append(vpn_server)
+
+        vpn_user = self.vpn_servers[0].find_user(self.user)
+        self.provisioning_devices = {}
+        for endpoint, device_type in PROVISIONING_ENDPOINTS:
+            if device_type not in self.provisioning_devices:
+                self.provisioning_devices[device_type] = vpn_user.add_device(name=device_type, device_type=device_type)
+
+    def client(self):
+        client = current_app.test_client()
+        client.post('/user/login', data={'email': USER_EMAIL, 'password': USER_PASSWORD})
+        return client
+
+    def bench_keygen(self):
+        for key_type in KEY_TYPES:
+            self.measure("keygen.{0}".format(key_type), lambda: generate_private_key(key_type))
+
+    def bench_create_child(self):
+        ca = self.vpn_servers[0].get_signing_ca()
+        for key_type in (ca.child_key_type, KEY_TYPE_EC_P256):
+            self.measure("create_child.{0}".format(key_type), lambda: ca.create_child(
+                settings=CERTIFICATE_SETTINGS_IPSEC_DEVICE, extras={'user_emails': [USER_EMAIL]}, key_type=key_type))
+
+    def bench_get_pkcs12(self):
+        device = self.provisioning_devices["generic_user_certificate"]
+        self.measure("get_pkcs12", lambda: device.certificate.get_pkcs12(chain=device.chain_bundle()))
+
+    def bench_provision(self):
+        client = self.client()
+        for endpoint, device_type in PROVISIONING_ENDPOINTS:
+            with current_app.test_request_context():
+                url = flask.url_for('frontend_blueprint.' + endpoint, device=self.provisioning_devices[device_type])
+
+            def get():
+                response = client.get(url)
+                assert response.status_code == 200, "{0}: {1}".format(url, response.status)
+            # Uncached payloads are what a device sees on first download
+            self.measure("provision.{0}".format(endpoint), get, setup=artifact_cache.clear)
+            self.measure("provision.{0}.cached".format(endpoint), get)
+
+    def bench_index(self):
+        client = self.client()
+
+        def get():
+            response = client.get('/')
+            assert response.status_code == 200, response.status
+        self.measure("index.{0}x{1}".format(self.vpns, self.devices), get)
+
+    def bench_device_secure(self):
+        converter = DeviceSecureConverter(current_app.url_map)
+        device = self.provisioning_devices["generic_user_certificate"]
+        self.measure("device_secure", lambda: converter.to_python(converter.to_url(device)))
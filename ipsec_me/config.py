@@ -3,8 +3,108 @@
 
 class DefaultConfig(object):
 	RSA_KEYSIZE = 4096
+	DEFAULT_KEY_TYPE = None  # e.g. "ec:secp256r1", None: RSA with RSA_KEYSIZE bits
 	PSK_ENTROPY = 96
 
+	## Storage of GUID columns outside PostgreSQL: "char" (32 hex digits) or "binary" (16 bytes).
+	## Switching an existing database needs "manage.py guid_storage --to binary|char" first.
+	GUID_STORAGE = "char"
+
+	## Number of parsed certificates and private keys cached per process
+	CERTIFICATE_CACHE_SIZE = 1024
+	## Number of provisioning payloads (.p12, .mobileconfig, ...) cached per process
+	ARTIFACT_CACHE_SIZE = 1024
+	## Number of CA certificate chains cached per process, for the provisioning payloads
+	CHAIN_CACHE_SIZE = 128
+
+	## Serial numbers reserved per CA row lock, 1 disables leasing
+	SERIAL_NUMBER_LEASE_SIZE = 100
+
+	## Revocation lists, served below CRL_BASE_URL (e.g. "https://vpn.example.com"),
+	## None leaves the CRL distribution point out of new certificates
+	CRL_BASE_URL = None
+	CRL_FULL_INTERVAL = 24*60*60
+	CRL_DELTA_INTERVAL = 60*60
+	CRL_CACHE_SIZE = 64
+	## Seconds between runs of "manage.py crl_run", which cuts new full CRLs and signs delta CRLs again before they expire
+	CRL_REFRESH_INTERVAL = 60
+
+	## OCSP responses are signed ahead of time by "manage.py ocsp_run", see ipsec_me.ocsp
+	OCSP_VALIDITY = 24*60*60
+	OCSP_REFRESH_MARGIN = 12*60*60
+	OCSP_REFRESH_INTERVAL = 60
+	OCSP_BATCH_SIZE = 100
+	## CertID hash algorithms responses are signed for, requests using others are answered with unauthorized
+	OCSP_CERT_ID_HASHES = ("sha1", "sha256")
+	OCSP_CACHE_SIZE = 10000
+	## Longest time a response is served from memory, bounds how long a revocation takes to show
+	OCSP_CACHE_TTL = 60
+
+	## Devices per query when exporting strongSwan configurations, see ipsec_me.export
+	EXPORT_BATCH_SIZE = 1000
+	## Seconds of the change journal read again by the next export, covers transactions that commit
+	## this much later than they wrote their entry. Must be more than the longest transaction.
+	EXPORT_OVERLAP = 10*60
+	## Seconds change journal entries are kept by "manage.py journal_prune", exports after a longer pause are full ones
+	JOURNAL_RETENTION = 7*24*60*60
+
+	## Unix socket of "manage.py signing_daemon", which then holds the CA keys and signs
+	## certificates and CRLs for the web workers, None: sign in-process. See ipsec_me.signing
+	SIGNING_SOCKET = None
+	SIGNING_WORKERS = None  # None: one worker process per CPU
+	SIGNING_BATCH_SIZE = 16
+	SIGNING_TIMEOUT = 30
+
+	## Request timings, see ipsec_me.metrics. /metrics is only served to these addresses, None: to anyone.
+	## Requests with Forwarded, X-Forwarded-For or X-Real-IP headers are refused: behind a reverse proxy
+	## on the same host every client has its address. The proxy must set one of them, or not pass /metrics on.
+	METRICS_ALLOWED_ADDRESSES = ("127.0.0.1", "::1")
+	## Log requests taking longer than this many seconds with a breakdown of where the time went, None: off
+	METRICS_SLOW_REQUEST = None
+
+	## Pre-generated key pool, see ipsec_me.keypool
+	KEYPOOL_DEPTH = 20
+	KEYPOOL_KEY_TYPES = None  # None: only the RSA_KEYSIZE key type
+	KEYPOOL_WORKERS = None  # None: one worker process per CPU
+	KEYPOOL_BATCH_SIZE = 10
+	KEYPOOL_INTERVAL = 5
+	KEYPOOL_HISTORY = 24*60*60
+
+	## Admission control for key generation and signing in the web processes, see ipsec_me.admission
+	ISSUANCE_PERMITS = None  # per process, None: one per CPU
+	ISSUANCE_GLOBAL_PERMITS = None  # shared by all processes through lock files, None: no limit
+	ISSUANCE_LOCK_DIR = None  # None: ipsec-me-issuance in the temporary directory
+	## Requests waiting for a permit per process before further ones get a 503
+	ISSUANCE_MAX_QUEUE = 16
+	ISSUANCE_QUEUE_TIMEOUT = 10
+	ISSUANCE_RETRY_AFTER = 5
+
+	## Create devices in background jobs instead of within the POST request
+	PROVISIONING_ASYNC = False
+	PROVISIONING_WORKERS = 4
+	PROVISIONING_POLL_INTERVAL = 2
+	## Seconds after which a RUNNING job is taken over by another worker, its own is assumed to have died
+	PROVISIONING_JOB_TIMEOUT = 10*60
+	## Seconds after which the status page of a PENDING job submits it again, the process it was queued in may be gone
+	PROVISIONING_QUEUE_TIMEOUT = 60
+
+	## Connection pool of the primary database, next to SQLALCHEMY_POOL_SIZE, SQLALCHEMY_MAX_OVERFLOW,
+	## SQLALCHEMY_POOL_TIMEOUT and SQLALCHEMY_POOL_RECYCLE. Tests connections before handing them out.
+	SQLALCHEMY_POOL_PRE_PING = False
+
+	## Read replicas for the read-only views (device pages, provisioning downloads), see ipsec_me.replicas.
+	## Listing SQLALCHEMY_DATABASE_URI here gives the downloads a pool of their own on the primary.
+	REPLICA_URLS = ()
+	REPLICA_POOL_SIZE = None
+	REPLICA_MAX_OVERFLOW = None
+	## Seconds a replica is behind, e.g. for PostgreSQL
+	## "SELECT EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())", None: never checked
+	REPLICA_LAG_QUERY = None
+	REPLICA_MAX_LAG = 5
+	REPLICA_CHECK_INTERVAL = 10
+	## Clients read from the primary for this many seconds after a request of theirs wrote
+	REPLICA_PIN_SECONDS = 10
+
 	BOOTSTRAP_SERVE_LOCAL = True
 
 ## HACK HACK
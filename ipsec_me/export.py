@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+# ipsec-me (c) Henryk Plötz
+
+from flask import current_app
+from base64 import b64encode
+from datetime import datetime, timedelta
+import os
+
+from .models import VPNUser, DeviceBase, GenericPskXauthDevice, ChangeJournal
+
+STATE_FILE = ".ipsec-me-export"
+STATE_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+SECRETS_DIR = "ipsec.secrets.d"
+
+## ipsec.secrets key types by key algorithm
+SECRET_KEY_TYPES = {
+    'rsa': "RSA",
+    'ec': "ECDSA",
+    'ed25519': "PKCS8",
+}
+
+HEADER = "# Generated by ipsec-me for {0}, do not edit\n"
+
+IPSEC_CONF = """config setup
+
+conn {name}-base
+{configuration}
+    left=%any
+    leftid=@{hostname}
+    right=%any
+
+conn {name}-cert
+    also={name}-base
+    leftcert={name}.pem
+    leftsendcert=always
+    rightauth=pubkey
+    auto=add
+
+conn {name}-xauth
+    also={name}-base
+    keyexchange=ikev1
+    leftauth=psk
+    rightauth=psk
+    rightauth2=xauth
+    auto=add
+"""
+
+def _quote(value):
+    if '"' in value or '\n' in value:
+        return "0s" + b64encode(value.encode("UTF-8")).decode("US-ASCII")
+    return '"{0}"'.format(value)
+
+def render_ipsec_conf(vpn_server):
+    configuration = "\n".join("    " + line.strip() for line in vpn_server.configuration.splitlines() if line.strip())
+    return HEADER.format(vpn_server.name) + IPSEC_CONF.format(name=DeviceBase.nameify(vpn_server.name),
+        configuration=configuration, hostname=vpn_server.external_hostname)
+
+def render_ipsec_secrets(vpn_server, include=SECRETS_DIR):
+    name = DeviceBase.nameify(vpn_server.name)
+    algorithm = vpn_server.certificate.key_type.partition(':')[0]
+    result = HEADER.format(vpn_server.name)
+    result += ": {0} {1}.pem\n".format(SECRET_KEY_TYPES[algorithm], name)
+    result += "%any : PSK {0}\n".format(_quote(vpn_server.psk))
+    if include:
+        result += "include {0}/*.secrets\n".format(include)
+    return result
+
+def render_device_secrets(device):
+    if not device.device_identity or not device.password:
+        return ""
+    return "{0} : XAUTH {1}\n".format(_quote(device.device_identity), _quote(device.password))
+
+def psk_devices(vpn_server):
+    "Query for the devices of a server that have an XAUTH secret"
+    return GenericPskXauthDevice.query \
+        .join(VPNUser, GenericPskXauthDevice.vpn_user_id == VPNUser.id) \
+        .filter(VPNUser.vpn_server_id == vpn_server.id)
+
+def stream_ipsec_secrets(vpn_server, batch_size=None):
+    "ipsec.secrets with all device secrets inline, as a generator of lines"
+    yield render_ipsec_secrets(vpn_server, include=None)
+    for device in psk_devices(vpn_server).yield_per(batch_size or current_app.config['EXPORT_BATCH_SIZE']):
+        yield render_device_secrets(device)
+
+
+class StrongSwanExporter(object):
+    """Writes the strongSwan gateway configuration of a VPN server into a directory.
+
+    The layout mirrors /etc: ipsec.conf, ipsec.secrets, ipsec.d/ with the
+    CA, server certificate and key, and one file per XAUTH device in
+    ipsec.secrets.d/, included from ipsec.secrets. The id of the last change
+    journal entry exported is kept in the directory, so that later exports
+    only rewrite the files of devices that changed since, and the server
+    files if the server changed. Entries of the last ``EXPORT_OVERLAP``
+    seconds before an export are read again by the next one, in case their
+    transaction was still running. An export more than JOURNAL_RETENTION
+    seconds after the previous one is a full one.
+    """
+
+    def __init__(self, vpn_server, directory, batch_size=None):
+        self.vpn_server = vpn_server
+        self.directory = directory
+        self.batch_size = batch_size or current_app.config['EXPORT_BATCH_SIZE']
+        self.written = 0
+        self.removed = 0
+
+    def _path(self, *parts):
+        return os.path.join(self.directory, *parts)
+
+    def _write(self, data, *parts, mode=0o644):
+        path = self._path(*parts)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if isinstance(data, str):
+            data = data.encode("UTF-8")
+        # Write and rename, so that strongSwan never reads a partial file
+        tmp = path + ".tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        self.written += 1
+
+    def _remove(self, *parts):
+        try:
+            os.unlink(self._path(*parts))
+            self.removed += 1
+        except FileNotFoundError:
+            pass
+
+    def _device_file(self, device_id):
+        return (SECRETS_DIR, "{0}.secrets".format(device_id))
+
+    def last_exported(self):
+        "Id of the last journal entry exported and when it was read, None if unknown"
+        try:
+            with open(self._path(STATE_FILE)) as f:
+                last_id, last_at = f.read().split()
+            return int(last_id), datetime.strptime(last_at, STATE_TIME_FORMAT)
+        except (OSError, ValueError):
+            # State files of older versions only have the id, the next export is a full one
+            return None
+
+    def export(self, full=False):
+        "Write all files or just the changed ones, returns whether it was a full export"
+        # Read first: changes made during the export are exported again next time
+        head_at = datetime.utcnow()
+        head = ChangeJournal.head(self.vpn_server.id)
+        last = self.last_exported()
+
+        # Entries older than JOURNAL_RETENTION may have been pruned, see ChangeJournal.prune
+        if last is not None and last[1] - timedelta(seconds=current_app.config['EXPORT_OVERLAP']) < \
+                head_at - timedelta(seconds=current_app.config['JOURNAL_RETENTION']):
+            last = None
+
+        if full or last is None:
+            full = True
+            self.export_server()
+            self.export_all_devices()
+        else:
+            last_id, last_at = last
+            changed_after = last_at - timedelta(seconds=current_app.config['EXPORT_OVERLAP'])
+            device_ids, server_changed = ChangeJournal.since(self.vpn_server.id, last_id, changed_after)
+            if server_changed:
+                self.export_server()
+            self.export_devices(device_ids)
+
+        self._write("{0} {1}\n".format(head, head_at.strftime(STATE_TIME_FORMAT)), STATE_FILE)
+        return full
+
+    def export_server(self):
+        vpn_server = self.vpn_server
+        name = DeviceBase.nameify(vpn_server.name)
+        self._write(render_ipsec_conf(vpn_server), "ipsec.conf")
+        self._write(render_ipsec_secrets(vpn_server), "ipsec.secrets", mode=0o600)
+        for ca in vpn_server.trusted_CAs():
+            self._write(ca.certificate.get_cert_pem(), "ipsec.d", "cacerts", "{0}.pem".format(ca.id))
+        self._write(vpn_server.certificate.get_cert_pem(), "ipsec.d", "certs", "{0}.pem".format(name))
+        self._write(vpn_server.certificate.get_key_pem(), "ipsec.d", "private", "{0}.pem".format(name), mode=0o600)
+
+    def export_all_devices(self):
+        exported = set()
+        for device in psk_devices(self.vpn_server).yield_per(self.batch_size):
+            self._write(render_device_secrets(device), *self._device_file(device.id), mode=0o600)
+            exported.add(self._device_file(device.id)[1])
+
+        if os.path.isdir(self._path(SECRETS_DIR)):
+            for filename in os.listdir(self._path(SECRETS_DIR)):
+                if filename.endswith(".secrets") and filename not in exported:
+                    self._remove(SECRETS_DIR, filename)
+
+    def export_devices(self, device_ids):
+        "Rewrite the files of the given devices, removing those of deleted or moved devices"
+        device_ids = list(device_ids)
+        for start in range(0, len(device_ids), self.batch_size):
+            batch = device_ids[start:start + self.batch_size]
+            devices = dict((device.id, device) for device in psk_devices(self.vpn_server).filter(DeviceBase.id.in_(batch)))
+            for device_id in batch:
+                if device_id in devices:
+                    self._write(render_device_secrets(devices[device_id]), *self._device_file(device_id), mode=0o600)
+                else:
+                    self._remove(*self._device_file(device_id))
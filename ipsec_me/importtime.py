@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+# ipsec-me (c) Henryk Plötz
+
+from collections import defaultdict
+import re
+import subprocess
+import sys
+
+## Run in a fresh interpreter, so that nothing is imported yet
+_SCRIPT = """
+import time
+start = time.perf_counter()
+import ipsec_me
+imported = time.perf_counter()
+ipsec_me.create_app({profile!r})
+print(imported - start, time.perf_counter() - imported)
+"""
+
+_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+class ImportReport(object):
+    def __init__(self, import_seconds, create_app_seconds, modules):
+        self.import_seconds = import_seconds
+        self.create_app_seconds = create_app_seconds
+        ## [(module name, self seconds, cumulative seconds, nesting level)]
+        self.modules = modules
+
+    def by_package(self):
+        "Import time per top-level package, slowest first"
+        totals = defaultdict(float)
+        for name, self_seconds, cumulative, level in self.modules:
+            totals[name.partition('.')[0]] += self_seconds
+        return sorted(totals.items(), key=lambda item: -item[1])
+
+    def slowest(self):
+        "Modules by their own import time, slowest first"
+        return sorted(self.modules, key=lambda module: -module[1])
+
+def import_report(profile="cli"):
+    "Time importing ipsec_me and creating the app with a profile in a new interpreter, needs Python 3.7"
+    if sys.version_info < (3, 7):
+        raise RuntimeError("Import timing needs Python 3.7 or later")
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", _SCRIPT.format(profile=profile)],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+
+    modules = []
+    for line in result.stderr.splitlines():
+        match = _LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            modules.append((name, int(self_us) / 1e6, int(cumulative_us) / 1e6, (len(indent) - 1) // 2))
+    import_seconds, create_app_seconds = (float(value) for value in result.stdout.split()[-2:])
+    return ImportReport(import_seconds, create_app_seconds, modules)
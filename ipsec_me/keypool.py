@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# ipsec-me (c) Henryk Plötz
+
+from flask import current_app
+from multiprocessing import Pool
+from datetime import datetime, timedelta
+import time
+
+from .models.keypool import PooledKey, keypool_key_types
+from .models.keys import generate_private_key, serialize_private_key
+
+
+def _generate_key(key_type):
+    "Runs in the worker processes, must not touch the database or the application"
+    return serialize_private_key(generate_private_key(key_type))
+
+
+class KeyPoolFiller(object):
+    """Keeps the pre-generated key pool filled up to ``KEYPOOL_DEPTH`` keys per key type.
+
+    Keys are generated in a pool of worker processes and stored by the calling
+    process, which needs an application context. With ``workers=0`` keys are
+    generated inline, which is mostly useful for tests.
+    """
+
+    def __init__(self, workers=None, batch_size=None):
+        self.workers = workers if workers is not None else current_app.config['KEYPOOL_WORKERS']
+        self.batch_size = batch_size or current_app.config['KEYPOOL_BATCH_SIZE']
+        self._pool = None
+
+    def _map(self, key_types):
+        if self.workers == 0:
+            return map(_generate_key, key_types)
+        if self._pool is None:
+            self._pool = Pool(self.workers)
+        return self._pool.imap_unordered(_generate_key, key_types)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def fill(self):
+        "Generate missing keys for all configured key types, returns the number of keys generated per key type"
+        target = current_app.config['KEYPOOL_DEPTH']
+        depth = PooledKey.depth()
+        result = {}
+
+        for key_type in keypool_key_types():
+            missing = target - depth.get(key_type, 0)
+            if missing <= 0:
+                continue
+
+            start = time.time()
+            batch = []
+            for key in self._map([key_type] * missing):
+                batch.append(key)
+                if len(batch) >= self.batch_size:
+                    PooledKey.add_keys(key_type, batch)
+                    batch = []
+            if batch:
+                PooledKey.add_keys(key_type, batch)
+
+            duration = time.time() - start
+            current_app.logger.info("Key pool {0}: generated {1} keys in {2:.1f}s ({3:.2f} keys/s)".format(
+                key_type, missing, duration, missing / duration if duration else 0))
+            result[key_type] = missing
+
+        PooledKey.purge(datetime.utcnow() - timedelta(seconds=current_app.config['KEYPOOL_HISTORY']))
+        return result
+
+    def run(self, interval=None):
+        "Refill the pool forever, checking every interval seconds"
+        if interval is None:
+            interval = current_app.config['KEYPOOL_INTERVAL']
+        try:
+            while True:
+                self.fill()
+                time.sleep(interval)
+        finally:
+            self.close()
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+# ipsec-me (c) Henryk Plötz
+
+from flask import current_app, request, before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from contextlib import contextmanager
+from collections import OrderedDict
+import threading
+import time
+
+INF = float("inf")
+
+## Upper bounds in seconds
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, INF)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, INF)
+
+def _format_value(value):
+    if value == INF:
+        return "+Inf"
+    return repr(float(value))
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{0}="{1}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels) + "}"
+
+
+class Histogram(object):
+    "Cumulative histogram with one series per combination of label values"
+
+    def __init__(self, name, help, labelnames=(), buckets=DURATION_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        ## label values -> [count per bucket, sum]
+        self._series = {}
+
+    def observe(self, value, *labelvalues):
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [[0] * len(self.buckets), 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+
+    def render(self):
+        lines = ["# HELP {0} {1}".format(self.name, self.help), "# TYPE {0} histogram".format(self.name)]
+        with self._lock:
+            series = sorted((labelvalues, list(counts), total) for labelvalues, (counts, total) in self._series.items())
+        for labelvalues, counts, total in series:
+            labels = list(zip(self.labelnames, labelvalues))
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append("{0}_bucket{1} {2}".format(self.name, _format_labels(labels + [("le", _format_value(bound))]), cumulative))
+            lines.append("{0}_sum{1} {2}".format(self.name, _format_labels(labels), _format_value(total)))
+            lines.append("{0}_count{1} {2}".format(self.name, _format_labels(labels), cumulative))
+        return lines
+
+    def clear(self):
+        with self._lock:
+            self._series = {}
+
+
+class RequestTimings(object):
+    "Time spent per operation during one request, for the slow request log"
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        ## operation -> [calls, seconds]
+        self.operations = OrderedDict()
+
+    def add(self, operation, seconds):
+        entry = self.operations.setdefault(operation, [0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+
+    def calls(self, operation):
+        return self.operations.get(operation, (0, 0.0))[0]
+
+    def breakdown(self):
+        return ", ".join("{0} {1:.3f}s ({2})".format(operation, seconds, calls)
+            for operation, (calls, seconds) in sorted(self.operations.items(), key=lambda item: -item[1][1]))
+
+
+class Metrics(object):
+    """Process-wide request and operation timings, rendered in the Prometheus text format.
+
+    Each process keeps its own numbers, like the caches. Besides the
+    histograms, collectors registered with :meth:`add_collector` are asked
+    for their current values on every scrape.
+    """
+
+    def __init__(self):
+        self.requests = Histogram("ipsec_me_request_duration_seconds",
+            "Time to handle a request", ("method", "route", "status"))
+        self.request_queries = Histogram("ipsec_me_request_queries",
+            "Database queries per request", ("route",), QUERY_COUNT_BUCKETS)
+        self.operations = Histogram("ipsec_me_operation_duration_seconds",
+            "Time spent in an operation, e.g. keygen, query or render", ("operation",))
+        self._collectors = []
+        self._local = threading.local()
+
+    def init_app(self, app):
+        "Time the requests and template rendering of app"
+        app.before_request(self.start_request)
+
+        @app.after_request
+        def finish(response):
+            self.finish_request(response.status_code)
+            return response
+
+        @app.teardown_request
+        def teardown(exception):
+            # Only still running if the request failed with an exception
+            self.finish_request(500)
+
+        before_render_template.connect(self._render_started, app)
+        template_rendered.connect(self._render_finished, app)
+
+    def _render_started(self, sender, template, context, **extra):
+        self._local.render_start = time.perf_counter()
+
+    def _render_finished(self, sender, template, context, **extra):
+        start = getattr(self._local, 'render_start', None)
+        if start is not None:
+            self._local.render_start = None
+            self.observe("render", time.perf_counter() - start)
+
+    def add_collector(self, collector):
+        "collector returns a list of Prometheus text lines"
+        self._collectors.append(collector)
+
+    @property
+    def current(self):
+        "Timings of the request handled by this thread, None outside of requests"
+        return getattr(self._local, 'timings', None)
+
+    def observe(self, operation, seconds):
+        self.operations.observe(seconds, operation)
+        timings = self.current
+        if timings is not None:
+            timings.add(operation, seconds)
+
+    def start_request(self):
+        self._local.timings = RequestTimings()
+
+    def finish_request(self, status):
+        timings = self.current
+        if timings is None:
+            return
+        self._local.timings = None
+
+        duration = time.perf_counter() - timings.start
+        route = request.url_rule.rule if request.url_rule is not None else "<unmatched>"
+        self.requests.observe(duration, request.method, route, status)
+        self.request_queries.observe(timings.calls("query") + timings.calls("query_for_update"), route)
+
+        slow = current_app.config['METRICS_SLOW_REQUEST']
+        if slow is not None and duration >= slow:
+            current_app.logger.warning("Slow request {0} {1} {2:.3f}s: {3}".format(
+                request.method, request.path, duration, timings.breakdown() or "no instrumented operations"))
+
+    def render(self):
+        lines = []
+        for histogram in (self.requests, self.request_queries, self.operations):
+            lines.extend(histogram.render())
+        for collector in self._collectors:
+            lines.extend(collector())
+        return "\n".join(lines) + "\n"
+
+    def clear(self):
+        for histogram in (self.requests, self.request_queries, self.operations):
+            histogram.clear()
+
+metrics = Metrics()
+
+@contextmanager
+def timed(operation):
+    "Record the time spent in the block or decorated function as operation"
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe(operation, time.perf_counter() - start)
+
+def cache_collector(caches):
+    "Collector for a dictionary name -> LRUCache"
+    def collect():
+        lines = []
+        for metric, kind, attribute in (
+                ("ipsec_me_cache_hits_total", "counter", "hits"),
+                ("ipsec_me_cache_misses_total", "counter", "misses"),
+                ("ipsec_me_cache_evictions_total", "counter", "evictions"),
+                ("ipsec_me_cache_size", "gauge", "size")):
+            lines.append("# TYPE {0} {1}".format(metric, kind))
+            for name, cache in sorted(caches.items()):
+                value = len(cache) if attribute == "size" else getattr(cache, attribute)
+                lines.append("{0}{1} {2}".format(metric, _format_labels([("cache", name)]), value))
+        return lines
+    return collect
+
+def gauge_collector(name, help, values, labelname):
+    "Collector for a gauge, values returns a dictionary label value -> value"
+    def collect():
+        lines = ["# HELP {0} {1}".format(name, help), "# TYPE {0} gauge".format(name)]
+        for label, value in sorted(values().items()):
+            lines.append("{0}{1} {2}".format(name, _format_labels([(labelname, label)]), value))
+        return lines
+    return collect
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _query_started(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _query_finished(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info['query_start'].pop()
+    # Row locks are where concurrent issuance waits, keep them apart
+    metrics.observe("query_for_update" if "FOR UPDATE" in statement else "query", time.perf_counter() - start)
+
+@event.listens_for(Engine, 'handle_error')
+def _query_failed(exception_context):
+    if exception_context.connection is not None and exception_context.connection.info.get('query_start'):
+        exception_context.connection.info['query_start'].pop()
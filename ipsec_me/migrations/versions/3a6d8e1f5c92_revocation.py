@@ -0,0 +1,47 @@
+"""certificate revocation lists
+
+Revision ID: 3a6d8e1f5c92
+Revises: b7f2c9e41d63
+Create Date: 2026-10-18 16:48:05.631870
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3a6d8e1f5c92'
+down_revision = 'b7f2c9e41d63'
+
+from alembic import op
+import sqlalchemy as sa
+from ipsec_me.models.utils import GUID
+
+
+def upgrade():
+    op.create_table('revoked_certificate',
+    sa.Column('id', GUID(), nullable=False),
+    sa.Column('ca_id', GUID(), nullable=False),
+    sa.Column('certificate_id', GUID(), nullable=True),
+    sa.Column('serial_number', sa.BigInteger(), nullable=False),
+    sa.Column('revoked_at', sa.DateTime(), nullable=False),
+    sa.Column('reason', sa.String(length=32), nullable=True),
+    sa.Column('crl_number', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['ca_id'], ['certificate_authority.id'], ),
+    sa.ForeignKeyConstraint(['certificate_id'], ['certificate.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_revoked_certificate_ca_id_serial_number', 'revoked_certificate', ['ca_id', 'serial_number'], unique=True)
+    op.create_index('ix_revoked_certificate_ca_id_crl_number', 'revoked_certificate', ['ca_id', 'crl_number'], unique=False)
+
+    op.add_column('certificate_authority', sa.Column('crl_number', sa.Integer(), server_default='0', nullable=True))
+    op.add_column('certificate_authority', sa.Column('crl_base_number', sa.Integer(), nullable=True))
+    op.add_column('certificate_authority', sa.Column('crl_base_at', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('certificate_authority') as batch_op:
+        batch_op.drop_column('crl_base_at')
+        batch_op.drop_column('crl_base_number')
+        batch_op.drop_column('crl_number')
+
+    op.drop_index('ix_revoked_certificate_ca_id_crl_number', table_name='revoked_certificate')
+    op.drop_index('ix_revoked_certificate_ca_id_serial_number', table_name='revoked_certificate')
+    op.drop_table('revoked_certificate')
@@ -0,0 +1,38 @@
+"""asynchronous provisioning jobs
+
+Revision ID: 4b1f0de2c6a7
+Revises: 70a70863a49d
+Create Date: 2026-10-18 11:03:52.771023
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4b1f0de2c6a7'
+down_revision = '70a70863a49d'
+
+from alembic import op
+import sqlalchemy as sa
+from ipsec_me.models.utils import GUID
+
+
+def upgrade():
+    op.create_table('provisioning_job',
+    sa.Column('id', GUID(), nullable=False),
+    sa.Column('vpn_user_id', GUID(), nullable=True),
+    sa.Column('name', sa.String(length=255), nullable=True),
+    sa.Column('device_type', sa.String(), nullable=True),
+    sa.Column('status', sa.Enum('PENDING', 'RUNNING', 'DONE', 'FAILED', name='jobstatus'), nullable=True),
+    sa.Column('error', sa.Text(), nullable=True),
+    sa.Column('device_id', GUID(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.Column('finished_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['device_id'], ['device.id'], ),
+    sa.ForeignKeyConstraint(['vpn_user_id'], ['vpn_user.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_provisioning_job_status', 'provisioning_job', ['status'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_provisioning_job_status', table_name='provisioning_job')
+    op.drop_table('provisioning_job')
@@ -0,0 +1,97 @@
+"""binary GUID storage
+
+Converts all GUID columns to BINARY(16) if GUID_STORAGE is "binary".
+Nothing to do on PostgreSQL, which has a native UUID type. On MySQL the
+column types are changed, on SQLite only the stored values.
+
+Only covers the tables of this revision. To switch an existing database
+later, run ``manage.py guid_storage --to binary`` (or ``char``), which
+converts every GUID column of the current schema, and set GUID_STORAGE.
+
+Revision ID: 5e8b1f3c7a24
+Revises: d41a7c5e9b20
+Create Date: 2026-10-18 14:52:31.260413
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5e8b1f3c7a24'
+down_revision = 'd41a7c5e9b20'
+
+from alembic import op
+import sqlalchemy as sa
+from flask import current_app
+import uuid
+
+## The GUID columns as of this revision, see ipsec_me.models.utils.guid_columns for the current ones
+GUID_COLUMNS = [
+    ('certificate', ['id']),
+    ('certificate_authority', ['id', 'certificate_id']),
+    ('vpn_server', ['id', 'certificate_id']),
+    ('ca_vpn_table', ['vpn_server_id', 'certificate_authority_id']),
+    ('vpn_user', ['id', 'vpn_server_id']),
+    ('device', ['id', 'vpn_user_id', 'certificate_id']),
+    ('provisioning_job', ['id', 'vpn_user_id', 'device_id']),
+    ('pooled_key', ['id']),
+]
+
+
+def to_binary(value):
+    if isinstance(value, bytes) and len(value) == 16:
+        return value
+    if isinstance(value, bytes):
+        value = value.decode("US-ASCII")
+    return uuid.UUID(value).bytes
+
+def to_char(value):
+    if isinstance(value, bytes) and len(value) == 16:
+        return uuid.UUID(bytes=value).hex
+    if isinstance(value, bytes):
+        return value.decode("US-ASCII")
+    return value
+
+def convert_values(connection, convert):
+    # Columns are untyped, so values are read and written as stored. Old and new
+    # representations never collide, so rows can be converted one value at a time.
+    for table_name, column_names in GUID_COLUMNS:
+        for column_name in column_names:
+            column = sa.column(column_name)
+            table = sa.table(table_name, column)
+            values = [row[0] for row in connection.execute(sa.select([column]).distinct()) if row[0] is not None]
+            for value in values:
+                converted = convert(value)
+                if converted != value:
+                    connection.execute(table.update().where(column == value).values({column_name: converted}))
+
+def alter_columns(type_):
+    for table_name, column_names in GUID_COLUMNS:
+        with op.batch_alter_table(table_name) as batch_op:
+            for column_name in column_names:
+                batch_op.alter_column(column_name, type_=type_, existing_nullable=column_name != 'id')
+
+def convert_storage(convert, type_):
+    connection = op.get_bind()
+
+    if connection.dialect.name == 'sqlite':
+        # Column types are only advisory, values keep the storage class they were written with
+        convert_values(connection, convert)
+        return
+
+    # Needs a column type that holds both representations during the conversion
+    connection.execute("SET FOREIGN_KEY_CHECKS=0")
+    alter_columns(sa.VARBINARY(32))
+    convert_values(connection, convert)
+    alter_columns(type_)
+    connection.execute("SET FOREIGN_KEY_CHECKS=1")
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'postgresql' or current_app.config.get('GUID_STORAGE') != "binary":
+        return
+    convert_storage(to_binary, sa.BINARY(16))
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        return
+    convert_storage(to_char, sa.CHAR(32))
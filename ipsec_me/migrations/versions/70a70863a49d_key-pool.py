@@ -0,0 +1,34 @@
+"""pre-generated key pool
+
+Revision ID: 70a70863a49d
+Revises: 20f04b9598da
+Create Date: 2026-10-18 10:12:31.204518
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '70a70863a49d'
+down_revision = '20f04b9598da'
+
+from alembic import op
+import sqlalchemy as sa
+from ipsec_me.models.utils import GUID
+
+
+def upgrade():
+    op.create_table('pooled_key',
+    sa.Column('id', GUID(), nullable=False),
+    sa.Column('key_type', sa.String(length=32), nullable=True),
+    sa.Column('private_key', sa.LargeBinary(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.Column('taken_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_pooled_key_created_at', 'pooled_key', ['created_at'], unique=False)
+    op.create_index('ix_pooled_key_key_type_taken_at', 'pooled_key', ['key_type', 'taken_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_pooled_key_key_type_taken_at', table_name='pooled_key')
+    op.drop_index('ix_pooled_key_created_at', table_name='pooled_key')
+    op.drop_table('pooled_key')
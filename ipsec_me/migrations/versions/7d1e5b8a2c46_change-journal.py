@@ -0,0 +1,31 @@
+"""change journal for gateway exports
+
+Revision ID: 7d1e5b8a2c46
+Revises: e2c4a7b93f18
+Create Date: 2026-10-18 18:41:12.907354
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7d1e5b8a2c46'
+down_revision = 'e2c4a7b93f18'
+
+from alembic import op
+import sqlalchemy as sa
+from ipsec_me.models.utils import GUID
+
+
+def upgrade():
+    op.create_table('change_journal',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('vpn_server_id', GUID(), nullable=False),
+    sa.Column('device_id', GUID(), nullable=True),
+    sa.Column('changed_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_change_journal_vpn_server_id_id', 'change_journal', ['vpn_server_id', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_change_journal_vpn_server_id_id', table_name='change_journal')
+    op.drop_table('change_journal')
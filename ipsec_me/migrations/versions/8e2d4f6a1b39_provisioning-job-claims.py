@@ -0,0 +1,26 @@
+"""claim time of provisioning jobs
+
+Revision ID: 8e2d4f6a1b39
+Revises: f3b8d2a61c07
+Create Date: 2026-10-19 10:12:31.408716
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8e2d4f6a1b39'
+down_revision = 'f3b8d2a61c07'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('provisioning_job', sa.Column('claimed_at', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    # SQLite copies the table, which would create the index a second time
+    op.drop_index('ix_provisioning_job_status', table_name='provisioning_job')
+    with op.batch_alter_table('provisioning_job') as batch_op:
+        batch_op.drop_column('claimed_at')
+    op.create_index('ix_provisioning_job_status', 'provisioning_job', ['status'], unique=False)
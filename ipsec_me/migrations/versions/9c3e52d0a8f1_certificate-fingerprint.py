@@ -0,0 +1,51 @@
+"""stored certificate fingerprint
+
+Revision ID: 9c3e52d0a8f1
+Revises: 4b1f0de2c6a7
+Create Date: 2026-10-18 12:20:07.415530
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9c3e52d0a8f1'
+down_revision = '4b1f0de2c6a7'
+
+from alembic import op
+import sqlalchemy as sa
+from hashlib import sha256
+
+BATCH_SIZE = 500
+
+certificate = sa.table('certificate',
+    # untyped, ids are passed through in whatever GUID storage the table uses
+    sa.column('id'),
+    sa.column('certificate', sa.LargeBinary()),
+    sa.column('fingerprint', sa.String(length=64)),
+)
+
+
+def upgrade():
+    op.add_column('certificate', sa.Column('fingerprint', sa.String(length=64), nullable=True))
+    op.create_index('ix_certificate_fingerprint', 'certificate', ['fingerprint'], unique=False)
+
+    connection = op.get_bind()
+    while True:
+        rows = connection.execute(
+            sa.select([certificate.c.id, certificate.c.certificate])
+            .where(certificate.c.fingerprint == None)
+            .where(certificate.c.certificate != None)
+            .limit(BATCH_SIZE)
+        ).fetchall()
+        if not rows:
+            break
+        for row in rows:
+            connection.execute(
+                certificate.update()
+                .where(certificate.c.id == row.id)
+                .values(fingerprint=sha256(row.certificate).hexdigest())
+            )
+
+
+def downgrade():
+    op.drop_index('ix_certificate_fingerprint', table_name='certificate')
+    op.drop_column('certificate', 'fingerprint')
@@ -0,0 +1,23 @@
+"""update time of VPN servers
+
+Revision ID: a4c7e1d9f250
+Revises: 8e2d4f6a1b39
+Create Date: 2026-10-19 11:02:47.190853
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a4c7e1d9f250'
+down_revision = '8e2d4f6a1b39'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('vpn_server', sa.Column('updated_at', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('vpn_server') as batch_op:
+        batch_op.drop_column('updated_at')
@@ -0,0 +1,51 @@
+"""unique VPN membership
+
+Revision ID: b7f2c9e41d63
+Revises: 5e8b1f3c7a24
+Create Date: 2026-10-18 15:37:48.119502
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b7f2c9e41d63'
+down_revision = '5e8b1f3c7a24'
+
+from alembic import op
+import sqlalchemy as sa
+
+# untyped, ids are passed through in whatever GUID storage the tables use
+vpn_user = sa.table('vpn_user',
+    sa.column('id'),
+    sa.column('vpn_server_id'),
+    sa.column('user_id'),
+)
+
+device = sa.table('device',
+    sa.column('vpn_user_id'),
+)
+
+provisioning_job = sa.table('provisioning_job',
+    sa.column('vpn_user_id'),
+)
+
+
+def upgrade():
+    # Merge duplicate memberships into the first one before enforcing uniqueness
+    connection = op.get_bind()
+    kept = {}
+    for row in connection.execute(sa.select([vpn_user.c.id, vpn_user.c.vpn_server_id, vpn_user.c.user_id]).order_by(vpn_user.c.id)):
+        key = (row.vpn_server_id, row.user_id)
+        if row.user_id is None:
+            continue
+        if key not in kept:
+            kept[key] = row.id
+            continue
+        for table in (device, provisioning_job):
+            connection.execute(table.update().where(table.c.vpn_user_id == row.id).values(vpn_user_id=kept[key]))
+        connection.execute(vpn_user.delete().where(vpn_user.c.id == row.id))
+
+    op.create_index('ix_vpn_user_vpn_server_id_user_id', 'vpn_user', ['vpn_server_id', 'user_id'], unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_vpn_user_vpn_server_id_user_id', table_name='vpn_user')
@@ -0,0 +1,44 @@
+"""published CRLs with their own numbering
+
+Revision ID: b9d3f5a27c84
+Revises: a4c7e1d9f250
+Create Date: 2026-10-19 13:26:09.553140
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b9d3f5a27c84'
+down_revision = 'a4c7e1d9f250'
+
+from alembic import op
+import sqlalchemy as sa
+from ipsec_me.models.utils import GUID
+
+
+def upgrade():
+    op.create_table('published_crl',
+    sa.Column('id', GUID(), nullable=False),
+    sa.Column('ca_id', GUID(), nullable=False),
+    sa.Column('delta', sa.Boolean(), nullable=False),
+    sa.Column('crl_number', sa.Integer(), nullable=False),
+    sa.Column('last_entry', sa.Integer(), nullable=False),
+    sa.Column('last_update', sa.DateTime(), nullable=False),
+    sa.Column('next_update', sa.DateTime(), nullable=False),
+    sa.Column('der', sa.LargeBinary(), nullable=False),
+    sa.ForeignKeyConstraint(['ca_id'], ['certificate_authority.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_published_crl_ca_id_delta', 'published_crl', ['ca_id', 'delta'], unique=True)
+
+    # CRLs signed so far carried the revocation count as their number, continue above it
+    op.add_column('certificate_authority', sa.Column('last_crl_number', sa.Integer(), server_default='0', nullable=True))
+    op.execute("UPDATE certificate_authority SET last_crl_number = crl_number")
+
+
+def downgrade():
+    with op.batch_alter_table('certificate_authority',
+            reflect_args=[sa.Column('issuing', sa.Boolean(create_constraint=False), server_default=sa.true())]) as batch_op:
+        batch_op.drop_column('last_crl_number')
+
+    op.drop_index('ix_published_crl_ca_id_delta', table_name='published_crl')
+    op.drop_table('published_crl')
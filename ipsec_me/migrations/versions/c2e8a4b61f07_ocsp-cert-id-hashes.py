@@ -0,0 +1,33 @@
+"""OCSP responses per CertID hash algorithm
+
+Revision ID: c2e8a4b61f07
+Revises: b9d3f5a27c84
+Create Date: 2026-10-19 14:40:12.806254
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c2e8a4b61f07'
+down_revision = 'b9d3f5a27c84'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('ocsp_response', sa.Column('hash_algorithm', sa.String(length=16), server_default='sha1', nullable=False))
+    op.drop_index('ix_ocsp_response_ca_id_serial_number', table_name='ocsp_response')
+    op.create_index('ix_ocsp_response_ca_id_serial_number_hash_algorithm', 'ocsp_response', ['ca_id', 'serial_number', 'hash_algorithm'], unique=True)
+
+
+def downgrade():
+    op.execute("DELETE FROM ocsp_response WHERE hash_algorithm != 'sha1'")
+    op.drop_index('ix_ocsp_response_ca_id_serial_number_hash_algorithm', table_name='ocsp_response')
+    op.drop_index('ix_ocsp_response_certificate_id', table_name='ocsp_response')
+    op.drop_index('ix_ocsp_response_next_update', table_name='ocsp_response')
+    # SQLite copies the table, which would create the remaining indexes a second time
+    with op.batch_alter_table('ocsp_response') as batch_op:
+        batch_op.drop_column('hash_algorithm')
+    op.create_index('ix_ocsp_response_next_update', 'ocsp_response', ['next_update'], unique=False)
+    op.create_index('ix_ocsp_response_certificate_id', 'ocsp_response', ['certificate_id'], unique=False)
+    op.create_index('ix_ocsp_response_ca_id_serial_number', 'ocsp_response', ['ca_id', 'serial_number'], unique=True)
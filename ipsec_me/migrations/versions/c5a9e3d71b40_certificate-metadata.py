@@ -0,0 +1,67 @@
+"""indexed certificate metadata
+
+Revision ID: c5a9e3d71b40
+Revises: 7d1e5b8a2c46
+Create Date: 2026-10-18 19:52:31.204718
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c5a9e3d71b40'
+down_revision = '7d1e5b8a2c46'
+
+from alembic import op
+import sqlalchemy as sa
+from ipsec_me.models.certificate import certificate_metadata, METADATA_COLUMNS
+
+BATCH_SIZE = 500
+
+certificate = sa.table('certificate',
+    # untyped, ids are passed through in whatever GUID storage the table uses
+    sa.column('id'),
+    sa.column('certificate', sa.LargeBinary()),
+    *[sa.column(column) for column in METADATA_COLUMNS]
+)
+
+
+def upgrade():
+    op.add_column('certificate', sa.Column('subject_dn', sa.String(length=255), nullable=True))
+    op.add_column('certificate', sa.Column('issuer_dn', sa.String(length=255), nullable=True))
+    op.add_column('certificate', sa.Column('serial_number', sa.String(length=40), nullable=True))
+    op.add_column('certificate', sa.Column('not_before', sa.DateTime(), nullable=True))
+    op.add_column('certificate', sa.Column('not_after', sa.DateTime(), nullable=True))
+    op.add_column('certificate', sa.Column('key_algorithm', sa.String(length=32), nullable=True))
+
+    # Walk the table in id order, one statement per batch for the updates
+    connection = op.get_bind()
+    update = certificate.update() \
+        .where(certificate.c.id == sa.bindparam('_id')) \
+        .values(**dict((column, sa.bindparam(column)) for column in METADATA_COLUMNS))
+    last_id = None
+    while True:
+        query = sa.select([certificate.c.id, certificate.c.certificate]) \
+            .where(certificate.c.certificate != None) \
+            .order_by(certificate.c.id) \
+            .limit(BATCH_SIZE)
+        if last_id is not None:
+            query = query.where(certificate.c.id > last_id)
+        rows = connection.execute(query).fetchall()
+        if not rows:
+            break
+        connection.execute(update, [dict(certificate_metadata(row.certificate), _id=row.id) for row in rows])
+        last_id = rows[-1].id
+
+    # After the backfill, so the indexes are built once
+    op.create_index('ix_certificate_subject_dn', 'certificate', ['subject_dn'], unique=False)
+    op.create_index('ix_certificate_issuer_dn_serial_number', 'certificate', ['issuer_dn', 'serial_number'], unique=False)
+    op.create_index('ix_certificate_not_after', 'certificate', ['not_after'], unique=False)
+    op.create_index('ix_certificate_key_algorithm', 'certificate', ['key_algorithm'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_certificate_key_algorithm', table_name='certificate')
+    op.drop_index('ix_certificate_not_after', table_name='certificate')
+    op.drop_index('ix_certificate_issuer_dn_serial_number', table_name='certificate')
+    op.drop_index('ix_certificate_subject_dn', table_name='certificate')
+    for column in reversed(METADATA_COLUMNS):
+        op.drop_column('certificate', column)
@@ -0,0 +1,23 @@
+"""per-CA key types
+
+Revision ID: d41a7c5e9b20
+Revises: 9c3e52d0a8f1
+Create Date: 2026-10-18 13:41:19.002734
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'd41a7c5e9b20'
+down_revision = '9c3e52d0a8f1'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('certificate_authority', sa.Column('key_type', sa.String(length=32), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('certificate_authority') as batch_op:
+        batch_op.drop_column('key_type')
@@ -0,0 +1,24 @@
+"""change journal index by time
+
+Revision ID: d7a3f9c2e615
+Revises: c2e8a4b61f07
+Create Date: 2026-10-20 09:41:18.552907
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'd7a3f9c2e615'
+down_revision = 'c2e8a4b61f07'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_index('ix_change_journal_vpn_server_id_changed_at', 'change_journal', ['vpn_server_id', 'changed_at'])
+    op.create_index('ix_change_journal_changed_at', 'change_journal', ['changed_at'])
+
+
+def downgrade():
+    op.drop_index('ix_change_journal_changed_at', table_name='change_journal')
+    op.drop_index('ix_change_journal_vpn_server_id_changed_at', table_name='change_journal')
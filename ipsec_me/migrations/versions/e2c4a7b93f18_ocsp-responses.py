@@ -0,0 +1,40 @@
+"""pre-signed OCSP responses
+
+Revision ID: e2c4a7b93f18
+Revises: 3a6d8e1f5c92
+Create Date: 2026-10-18 17:55:40.284117
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e2c4a7b93f18'
+down_revision = '3a6d8e1f5c92'
+
+from alembic import op
+import sqlalchemy as sa
+from ipsec_me.models.utils import GUID
+
+
+def upgrade():
+    op.create_table('ocsp_response',
+    sa.Column('id', GUID(), nullable=False),
+    sa.Column('ca_id', GUID(), nullable=False),
+    sa.Column('certificate_id', GUID(), nullable=False),
+    sa.Column('serial_number', sa.BigInteger(), nullable=False),
+    sa.Column('response', sa.LargeBinary(), nullable=False),
+    sa.Column('this_update', sa.DateTime(), nullable=False),
+    sa.Column('next_update', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['ca_id'], ['certificate_authority.id'], ),
+    sa.ForeignKeyConstraint(['certificate_id'], ['certificate.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_ocsp_response_ca_id_serial_number', 'ocsp_response', ['ca_id', 'serial_number'], unique=True)
+    op.create_index('ix_ocsp_response_certificate_id', 'ocsp_response', ['certificate_id'], unique=False)
+    op.create_index('ix_ocsp_response_next_update', 'ocsp_response', ['next_update'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_ocsp_response_next_update', table_name='ocsp_response')
+    op.drop_index('ix_ocsp_response_certificate_id', table_name='ocsp_response')
+    op.drop_index('ix_ocsp_response_ca_id_serial_number', table_name='ocsp_response')
+    op.drop_table('ocsp_response')
@@ -0,0 +1,45 @@
+"""intermediate CAs and CA selection
+
+Revision ID: f3b8d2a61c07
+Revises: c5a9e3d71b40
+Create Date: 2026-10-18 21:07:44.518302
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'f3b8d2a61c07'
+down_revision = 'c5a9e3d71b40'
+
+from alembic import op
+import sqlalchemy as sa
+from ipsec_me.models.utils import GUID
+
+caselection = sa.Enum('FIRST', 'ROUND_ROBIN', 'LEAST_ISSUED', 'DEVICE_TYPE', name='caselection')
+
+def _batch_ca():
+    # SQLite copies the table, without this the implicit CHECK of issuing outlives the column
+    return op.batch_alter_table('certificate_authority',
+        reflect_args=[sa.Column('issuing', sa.Boolean(create_constraint=False), server_default=sa.true())])
+
+
+def upgrade():
+    op.add_column('certificate_authority', sa.Column('parent_id', GUID(), nullable=True))
+    op.add_column('certificate_authority', sa.Column('issuing', sa.Boolean(), server_default=sa.true(), nullable=True))
+    op.add_column('certificate_authority', sa.Column('device_types', sa.String(length=255), nullable=True))
+    with _batch_ca() as batch_op:
+        batch_op.create_foreign_key('fk_certificate_authority_parent_id', 'certificate_authority', ['parent_id'], ['id'])
+
+    caselection.create(op.get_bind(), checkfirst=True)
+    op.add_column('vpn_server', sa.Column('ca_selection', caselection, server_default='FIRST', nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('vpn_server') as batch_op:
+        batch_op.drop_column('ca_selection')
+    caselection.drop(op.get_bind(), checkfirst=True)
+
+    with _batch_ca() as batch_op:
+        batch_op.drop_constraint('fk_certificate_authority_parent_id', type_='foreignkey')
+        batch_op.drop_column('device_types')
+        batch_op.drop_column('issuing')
+        batch_op.drop_column('parent_id')
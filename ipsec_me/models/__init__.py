@@ -8,16 +8,32 @@ from flask_diamond.mixins.crud import CRUDMixin
 from flask_diamond.facets.database import db
 
 from sqlalchemy.ext.declarative import declared_attr
+from sqlalchemy.orm import joinedload
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy import event
 
 from passlib import pwd
 from flask import current_app
 from uuid import uuid4
+from datetime import datetime, timedelta
 from string import ascii_lowercase, digits
 
 from enum import Enum
+from collections import namedtuple, defaultdict
+from itertools import count
 
 from .certificate import Certificate, CertificateStatus, CERTIFICATE_SETTINGS_CA, CERTIFICATE_SETTINGS_IPSEC_SERVER, CERTIFICATE_SETTINGS_IPSEC_DEVICE
+from .keys import default_key_type, select_key_type, KEY_TYPE_EC_P256, KEY_TYPE_EC_P384, KEY_TYPE_ED25519
+from .keypool import PooledKey
+from .provisioning import ProvisioningJob, JobStatus
+from .serial import serial_number_allocator
+from .revocation import RevokedCertificate, PublishedCRL, crl_engine, CRL_PATH, DELTA_CRL_PATH
+from .ocsp import OCSPResponse
+from .journal import ChangeJournal
+from .chain import chain_bundle
 from .utils import GUID
+from ..registry import device_registry
+from ..admission import issuance_limiter
 
 ca_vpn_table = db.Table('ca_vpn_table',
     db.Column('vpn_server_id', GUID, db.ForeignKey('vpn_server.id')),
@@ -28,12 +44,19 @@ class SerialNumberMixin(object):
     next_serial_number = db.Column('next_serial_number', db.Integer, default=1, server_default='1')
 
     def get_next_serial_number(self):
+        lease_size = current_app.config['SERIAL_NUMBER_LEASE_SIZE']
+        if lease_size > 1:
+            return serial_number_allocator.allocate(self, lease_size)
+        return self.get_next_serial_numbers(1)[0]
+
+    def get_next_serial_numbers(self, count):
+        "Reserve count consecutive serial numbers with one locked update"
         ca = db.session.query(self.__class__).with_lockmode('update').filter_by(id=self.id).one()
         serial_number = ca.next_serial_number
-        ca.next_serial_number += 1
+        ca.next_serial_number += count
         db.session.flush()
         db.session.expire(self)
-        return serial_number
+        return range(serial_number, serial_number + count)
 
 
 class CertificateAuthority(db.Model, CRUDMixin, SerialNumberMixin):
@@ -42,9 +65,31 @@ class CertificateAuthority(db.Model, CRUDMixin, SerialNumberMixin):
     rdn = db.Column(db.String())
     base_dn = db.Column(db.String())
 
+    ## Key type of the CA itself and default for the certificates it issues, None for the application default
+    key_type = db.Column(db.String(32))
+
+    ## The CA that signed the certificate of this intermediate CA, None for self-signed CAs
+    parent_id = db.Column('parent_id', GUID, db.ForeignKey('certificate_authority.id'))
+    parent = db.relationship('CertificateAuthority', remote_side=[id], backref='intermediates')
+
+    ## Whether new certificates are signed with this CA. Roots of intermediate CAs and
+    ## retired CAs don't issue, but stay trusted until all their certificates are gone.
+    issuing = db.Column(db.Boolean, default=True, server_default=db.true())
+
+    ## Comma separated device types this CA signs for with CASelection.DEVICE_TYPE, empty for all others
+    device_types = db.Column(db.String(255))
+
     certificate_id = db.Column('certificate_id', GUID, db.ForeignKey('certificate.id'))
     certificate = db.relationship('Certificate')
 
+    ## Incremented with every revocation, numbers the RevokedCertificate entries, see models.revocation
+    crl_number = db.Column(db.Integer, default=0, server_default='0')
+    ## Last revocation and time of the current full CRL, delta CRLs list the revocations since
+    crl_base_number = db.Column(db.Integer)
+    crl_base_at = db.Column(db.DateTime)
+    ## Number of the last CRL signed, full and delta CRLs share the sequence
+    last_crl_number = db.Column(db.Integer, default=0, server_default='0')
+
     VPNs = db.relationship(
         "VPNServer",
         secondary=ca_vpn_table,
@@ -57,12 +102,48 @@ class CertificateAuthority(db.Model, CRUDMixin, SerialNumberMixin):
         else:
             return self.rdn
 
-    def __init__(self, rdn, base_dn="", settings=CERTIFICATE_SETTINGS_CA):
+    def __init__(self, rdn, base_dn="", settings=CERTIFICATE_SETTINGS_CA, key_type=None, parent=None, path_length=0, issuing=True, device_types=()):
         self.rdn = rdn
         self.base_dn = base_dn
-        self.certificate = Certificate.create(DN=self.DN, settings=settings)
+        self.key_type = key_type
+        self.issuing = issuing
+        self.device_types = ",".join(device_types)
+        if parent is None:
+            self.certificate = Certificate.create(DN=self.DN, settings=settings, key_type=key_type,
+                path_length=path_length)
+        else:
+            self.parent = parent
+            self.certificate = parent.create_child(settings, DN=self.DN, key_type=key_type,
+                extras={'path_length': path_length})
+
+    @classmethod
+    def create(cls, _commit=True, **kwargs):
+        "Create a CA and publish its first CRLs"
+        ca = super(CertificateAuthority, cls).create(_commit=_commit, **kwargs)
+        if _commit:
+            crl_engine.refresh(ca)
+        return ca
+
+    def signs_for(self, device_type):
+        "Whether this CA is dedicated to device_type, see CASelection.DEVICE_TYPE"
+        return device_type in (self.device_types or "").split(",")
+
+    def chain(self):
+        "This CA and its parents up to the root"
+        ca = self
+        while ca is not None:
+            yield ca
+            ca = ca.parent
+
+    def chain_bundle(self):
+        "The certificates of chain(), cached per process, see models.chain"
+        return chain_bundle(self)
 
-    def create_child(self, settings, DN=None, rdn=None, extras={}):
+    @property
+    def child_key_type(self):
+        return self.key_type or default_key_type()
+
+    def child_DN(self, DN=None, rdn=None, extras={}):
         if rdn is None:
             if 'host_names' in extras:
                 rdn = "CN={0}".format(extras['host_names'][0])
@@ -78,14 +159,126 @@ class CertificateAuthority(db.Model, CRUDMixin, SerialNumberMixin):
                 else:
                     DN = rdn
 
-        extras['serial_number'] = self.get_next_serial_number()
+        return DN
+
+    def create_child(self, settings, DN=None, rdn=None, extras={}, key_type=None, _commit=True):
+        DN = self.child_DN(DN=DN, rdn=rdn, extras=extras)
+
+        extras = dict(extras)
+        extras.setdefault('crl_urls', self.crl_urls())
+
+        # Before the serial number lease, which may lock the CA row, see Certificate.__init__
+        with issuance_limiter.permit():
+            extras['serial_number'] = self.get_next_serial_number()
+            return Certificate.create(_commit=_commit, DN=DN, settings=settings, sign_ca=self.certificate,
+                key_type=key_type or self.child_key_type, **extras)
+
+    def create_children(self, specs, _commit=True):
+        """Issue many certificates at once.
+
+        specs is a list of dictionaries with the keyword arguments of
+        :meth:`create_child`. The CA key is loaded once, all serial numbers are
+        reserved with a single locked update and all certificates are stored in
+        one transaction.
+        """
+        specs = list(specs)
+        signer = self.certificate.signer()
+        crl_urls = self.crl_urls()
+
+        children = []
+        with issuance_limiter.permit():
+            serial_numbers = self.get_next_serial_numbers(len(specs))
+            for spec, serial_number in zip(specs, serial_numbers):
+                extras = dict(spec.get('extras', {}))
+                DN = self.child_DN(DN=spec.get('DN'), rdn=spec.get('rdn'), extras=extras)
+                extras['serial_number'] = serial_number
+                extras.setdefault('crl_urls', crl_urls)
+                children.append(Certificate(DN=DN, settings=spec['settings'], sign_ca=signer,
+                    key_type=spec.get('key_type') or self.child_key_type, **extras))
+
+        db.session.add_all(children)
+        if _commit:
+            db.session.commit()
+        return children
 
-        return Certificate.create(DN=DN, settings=settings, sign_ca=self.certificate, **extras)
+    @classmethod
+    def signing_keys(cls):
+        "CA certificate fingerprint -> DER private key of all CAs, for the signing daemon"
+        return dict(db.session.query(Certificate.fingerprint, Certificate.private_key)
+            .join(cls, cls.certificate_id == Certificate.id))
+
+    def _locked(self):
+        return db.session.query(self.__class__).with_lockmode('update').populate_existing().filter_by(id=self.id).one()
+
+    def crl_urls(self, path=CRL_PATH):
+        "URLs of the CRLs of this CA, empty unless CRL_BASE_URL is configured"
+        base_url = current_app.config['CRL_BASE_URL']
+        if not base_url:
+            return []
+        return [base_url.rstrip('/') + path.format(self.id)]
+
+    def certificates(self):
+        "Query for the certificates of the VPN servers and devices using this CA, the candidates for having been issued by it"
+        vpn_server_ids = db.session.query(ca_vpn_table.c.vpn_server_id) \
+            .filter(ca_vpn_table.c.certificate_authority_id == self.id)
+        device_certificates = db.session.query(GenericUserCertificateDevice.certificate_id) \
+            .join(VPNUser, GenericUserCertificateDevice.vpn_user_id == VPNUser.id) \
+            .filter(VPNUser.vpn_server_id.in_(vpn_server_ids))
+        server_certificates = db.session.query(VPNServer.certificate_id) \
+            .filter(VPNServer.id.in_(vpn_server_ids))
+        return Certificate.query.filter(Certificate.id.in_(device_certificates.union(server_certificates)))
+
+    def issued(self, certificate):
+        if certificate.issuer_dn is not None and self.certificate.subject_dn is not None:
+            return certificate.issuer_dn == self.certificate.subject_dn
+        return certificate._certificate.issuer == self.certificate._certificate.subject
+
+    def revoke(self, certificate, reason=None, _commit=True):
+        "Revoke a certificate issued by this CA, reason is an x509.ReasonFlags"
+        if not self.issued(certificate):
+            raise ValueError("{0} was not issued by {1}".format(certificate, self))
+
+        serial_number = certificate._certificate.serial_number
+        entry = RevokedCertificate.query.filter_by(ca_id=self.id, serial_number=serial_number).first()
+        if entry is None:
+            ca = self._locked()
+            # A concurrent revocation of the same certificate may have won the lock
+            entry = RevokedCertificate.query.filter_by(ca_id=self.id, serial_number=serial_number).first()
+        if entry is None:
+            ca.crl_number += 1
+            entry = RevokedCertificate(ca_id=self.id, certificate_id=certificate.id, serial_number=serial_number,
+                reason=reason.value if reason is not None else None, crl_number=ca.crl_number)
+            db.session.add(entry)
+            crl_engine.publish(ca)
+            current_app.logger.info("Revoked certificate {0} of {1}".format(serial_number, self))
+
+        certificate.status = CertificateStatus.REVOKED
+        if _commit:
+            db.session.commit()
+        return entry
+
+    def get_crl(self):
+        return crl_engine.full_crl(self)
+
+    def get_delta_crl(self):
+        return crl_engine.delta_crl(self)
 
 class UserType(Enum):
     USER = "user"
     ADMIN = "admin"
 
+class CASelection(Enum):
+    "How a VPN server chooses among its issuing CAs, see VPNServer.get_signing_ca()"
+    FIRST = "first"
+    ROUND_ROBIN = "round_robin"
+    ## The CA with the lowest serial number counter
+    LEAST_ISSUED = "least_issued"
+    ## Round robin among the CAs dedicated to the device type, or among the others
+    DEVICE_TYPE = "device_type"
+
+## Round robin position of each VPN server, per process
+_ca_rotation = defaultdict(count)
+
 DEFAULT_CONFIGURATION = """
 leftsubnet=0.0.0.0/0
 rightsourceip=%dhcp
@@ -114,10 +307,16 @@ class VPNServer(db.Model, CRUDMixin):
         secondary=ca_vpn_table,
         back_populates="VPNs")
 
-    def __init__(self, name, external_hostname, base_dns_name=None, psk=Ellipsis, certificate=Ellipsis, configuration=DEFAULT_CONFIGURATION, CAs=None, CA_params={}, certificate_params={}):
+    ca_selection = db.Column(db.Enum(CASelection), default=CASelection.FIRST)
+
+    ## Set on every change, e.g. to tell cached provisioning payloads apart in all processes
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __init__(self, name, external_hostname, base_dns_name=None, psk=Ellipsis, certificate=Ellipsis, configuration=DEFAULT_CONFIGURATION, CAs=None, CA_params={}, certificate_params={}, intermediate_CAs=0, ca_selection=None):
         self.name = name
         self.external_hostname = external_hostname
         self.configuration = configuration
+        self.ca_selection = ca_selection or (CASelection.ROUND_ROBIN if intermediate_CAs else CASelection.FIRST)
 
         if base_dns_name is None:
             if '.' in self.external_hostname:
@@ -132,7 +331,16 @@ class VPNServer(db.Model, CRUDMixin):
         else:
             self.psk = psk
         
-        if CAs is None:
+        if CAs is None and intermediate_CAs:
+            CA_params = dict(CA_params)
+            CA_params.setdefault("rdn", "CN=VPN Root CA")
+            root = CertificateAuthority.create(path_length=1, issuing=False, **CA_params)
+            self.CAs.append(root)
+            for number in range(1, intermediate_CAs + 1):
+                ca = CertificateAuthority.create(rdn="CN=VPN CA {0}".format(number),
+                    base_dn=root.base_dn, key_type=root.key_type, parent=root)
+                self.CAs.append(ca)
+        elif CAs is None:
             CA_params = dict(CA_params)
             CA_params.setdefault("rdn", "CN={0}".format("VPN CA 1"))
             ca = CertificateAuthority.create(**CA_params)
@@ -146,15 +354,14 @@ class VPNServer(db.Model, CRUDMixin):
                 certificate_params.setdefault('settings', CERTIFICATE_SETTINGS_IPSEC_SERVER)
                 certificate_params.setdefault('extras', {
                 }).setdefault('host_names', [self.external_hostname])
-                self.certificate = self.CAs[0].create_child(**certificate_params)
+                self.certificate = self.get_signing_ca().create_child(**certificate_params)
         else:
             self.certificate = certificate
 
     def find_user(self, user):
-        for vu in self.users:
-            if vu.user == user:
-                return vu
-        return None
+        if user is None:
+            return None
+        return self.users.filter_by(user_id=user.id).first()
 
     def add_user(self, user, user_type=UserType.USER):
         vu = self.find_user(user)
@@ -166,17 +373,88 @@ class VPNServer(db.Model, CRUDMixin):
 
             return vu
 
-        vu = VPNUser.create(vpn_server=self, user_type=user_type, user=user)
-        self.users.append( vu )
+        try:
+            # A savepoint, so that a conflict doesn't throw away the caller's other changes
+            with db.session.begin_nested():
+                vu = VPNUser.create(vpn_server=self, user_type=user_type, user=user, _commit=False)
+        except IntegrityError:
+            # Added concurrently
+            vu = self.find_user(user)
+            if vu.user_type != user_type:
+                vu.set_user_type(user_type)
+        db.session.commit()
         return vu
 
-    def get_signing_ca(self):
-        return self.CAs[0] # FIXME
+    def add_users(self, users, user_type=UserType.USER, _commit=True):
+        "Add many users in one transaction, existing members get user_type"
+        existing = dict((vu.user_id, vu) for vu in self.users.filter(VPNUser.user_id.in_([u.id for u in users])))
+
+        result = []
+        for user in users:
+            vu = existing.get(user.id)
+            if vu is None:
+                vu = existing[user.id] = VPNUser(vpn_server=self, user_type=user_type, user=user)
+                db.session.add(vu)
+            else:
+                vu.user_type = user_type
+            result.append(vu)
+
+        if _commit:
+            db.session.commit()
+        return result
+
+    def signing_CAs(self, device_type=None):
+        "The CAs that may sign a new certificate for device_type, None for the server itself"
+        CAs = [ca for ca in self.CAs if ca.issuing]
+        if self.ca_selection == CASelection.DEVICE_TYPE:
+            dedicated = [ca for ca in CAs if ca.signs_for(device_type)]
+            return dedicated or [ca for ca in CAs if not ca.device_types] or CAs
+        return CAs
+
+    def get_signing_ca(self, device_type=None):
+        "The CA to sign a new certificate with according to ca_selection"
+        CAs = self.signing_CAs(device_type)
+        if not CAs:
+            raise ValueError("{0} has no issuing CA".format(self))
+        if self.ca_selection == CASelection.LEAST_ISSUED:
+            return min(CAs, key=lambda ca: ca.next_serial_number or 0)
+        if self.ca_selection in (CASelection.ROUND_ROBIN, CASelection.DEVICE_TYPE):
+            CAs.sort(key=lambda ca: str(ca.id))
+            return CAs[next(_ca_rotation[self.id]) % len(CAs)]
+        return CAs[0]
+
+    def issuing_ca(self, certificate):
+        "The CA of this server that issued certificate, or None"
+        for ca in self.trusted_CAs():
+            if ca.issued(certificate):
+                return ca
+        return None
+
+    def chain_bundle(self):
+        "The chain of the server certificate, clients need its root to authenticate the server. None if no CA of this server issued it."
+        ca = self.issuing_ca(self.certificate)
+        return ca.chain_bundle() if ca is not None else None
+
+    def trusted_CAs(self):
+        "All CAs of this server and their parents, for the trust store of the gateway"
+        result = []
+        for ca in self.CAs:
+            for link in ca.chain():
+                if link not in result:
+                    result.append(link)
+        return result
+
 
 ## FIXME Uniqueness-Constraints in all classes
 
+## Enough of a device to list and link it, see VPNUser.dashboard()
+DeviceSummary = namedtuple('DeviceSummary', ['id', 'name', 'device_type'])
+
 class VPNUser(db.Model, CRUDMixin):
     __tablename__ = 'vpn_user'
+    __table_args__ = (
+        db.Index('ix_vpn_user_vpn_server_id_user_id', 'vpn_server_id', 'user_id', unique=True),
+    )
     id = db.Column(GUID, primary_key=True, default=uuid4)
 
     vpn_server_id = db.Column('vpn_server_id', GUID, db.ForeignKey('vpn_server.id'))
@@ -187,20 +465,43 @@ class VPNUser(db.Model, CRUDMixin):
     user_id = db.Column('user_id', db.Integer, db.ForeignKey('user.id'))
     user = db.relationship('User', backref=db.backref('vpns', lazy='dynamic'))
 
+    @classmethod
+    def dashboard(cls, user):
+        """The VPN memberships of user with their servers and device summaries, in two queries.
+
+        Returns a list of (VPNUser, [DeviceSummary, ...]) ordered by server name.
+        """
+        vpn_users = cls.query \
+            .filter_by(user_id=user.id) \
+            .join(cls.vpn_server) \
+            .options(joinedload(cls.vpn_server)) \
+            .order_by(VPNServer.name) \
+            .all()
+
+        devices = dict((vu.id, []) for vu in vpn_users)
+        if devices:
+            rows = db.session.query(DeviceBase.id, DeviceBase.name, DeviceBase.device_type, DeviceBase.vpn_user_id) \
+                .filter(DeviceBase.vpn_user_id.in_(list(devices))) \
+                .order_by(DeviceBase.name)
+            for row in rows:
+                devices[row.vpn_user_id].append(DeviceSummary(row.id, row.name, row.device_type))
+
+        return [(vu, devices[vu.id]) for vu in vpn_users]
+
     def set_user_type(self, user_type):
         self.user_type = user_type
         current_app.logger.debug("Changing {0} to type {1} in {2}".format(self.user, user_type, self.vpn_server))
         self.save()
 
-    def add_device(self, device_type, **params):
+    def add_device(self, device_type, _commit=True, **params):
         if issubclass(device_type.__class__, type) and issubclass(device_type, DeviceBase):
             device_class = device_type
         else:
             device_class = DeviceBase.class_from_type(device_type)
 
-        d = device_class.create(vpn_user=self, **params)
+        d = device_class.create(_commit=_commit, vpn_user=self, **params)
         current_app.logger.debug("Added {0} to {1}".format(d, self))
-        self.save()
+        self.save(_commit)
 
         return d
 
@@ -208,6 +509,9 @@ class DeviceBase(db.Model, CRUDMixin):
     __tablename__ = 'device'
     DEVICE_TYPE = None
 
+    ## Key types the device can use, in order of preference, see models.keys. None means any.
+    KEY_TYPES = None
+
     id = db.Column(GUID, primary_key=True, default=uuid4)
     name = db.Column(db.String(255))
     device_type = db.Column(db.String())
@@ -230,10 +534,12 @@ class DeviceBase(db.Model, CRUDMixin):
 
     @classmethod
     def class_from_type(cls, device_type):
-        for subcls in cls.all_subclasses():
-            if subcls.DEVICE_TYPE == device_type:
-                return subcls
-        return None
+        return device_registry.device_class(device_type)
+
+    @classmethod
+    def choose_key_type(cls, CA):
+        "Key type for a new certificate of this device class: the CA's default if supported"
+        return select_key_type(CA.child_key_type, cls.KEY_TYPES)
 
     @staticmethod
     def nameify(name):
@@ -269,25 +575,58 @@ class GenericPskXauthDevice(DeviceBase):
 class GenericUserCertificateDevice(DeviceBase):
     "Generic (User Certificate)"
     DEVICE_TYPE = "generic_user_certificate"
+    KEY_TYPES = ("rsa", KEY_TYPE_EC_P256, KEY_TYPE_EC_P384)
 
     certificate_id = db.Column('certificate_id', GUID, db.ForeignKey('certificate.id'))
     certificate = db.relationship('Certificate')
 
     def __init__(self, certificate=None, **kwargs):
+        if certificate is None:
+            # Before the device is autoflushed, so that nothing is written while waiting for it
+            with issuance_limiter.permit():
+                self._init(certificate, kwargs)
+        else:
+            self._init(certificate, kwargs)
+
+    def _init(self, certificate, kwargs):
         super(GenericUserCertificateDevice, self).__init__(**kwargs)
 
-        CA = kwargs['vpn_user'].vpn_server.get_signing_ca()
+        CA = kwargs['vpn_user'].vpn_server.get_signing_ca(device_type=self.DEVICE_TYPE)
 
         if certificate is None:
             certificate_params = dict()
             certificate_params.setdefault('DN', 'CN={0}'.format(kwargs['vpn_user'].user.email))
             certificate_params.setdefault('settings', CERTIFICATE_SETTINGS_IPSEC_DEVICE)
+            certificate_params.setdefault('key_type', self.choose_key_type(CA))
             certificate_params.setdefault('extras', {
             }).setdefault('user_emails', [kwargs['vpn_user'].user.email])
-            self.certificate = CA.create_child(**certificate_params)
+            # Stored along with the device, by whoever saves it
+            self.certificate = CA.create_child(_commit=False, **certificate_params)
         else:
             self.certificate = certificate
 
+    def issuing_ca(self):
+        CA = self.vpn_user.vpn_server.issuing_ca(self.certificate)
+        if CA is None:
+            raise ValueError("No CA of {0} issued the certificate of {1}".format(self.vpn_user.vpn_server, self))
+        return CA
+
+    def chain_bundle(self):
+        "The chain of the device certificate, for the provisioning payloads"
+        return self.issuing_ca().chain_bundle()
+
+    def revoke(self, reason=None):
+        "Revoke the device certificate with the CA of the VPN that issued it"
+        return self.issuing_ca().revoke(self.certificate, reason=reason)
+
+    @classmethod
+    def find_by_fingerprint(cls, id, fingerprint):
+        "Look up a device by id and the fingerprint of its certificate, with one indexed query"
+        return cls.query.join(cls.certificate) \
+            .options(db.contains_eager(cls.certificate)) \
+            .filter(cls.id == id, Certificate.fingerprint == fingerprint) \
+            .first()
+
 class AndroidNativeDevice(GenericPskXauthDevice):
     "Android (4.4+, native client)"
     DEVICE_TYPE = "android_native"
@@ -300,6 +639,16 @@ class Ios10Device(GenericUserCertificateDevice):
     "iOS 10+, OS X 10.11+"
     DEVICE_TYPE = "ios_10"
 
+    ## Values for CertificateType in the IKEv2 configuration profile
+    CERTIFICATE_TYPES = {
+        KEY_TYPE_EC_P256: "ECDSA256",
+        KEY_TYPE_EC_P384: "ECDSA384",
+    }
+
+    @property
+    def certificate_type(self):
+        return self.CERTIFICATE_TYPES.get(self.certificate.key_type, "RSA")
+
 class Win10Device(GenericUserCertificateDevice):
     "Windows 10+"
     DEVICE_TYPE = "win_10"
@@ -307,6 +656,7 @@ class Win10Device(GenericUserCertificateDevice):
 class GenericLinuxDevice(GenericUserCertificateDevice):
     "Linux (generic)"
     DEVICE_TYPE = "linux"
+    KEY_TYPES = ("rsa", KEY_TYPE_EC_P256, KEY_TYPE_EC_P384, KEY_TYPE_ED25519)
 
 class LinuxDebDevice(GenericLinuxDevice):
     "Linux .deb based (Ubuntu, Debian, Mate)"
@@ -316,3 +666,24 @@ class LinuxRpmDevice(GenericLinuxDevice):
     "Linux .rpm based (Fedora, RedHat, CentOS)"
     DEVICE_TYPE = "linux_rpm"
 
+for device_class in DeviceBase.all_subclasses():
+    if device_class.DEVICE_TYPE is not None:
+        device_registry.register(device_class)
+
+def _device_changed(mapper, connection, target):
+    if target.vpn_user_id is not None:
+        vpn_server_id = db.select([VPNUser.__table__.c.vpn_server_id]) \
+            .where(VPNUser.__table__.c.id == target.vpn_user_id).as_scalar()
+        ChangeJournal.record(connection, vpn_server_id, target.id)
+
+for event_name in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(DeviceBase, event_name, _device_changed, propagate=True)
+
+@event.listens_for(VPNServer, 'before_update')
+def _vpn_server_updating(mapper, connection, target):
+    # Also called when only the CAs changed
+    target.updated_at = datetime.utcnow()
+
+@event.listens_for(VPNServer, 'after_update')
+def _vpn_server_changed(mapper, connection, target):
+    ChangeJournal.record(connection, target.id)
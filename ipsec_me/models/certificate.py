@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
 # ipsec-me (c) Henryk Plötz
 
-from ldap3.utils.dn import parse_dn
+## ldap3, pyOpenSSL and pyasn1 are imported where they are used, they are slow to
+## import and most manage.py commands never need them
 
 from flask_diamond.mixins.crud import CRUDMixin
 from flask_diamond.facets.database import db
@@ -13,7 +14,6 @@ from enum import Enum
 from datetime import datetime, timedelta
 from subprocess import run, PIPE
 from hashlib import sha256
-from OpenSSL import crypto as crypto_openssl
 
 from cryptography import x509
 from cryptography.x509.oid import ObjectIdentifier, NameOID, ExtendedKeyUsageOID
@@ -21,13 +21,20 @@ from cryptography.hazmat.primitives import hashes
 
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import rsa, ed25519
 
-from pyasn1_modules import rfc2459
-from pyasn1.codec.der import decoder
+from sqlalchemy import event
 
 from uuid import uuid4
+import logging
 from .utils import GUID
+from ..cache import LRUCache
+from ..metrics import timed
+from ..signing import RemoteSigner
+from ..admission import issuance_limiter
+from .keypool import PooledKey
+from .revocation import crl_distribution_points
+from .keys import rsa_key_type, default_key_type, key_type_of, generate_private_key, serialize_private_key, load_private_key, signature_hash, private_key_format
 
 X509_NAME_MAP = {
     'CN': NameOID.COMMON_NAME,
@@ -40,25 +47,39 @@ _CERTIFICATE_SETTINGS_SELFSIGN = lambda b, **extras: \
     b.issuer_name(extras['subject']) \
     .serial_number(x509.random_serial_number())
 
-CERTIFICATE_SETTINGS_CA = lambda b, **extras: \
+def _ipsec_key_usage(key):
+    # Key encipherment only works with RSA keys, Ed25519 keys can only sign
+    return x509.KeyUsage(digital_signature=True, content_commitment=False,
+        key_encipherment=isinstance(key, rsa.RSAPrivateKey), data_encipherment=False,
+        key_agreement=not isinstance(key, ed25519.Ed25519PrivateKey),
+        key_cert_sign=False, crl_sign=False, encipher_only=False, decipher_only=False)
+
+def _add_crl_distribution_points(b, urls):
+    if not urls:
+        return b
+    return b.add_extension(crl_distribution_points(urls), critical=False)
+
+## path_length 0 for CAs signing only end entity certificates, 1 for roots of intermediate CAs
+CERTIFICATE_SETTINGS_CA = lambda b, **extras: _add_crl_distribution_points(
     b.subject_name(extras['subject']) \
     .public_key(extras['key'].public_key()) \
     .not_valid_before(datetime.utcnow()).not_valid_after( datetime.utcnow() + timedelta(**extras.get('lifetime', {'days': 20*365})) ) \
-    .add_extension(x509.BasicConstraints(ca=True, path_length=0), critical=True)
+    .add_extension(x509.BasicConstraints(ca=True, path_length=extras.get('path_length', 0)), critical=True),
+    extras.get('crl_urls'))
 
-_CERTIFICATE_SETTINGS_IPSEC_COMMON = lambda b, **extras: \
+_CERTIFICATE_SETTINGS_IPSEC_COMMON = lambda b, **extras: _add_crl_distribution_points(
     b.subject_name(extras['subject']) \
     .public_key(extras['key'].public_key()) \
     .not_valid_before(datetime.utcnow()) \
     .not_valid_after( extras.get('not_valid_after', datetime.utcnow() + timedelta(**extras.get('lifetime', {'days': 15*365})) ) ) \
     .add_extension(x509.BasicConstraints(ca=False, path_length=None), critical=True) \
-    .add_extension(x509.KeyUsage(digital_signature=True, content_commitment=False, key_encipherment=True, data_encipherment=False,
-        key_agreement=True, key_cert_sign=False, crl_sign=False, encipher_only=False, decipher_only=False), critical=False) \
+    .add_extension(_ipsec_key_usage(extras['key']), critical=False) \
     .add_extension(
         x509.SubjectAlternativeName(
             [x509.DNSName(name) for name in extras.get('host_names', [])] 
             + [x509.RFC822Name(name) for name in extras.get('user_emails', [])]
-        ), critical=False)
+        ), critical=False),
+    extras.get('crl_urls'))
 
 CERTIFICATE_SETTINGS_IPSEC_SERVER = lambda b, **extras: \
     _CERTIFICATE_SETTINGS_IPSEC_COMMON(b, **extras) \
@@ -68,6 +89,59 @@ CERTIFICATE_SETTINGS_IPSEC_DEVICE = lambda b, **extras: \
     _CERTIFICATE_SETTINGS_IPSEC_COMMON(b, **extras) \
     .add_extension(x509.ExtendedKeyUsage([ExtendedKeyUsageOID.CLIENT_AUTH, ObjectIdentifier("1.3.6.1.5.5.8.2.2")]), critical=False) \
 
+## Set to DEBUG to log the full text of every new certificate
+certificate_logger = logging.getLogger('ipsec_me.certificates')
+
+## Process-wide cache of parsed certificates and private keys, keyed by
+## (certificate id, column name, certificate fingerprint)
+parsed_cache = LRUCache()
+
+def serial_hex(serial_number):
+    "Serial number as stored in Certificate.serial_number"
+    return "{0:x}".format(serial_number)
+
+METADATA_COLUMNS = ('subject_dn', 'issuer_dn', 'serial_number', 'not_before', 'not_after', 'key_algorithm')
+
+def certificate_metadata(data):
+    "Values of the metadata columns of Certificate for a DER certificate, or certificate request"
+    try:
+        cert = x509.load_der_x509_certificate(data, backend=default_backend())
+    except ValueError:
+        request = x509.load_der_x509_csr(data, backend=default_backend())
+        return dict(subject_dn=request.subject.rfc4514_string(), issuer_dn=None, serial_number=None,
+            not_before=None, not_after=None, key_algorithm=key_type_of(request.public_key()))
+    return dict(
+        subject_dn=cert.subject.rfc4514_string(),
+        issuer_dn=cert.issuer.rfc4514_string(),
+        serial_number=serial_hex(cert.serial_number),
+        not_before=cert.not_valid_before,
+        not_after=cert.not_valid_after,
+        key_algorithm=key_type_of(cert.public_key()),
+    )
+
+class CertificateSigner(object):
+    "Parsed issuer name and private key of a CA certificate, to sign many certificates without parsing them again"
+
+    def __init__(self, subject, private_key):
+        self.subject = subject
+        self.private_key = private_key
+
+    def sign_certificate(self, cert_builder):
+        return cert_builder.issuer_name(self.subject) \
+            .sign(self.private_key, signature_hash(self.private_key), default_backend())
+
+    def sign_crl(self, crl_builder):
+        return crl_builder.sign(self.private_key, signature_hash(self.private_key), default_backend())
+
+class LazyText(object):
+    "Defers rendering of a text, e.g. until a log record is actually emitted"
+
+    def __init__(self, render):
+        self.render = render
+
+    def __str__(self):
+        return self.render()
+
 class CertificateStatus(Enum):
     REQUEST = "request"
     ACTIVE = "active"
@@ -75,28 +149,54 @@ class CertificateStatus(Enum):
 
 class Certificate(db.Model, CRUDMixin):
     __tablename__ = "certificate"
+    __table_args__ = (
+        db.Index('ix_certificate_issuer_dn_serial_number', 'issuer_dn', 'serial_number'),
+    )
     id = db.Column(GUID, primary_key=True, default=uuid4)
 
-    certificate = db.Column(db.LargeBinary())
-    private_key = db.Column(db.LargeBinary())
+    certificate = db.deferred(db.Column(db.LargeBinary()))
+    private_key = db.deferred(db.Column(db.LargeBinary()))
+
+    ## SHA-256 of the DER certificate, maintained whenever certificate is set
+    fingerprint = db.Column(db.String(64), index=True)
 
     status = db.Column('status', db.Enum(CertificateStatus), default=CertificateStatus.ACTIVE)
 
-    def __init__(self, DN, settings, keysize=None, sign_ca=Ellipsis, **kwargs):
-        if keysize is None:
-            keysize = current_app.config['RSA_KEYSIZE']
-
-        key = rsa.generate_private_key(
-            public_exponent=65537,
-            key_size=keysize,
-            backend=default_backend()
-        )
-        self.private_key = key.private_bytes(
-            encoding=serialization.Encoding.DER,
-            format=serialization.PrivateFormat.TraditionalOpenSSL,
-            encryption_algorithm=serialization.NoEncryption(),
-        )
+    ## Copied from the certificate whenever it is set, to query without parsing blobs.
+    ## DNs in RFC 4514 form, serial_number in lower case hex, see serial_hex()
+    subject_dn = db.Column(db.String(255), index=True)
+    issuer_dn = db.Column(db.String(255))
+    serial_number = db.Column(db.String(40))
+    not_before = db.Column(db.DateTime)
+    not_after = db.Column(db.DateTime, index=True)
+    key_algorithm = db.Column(db.String(32), index=True)
+
+    def __init__(self, DN, settings, keysize=None, key_type=None, sign_ca=Ellipsis, **kwargs):
+        if key_type is None:
+            if keysize is None:
+                key_type = default_key_type()
+            else:
+                key_type = rsa_key_type(keysize)
+
+        # Held from the key generation to the signature, raises Overloaded when too many requests wait.
+        # Taken before the pool key is: nothing is written or locked while a request waits for it.
+        with issuance_limiter.permit():
+            pooled_key = PooledKey.take(key_type)
+            self._create(DN, settings, key_type, pooled_key, sign_ca, kwargs)
+
+        current_app.logger.debug("Created certificate {0} for {1}".format(self.fingerprint, DN))
+        certificate_logger.debug("%s", LazyText(self.prettyPrint))
+
+    def _create(self, DN, settings, key_type, pooled_key, sign_ca, kwargs):
+        if pooled_key is not None:
+            key = load_private_key(pooled_key)
+            self.private_key = pooled_key
+        else:
+            current_app.logger.debug("Key pool for {0} is empty, generating key inline".format(key_type))
+            key = generate_private_key(key_type)
+            self.private_key = serialize_private_key(key)
 
+        from ldap3.utils.dn import parse_dn
         name_parts = parse_dn(DN)
         subject = x509.Name([
             x509.NameAttribute(X509_NAME_MAP[e[0]], e[1])
@@ -106,61 +206,128 @@ class Certificate(db.Model, CRUDMixin):
         extras = dict(kwargs)
         if sign_ca is Ellipsis: # Self-Sign
             base = _CERTIFICATE_SETTINGS_SELFSIGN( x509.CertificateBuilder(), subject=subject )
-            sign_cb = lambda a: a.sign(key, hashes.SHA256(), default_backend())
+            sign_cb = lambda a: a.sign(key, signature_hash(key), default_backend())
             status = CertificateStatus.ACTIVE
         elif sign_ca is None: # CSR
             base = x509.CertificateRequestBuilder()
-            sign_cb = lambda a: a.sign(key, hashes.SHA256(), default_backend())
+            sign_cb = lambda a: a.sign(key, signature_hash(key), default_backend())
             status = CertificateStatus.REQUEST
         else:
             base = x509.CertificateBuilder()
             sign_cb = lambda a: sign_ca.sign_certificate(a.serial_number(extras['serial_number']))
             status = CertificateStatus.ACTIVE
 
-        certificate = sign_cb( settings(base, subject=subject, key=key, **extras) )
+        builder = settings(base, subject=subject, key=key, **extras)
+        with timed("sign"):
+            certificate = sign_cb(builder)
         self.certificate = certificate.public_bytes(serialization.Encoding.DER)
 
-        print(self.prettyPrint())
+    def _parsed(self, column, loader):
+        # Keyed by fingerprint so that cache hits don't need to load the deferred blob
+        if self.id is None or self.fingerprint is None:
+            return loader(getattr(self, column))
+
+        key = (self.id, column, self.fingerprint)
+        result = parsed_cache.get(key)
+        if result is None:
+            result = loader(getattr(self, column))
+            parsed_cache.set(key, result)
+        return result
 
     @property
     def _private_key(self):
-        return serialization.load_der_private_key(self.private_key, password=None, backend=default_backend())
+        return self._parsed('private_key', load_private_key)
 
     @property
     def _certificate(self):
-        return x509.load_der_x509_certificate(self.certificate, backend=default_backend())
+        return self._parsed('certificate', lambda data: x509.load_der_x509_certificate(data, backend=default_backend()))
+
+    @property
+    def key_type(self):
+        return key_type_of(self._certificate.public_key())
+
+    def supports_pkcs12(self):
+        # pyOpenSSL can't put Ed25519 keys into PKCS#12 files
+        return not isinstance(self._private_key, ed25519.Ed25519PrivateKey)
+
+    def signer(self, local=False):
+        "Signer with the key of this certificate, held by the signing daemon if SIGNING_SOCKET is configured"
+        path = current_app.config['SIGNING_SOCKET']
+        if path and not local:
+            return RemoteSigner(path, self._certificate.subject, self.fingerprint, timeout=current_app.config['SIGNING_TIMEOUT'])
+        return CertificateSigner(self._certificate.subject, self._private_key)
 
     def sign_certificate(self, cert_builder):
         ## FIXME: Serial number
-        return cert_builder.issuer_name(self._certificate.subject) \
-            .sign(self._private_key, hashes.SHA256(), default_backend())
+        return self.signer().sign_certificate(cert_builder)
 
-    def prettyPrint(self, use_openssl=True):
+    def prettyPrint(self, use_openssl=False):
         if use_openssl:
             result = run(["openssl", "x509", "-noout", "-text", "-inform", "DER"], input=self.certificate, stdout=PIPE)
             return result.stdout.decode("UTF-8")
         else:
+            from pyasn1_modules import rfc2459
+            from pyasn1.codec.der import decoder
             cert = decoder.decode(self.certificate, asn1Spec=rfc2459.Certificate())[0]
             return cert.prettyPrint()
 
-    def get_pkcs12(self, include_chain=True, password=None):
+    @timed("pkcs12")
+    def get_pkcs12(self, include_chain=True, password=None, chain=None):
+        "PKCS#12 file with the key and certificate, include_chain adds the certificates of the ChainBundle chain"
+        from OpenSSL import crypto as crypto_openssl
         pfx = crypto_openssl.PKCS12Type()
-        pfx.set_privatekey(crypto_openssl.PKey.from_cryptography_key(self._private_key))
+        # Load from DER, pyOpenSSL can't convert all cryptography key objects
+        pfx.set_privatekey(crypto_openssl.load_privatekey(crypto_openssl.FILETYPE_ASN1, self.private_key))
         pfx.set_certificate(crypto_openssl.X509.from_cryptography(self._certificate))
-        if include_chain:
-            pfx.set_ca_certificates(None)  ## FIXME Implement
+        if include_chain and chain is not None:
+            self._check_chain(chain)
+            pfx.set_ca_certificates(chain.openssl_certificates())
         return pfx.export(password)
 
-    def get_ca_pem(self):
-        return b'' ## FIXME Implement
+    def get_ca_pem(self, chain):
+        "PEM of the CA certificates of the ChainBundle chain of the issuer, issuer first"
+        self._check_chain(chain)
+        return chain.pem
+
+    def _check_chain(self, chain):
+        if chain.certificates[0].subject != self._certificate.issuer:
+            raise ValueError("{0} was not issued by {1}".format(self.subject_dn, chain.certificates[0].subject.rfc4514_string()))
 
     def get_cert_pem(self):
         return self._certificate.public_bytes(serialization.Encoding.PEM)
 
     def get_key_pem(self, encryption_algorithm=serialization.NoEncryption()):
         return self._private_key.private_bytes(encoding=serialization.Encoding.PEM,
-            format=serialization.PrivateFormat.TraditionalOpenSSL,
+            format=private_key_format(self._private_key),
             encryption_algorithm=encryption_algorithm)
 
+    @classmethod
+    def find_by_serial(cls, serial_number, issuer_dn=None):
+        "Certificates with a serial number, optionally of one issuer"
+        query = cls.query.filter(cls.serial_number == serial_hex(serial_number))
+        if issuer_dn is not None:
+            query = query.filter(cls.issuer_dn == issuer_dn)
+        return query.all()
+
+    @classmethod
+    def expiring(cls, before, after=None):
+        "Query for the certificates expiring between after (default: now) and before, soonest first"
+        return cls.query \
+            .filter(cls.not_after >= (after or datetime.utcnow()), cls.not_after < before) \
+            .order_by(cls.not_after)
+
     def get_hexhash(self):
-        return sha256(self.certificate).hexdigest()
+        if self.fingerprint is None:
+            return sha256(self.certificate).hexdigest()
+        return self.fingerprint
+
+@event.listens_for(Certificate.certificate, 'set')
+@event.listens_for(Certificate.private_key, 'set')
+def _invalidate_parsed_cache(target, value, oldvalue, initiator):
+    if initiator.key == 'certificate':
+        target.fingerprint = sha256(value).hexdigest() if value is not None else None
+        metadata = certificate_metadata(value) if value is not None else dict.fromkeys(METADATA_COLUMNS)
+        for column, column_value in metadata.items():
+            setattr(target, column, column_value)
+    if target.id is not None:
+        parsed_cache.discard_where(lambda key: key[0] == target.id and key[1] == initiator.key)
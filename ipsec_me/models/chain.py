@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# ipsec-me (c) Henryk Plötz
+
+from cryptography.hazmat.primitives import serialization
+
+from ..cache import LRUCache
+
+## Chain bundles of the CAs, keyed by (CA id, CA certificate fingerprint). A CA
+## certificate that is replaced gets a new key. So does an intermediate CA whose
+## parent was replaced: it has to be signed again by the new parent.
+chain_cache = LRUCache()
+
+class ChainBundle(object):
+    """The certificates of a CA and its parents, encoded once for all payloads.
+
+    entries is a list of (certificate id, DER certificate), starting with the
+    CA that issues end entity certificates and ending with the root.
+    """
+
+    def __init__(self, entries, certificates):
+        self.entries = entries
+        self.certificates = certificates
+        self.pem = b"".join(certificate.public_bytes(serialization.Encoding.PEM) for certificate in certificates)
+        self._openssl = None
+
+    @property
+    def root(self):
+        "(certificate id, DER certificate) of the trust anchor"
+        return self.entries[-1]
+
+    @property
+    def intermediates(self):
+        return self.entries[:-1]
+
+    def openssl_certificates(self):
+        "The certificates as pyOpenSSL objects, for PKCS#12 files"
+        if self._openssl is None:
+            from OpenSSL import crypto as crypto_openssl
+            self._openssl = [crypto_openssl.X509.from_cryptography(certificate) for certificate in self.certificates]
+        return self._openssl
+
+def chain_bundle(ca):
+    "The cached ChainBundle of a CertificateAuthority"
+    key = (ca.id, ca.certificate.fingerprint)
+    bundle = chain_cache.get(key)
+    if bundle is None:
+        chain = list(ca.chain())
+        bundle = ChainBundle([(link.certificate.id, link.certificate.certificate) for link in chain],
+            [link.certificate._certificate for link in chain])
+        chain_cache.set(key, bundle)
+    return bundle
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+# ipsec-me (c) Henryk Plötz
+
+from flask_diamond.facets.database import db
+
+from datetime import datetime
+from .utils import GUID
+
+class ChangeJournal(db.Model):
+    """Ordered record of changes to the gateway configuration of a VPN server.
+
+    An entry with a device_id means that device was added, changed or
+    deleted, one without means the server itself changed. Exports remember
+    the last id they have seen, see ipsec_me.export.
+
+    Ids are handed out when an entry is flushed, not when it commits: an
+    entry with a lower id than the latest can still show up later. Readers
+    of the journal also re-read the recent entries, see :meth:`since`.
+    Entries older than JOURNAL_RETENTION seconds are deleted by :meth:`prune`.
+    """
+    __tablename__ = 'change_journal'
+    __table_args__ = (
+        db.Index('ix_change_journal_vpn_server_id_id', 'vpn_server_id', 'id'),
+        db.Index('ix_change_journal_vpn_server_id_changed_at', 'vpn_server_id', 'changed_at'),
+        ## For pruning
+        db.Index('ix_change_journal_changed_at', 'changed_at'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    vpn_server_id = db.Column(GUID, nullable=False)
+    device_id = db.Column(GUID)
+    changed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    @classmethod
+    def record(cls, connection, vpn_server_id, device_id=None):
+        "Add an entry from within a flush, vpn_server_id may be a scalar subquery"
+        connection.execute(cls.__table__.insert().values(
+            vpn_server_id=vpn_server_id, device_id=device_id, changed_at=datetime.utcnow()))
+
+    @classmethod
+    def head(cls, vpn_server_id):
+        "Id of the latest entry for a server, 0 if there is none"
+        return db.session.query(db.func.max(cls.id)).filter(cls.vpn_server_id == vpn_server_id).scalar() or 0
+
+    @classmethod
+    def since(cls, vpn_server_id, last_id, changed_after=None):
+        """Changed device ids and whether the server itself changed since entry last_id
+
+        Entries changed after changed_after count as well whatever their id,
+        this catches those of transactions that committed after last_id was read.
+        """
+        # Two queries rather than an OR, so that each can use its index
+        queries = [db.session.query(cls.device_id).filter(cls.vpn_server_id == vpn_server_id, cls.id > last_id)]
+        if changed_after is not None:
+            queries.append(db.session.query(cls.device_id).filter(cls.vpn_server_id == vpn_server_id, cls.changed_at > changed_after))
+        device_ids = set()
+        server_changed = False
+        for query in queries:
+            for (device_id,) in query:
+                if device_id is None:
+                    server_changed = True
+                else:
+                    device_ids.add(device_id)
+        return device_ids, server_changed
+
+    @classmethod
+    def prune(cls, before):
+        "Delete the entries changed before a time and commit, returns how many were deleted"
+        count = cls.query.filter(cls.changed_at < before).delete(synchronize_session=False)
+        db.session.commit()
+        return count
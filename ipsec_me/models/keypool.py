@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+# ipsec-me (c) Henryk Plötz
+
+from flask_diamond.mixins.crud import CRUDMixin
+from flask_diamond.facets.database import db
+
+from flask import current_app
+from datetime import datetime, timedelta
+from uuid import uuid4
+from .utils import GUID
+from .keys import default_key_type
+
+class PooledKey(db.Model, CRUDMixin):
+    """Pre-generated private key, waiting to be used for a new certificate.
+
+    Keys are generated by the background workers in :mod:`ipsec_me.keypool`
+    and claimed by :meth:`take` in the same transaction that stores the
+    certificate using them, so a failed issuance returns the key to the pool.
+    Claimed rows lose their key material but are kept for a while so that
+    refill and drain rates can be computed by :meth:`stats`.
+    """
+    __tablename__ = "pooled_key"
+    __table_args__ = (
+        db.Index('ix_pooled_key_key_type_taken_at', 'key_type', 'taken_at'),
+    )
+    id = db.Column(GUID, primary_key=True, default=uuid4)
+    key_type = db.Column(db.String(32))
+    private_key = db.Column(db.LargeBinary())
+    created_at = db.Column(db.DateTime(), default=datetime.utcnow, index=True)
+    taken_at = db.Column(db.DateTime())
+
+    ## Number of candidate rows to try when a concurrent issuer claimed the first one
+    TAKE_CANDIDATES = 5
+
+    @classmethod
+    def take(cls, key_type):
+        "Claim the oldest key of key_type from the pool, returns its DER encoding or None if the pool is empty"
+        if not current_app.config.get('KEYPOOL_DEPTH'):
+            return None
+
+        candidates = db.session.query(cls.id, cls.private_key) \
+            .filter_by(key_type=key_type, taken_at=None) \
+            .order_by(cls.created_at) \
+            .limit(cls.TAKE_CANDIDATES) \
+            .all()
+
+        for key_id, private_key in candidates:
+            # Whoever marks the row as taken owns the key
+            claimed = db.session.query(cls) \
+                .filter_by(id=key_id, taken_at=None) \
+                .update({'taken_at': datetime.utcnow(), 'private_key': None}, synchronize_session=False)
+            if claimed == 1:
+                return private_key
+
+        return None
+
+    @classmethod
+    def add_keys(cls, key_type, keys, _commit=True):
+        db.session.bulk_insert_mappings(cls, [
+            dict(id=uuid4(), key_type=key_type, private_key=key, created_at=datetime.utcnow())
+            for key in keys
+        ])
+        if _commit:
+            db.session.commit()
+
+    @classmethod
+    def depth(cls):
+        "Returns a dictionary key_type -> number of available keys in the pool"
+        return dict(
+            db.session.query(cls.key_type, db.func.count(cls.id)) \
+                .filter_by(taken_at=None) \
+                .group_by(cls.key_type)
+        )
+
+    @classmethod
+    def purge(cls, before, _commit=True):
+        "Forget about keys that were taken before the given time"
+        result = db.session.query(cls).filter(cls.taken_at < before).delete(synchronize_session=False)
+        if _commit:
+            db.session.commit()
+        return result
+
+    @classmethod
+    def stats(cls, window=timedelta(hours=1)):
+        "Pool depth, target, and refill and drain rates (keys per hour, measured over window) per key type"
+        since = datetime.utcnow() - window
+        hours = window.total_seconds() / 3600.0
+
+        depth = cls.depth()
+        generated = dict(
+            db.session.query(cls.key_type, db.func.count(cls.id)) \
+                .filter(cls.created_at >= since) \
+                .group_by(cls.key_type)
+        )
+        taken = dict(
+            db.session.query(cls.key_type, db.func.count(cls.id)) \
+                .filter(cls.taken_at >= since) \
+                .group_by(cls.key_type)
+        )
+
+        return dict(
+            (key_type, {
+                'depth': depth.get(key_type, 0),
+                'target': current_app.config.get('KEYPOOL_DEPTH', 0),
+                'refill_rate': generated.get(key_type, 0) / hours,
+                'drain_rate': taken.get(key_type, 0) / hours,
+            })
+            for key_type in set(depth) | set(generated) | set(taken) | set(keypool_key_types())
+        )
+
+def keypool_key_types():
+    "Key types that the pool should be kept filled for"
+    key_types = current_app.config.get('KEYPOOL_KEY_TYPES')
+    if key_types is None:
+        key_types = [default_key_type()]
+    return list(key_types)
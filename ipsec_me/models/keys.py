@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+# ipsec-me (c) Henryk Plötz
+
+from flask import current_app
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization, hashes
+from cryptography.hazmat.primitives.asymmetric import rsa, ec, ed25519
+
+from ..metrics import timed
+
+## Key types are strings of the form "<algorithm>[:<parameter>]", e.g. "rsa:4096",
+## "ec:secp256r1" or "ed25519". Lists of supported key types may also name just
+## the algorithm ("rsa") to accept any parameter.
+
+KEY_TYPE_EC_P256 = "ec:secp256r1"
+KEY_TYPE_EC_P384 = "ec:secp384r1"
+KEY_TYPE_ED25519 = "ed25519"
+
+EC_CURVES = {
+    'secp256r1': ec.SECP256R1,
+    'secp384r1': ec.SECP384R1,
+}
+
+def rsa_key_type(keysize):
+    return "rsa:{0}".format(keysize)
+
+def default_key_type():
+    return current_app.config.get('DEFAULT_KEY_TYPE') or rsa_key_type(current_app.config['RSA_KEYSIZE'])
+
+def key_type_supported(key_type, supported):
+    "Check key_type against a list of supported key types, None means anything goes"
+    if supported is None:
+        return True
+    return any(key_type == entry or key_type.startswith(entry + ":") for entry in supported)
+
+def select_key_type(preferred, supported):
+    "Returns preferred if it is supported, otherwise the first supported key type"
+    if key_type_supported(preferred, supported):
+        return preferred
+    if supported[0] == "rsa":
+        return rsa_key_type(current_app.config['RSA_KEYSIZE'])
+    return supported[0]
+
+@timed("keygen")
+def generate_private_key(key_type):
+    algorithm, _, parameter = key_type.partition(':')
+
+    if algorithm == "rsa":
+        return rsa.generate_private_key(
+            public_exponent=65537,
+            key_size=int(parameter),
+            backend=default_backend()
+        )
+    elif algorithm == "ec" and parameter in EC_CURVES:
+        return ec.generate_private_key(EC_CURVES[parameter](), backend=default_backend())
+    elif key_type == KEY_TYPE_ED25519:
+        return ed25519.Ed25519PrivateKey.generate()
+
+    raise ValueError("Unsupported key type {0}".format(key_type))
+
+def key_type_of(key):
+    "Key type of a private or public key"
+    if isinstance(key, (rsa.RSAPrivateKey, rsa.RSAPublicKey)):
+        return rsa_key_type(key.key_size)
+    elif isinstance(key, (ec.EllipticCurvePrivateKey, ec.EllipticCurvePublicKey)):
+        return "ec:{0}".format(key.curve.name)
+    elif isinstance(key, (ed25519.Ed25519PrivateKey, ed25519.Ed25519PublicKey)):
+        return KEY_TYPE_ED25519
+    raise ValueError("Unsupported key {0!r}".format(key))
+
+def signature_hash(key):
+    "Hash algorithm to sign with key, None for algorithms with a built-in hash"
+    if isinstance(key, ed25519.Ed25519PrivateKey):
+        return None
+    if isinstance(key, ec.EllipticCurvePrivateKey) and key.curve.key_size > 256:
+        return hashes.SHA384()
+    return hashes.SHA256()
+
+def private_key_format(key):
+    # There is no traditional OpenSSL format for Ed25519
+    if isinstance(key, ed25519.Ed25519PrivateKey):
+        return serialization.PrivateFormat.PKCS8
+    return serialization.PrivateFormat.TraditionalOpenSSL
+
+def serialize_private_key(key):
+    return key.private_bytes(
+        encoding=serialization.Encoding.DER,
+        format=private_key_format(key),
+        encryption_algorithm=serialization.NoEncryption(),
+    )
+
+def load_private_key(data):
+    return serialization.load_der_private_key(data, password=None, backend=default_backend())
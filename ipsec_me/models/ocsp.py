@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# ipsec-me (c) Henryk Plötz
+
+from flask_diamond.mixins.crud import CRUDMixin
+from flask_diamond.facets.database import db
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+from datetime import datetime
+from uuid import uuid4
+
+from .utils import GUID
+from .certificate import Certificate
+
+STALE_KEY = 'ocsp_stale_certificates'
+
+class OCSPResponse(db.Model, CRUDMixin):
+    """A pre-signed OCSP response for one certificate and CertID hash algorithm, see ipsec_me.ocsp.
+
+    Responses with a next_update in the past are never served. They are
+    re-signed by the refresher, which also picks up responses whose
+    certificate status changed: those get next_update set to now.
+    """
+    __tablename__ = 'ocsp_response'
+    __table_args__ = (
+        db.Index('ix_ocsp_response_ca_id_serial_number_hash_algorithm', 'ca_id', 'serial_number', 'hash_algorithm', unique=True),
+    )
+    id = db.Column(GUID, primary_key=True, default=uuid4)
+    ca_id = db.Column('ca_id', GUID, db.ForeignKey('certificate_authority.id'), nullable=False)
+    certificate_id = db.Column('certificate_id', GUID, db.ForeignKey('certificate.id'), index=True, nullable=False)
+    serial_number = db.Column(db.BigInteger, nullable=False)
+    ## Hash algorithm of the CertID, responses must use the one of the request, see OCSP_CERT_ID_HASHES
+    hash_algorithm = db.Column(db.String(16), nullable=False, default='sha1', server_default='sha1')
+    response = db.Column(db.LargeBinary(), nullable=False)
+    this_update = db.Column(db.DateTime, nullable=False)
+    next_update = db.Column(db.DateTime, nullable=False, index=True)
+
+@event.listens_for(Certificate.status, 'set')
+def _certificate_status_changed(target, value, oldvalue, initiator):
+    session = object_session(target)
+    if target.id is not None and session is not None and value != oldvalue:
+        session.info.setdefault(STALE_KEY, set()).add(target.id)
+
+@event.listens_for(Session, 'after_flush')
+def _expire_stale_responses(session, flush_context):
+    stale = session.info.pop(STALE_KEY, None)
+    if stale:
+        session.connection().execute(OCSPResponse.__table__.update()
+            .where(OCSPResponse.__table__.c.certificate_id.in_(list(stale)))
+            .values(next_update=datetime.utcnow()))
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# ipsec-me (c) Henryk Plötz
+
+from flask_diamond.mixins.crud import CRUDMixin
+from flask_diamond.facets.database import db
+
+from flask import current_app
+from datetime import datetime, timedelta
+from enum import Enum
+from uuid import uuid4
+from .utils import GUID
+
+class JobStatus(Enum):
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+class ProvisioningJob(db.Model, CRUDMixin):
+    "Deferred creation of a device, executed by :class:`ipsec_me.provisioning.ProvisioningQueue`"
+    __tablename__ = 'provisioning_job'
+    id = db.Column(GUID, primary_key=True, default=uuid4)
+
+    vpn_user_id = db.Column('vpn_user_id', GUID, db.ForeignKey('vpn_user.id'))
+    vpn_user = db.relationship('VPNUser')
+
+    name = db.Column(db.String(255))
+    device_type = db.Column(db.String())
+
+    status = db.Column(db.Enum(JobStatus), default=JobStatus.PENDING, index=True)
+    error = db.Column(db.Text())
+
+    device_id = db.Column('device_id', GUID, db.ForeignKey('device.id'))
+    device = db.relationship('DeviceBase')
+
+    created_at = db.Column(db.DateTime(), default=datetime.utcnow)
+    ## When a worker moved the job to RUNNING, the job is taken over if the worker died
+    claimed_at = db.Column(db.DateTime())
+    finished_at = db.Column(db.DateTime())
+
+    @property
+    def finished(self):
+        return self.status in (JobStatus.DONE, JobStatus.FAILED)
+
+    def claim(self):
+        """Atomically move the job to RUNNING, returns False if somebody else got it first.
+
+        Jobs that are RUNNING for longer than PROVISIONING_JOB_TIMEOUT are
+        claimed again: their worker is assumed to have died.
+        """
+        claimed = db.session.query(self.__class__) \
+            .filter_by(id=self.id) \
+            .filter(self.__class__._waiting()) \
+            .update({'status': JobStatus.RUNNING, 'claimed_at': datetime.utcnow()}, synchronize_session=False)
+        db.session.commit()
+        db.session.expire(self)
+        return claimed == 1
+
+    @staticmethod
+    def _stale_before(timeout='PROVISIONING_JOB_TIMEOUT'):
+        return datetime.utcnow() - timedelta(seconds=current_app.config[timeout])
+
+    @classmethod
+    def _waiting(cls):
+        stale = cls._stale_before()
+        return db.or_(cls.status == JobStatus.PENDING,
+            db.and_(cls.status == JobStatus.RUNNING, db.or_(cls.claimed_at == None, cls.claimed_at < stale)))
+
+    @property
+    def stale(self):
+        "PENDING or RUNNING for so long that the process it was queued in or its worker is assumed to have died"
+        if self.status is JobStatus.PENDING:
+            return self.created_at is None or self.created_at < self._stale_before('PROVISIONING_QUEUE_TIMEOUT')
+        return self.status is JobStatus.RUNNING and (self.claimed_at is None or self.claimed_at < self._stale_before())
+
+    def run(self):
+        if not self.claim():
+            current_app.logger.debug("Not running {0}, already claimed".format(self))
+            return
+
+        try:
+            # Committed together with DONE, a job is never taken over after its device was added
+            self.device = self.vpn_user.add_device(name=self.name, device_type=self.device_type, _commit=False)
+            self.status = JobStatus.DONE
+        except Exception as e:
+            current_app.logger.exception("Provisioning job {0} failed".format(self))
+            db.session.rollback()
+            self.status = JobStatus.FAILED
+            self.error = str(e)
+
+        self.finished_at = datetime.utcnow()
+        self.save()
+
+    @classmethod
+    def pending(cls):
+        "Jobs waiting for a worker, including those whose worker died"
+        return cls.query.filter(cls._waiting()).order_by(cls.created_at)
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+# ipsec-me (c) Henryk Plötz
+
+from flask_diamond.mixins.crud import CRUDMixin
+from flask_diamond.facets.database import db
+
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from datetime import datetime, timedelta
+from uuid import uuid4
+import threading
+import time
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+
+from .utils import GUID
+from ..cache import LRUCache
+from ..metrics import timed
+
+## Paths the CRLs of a CA are served from, relative to CRL_BASE_URL
+CRL_PATH = "/crl/{0}.crl"
+DELTA_CRL_PATH = "/crl/{0}_delta.crl"
+
+ENTRIES_KEY = 'crl_entries'
+
+class RevokedCertificate(db.Model, CRUDMixin):
+    """A revoked certificate, by serial number within its CA.
+
+    crl_number numbers the revocations of each CA, so that CRLs can be
+    extended with just the entries added since. It is not the number of a
+    CRL, see CertificateAuthority.last_crl_number.
+    """
+    __tablename__ = 'revoked_certificate'
+    __table_args__ = (
+        db.Index('ix_revoked_certificate_ca_id_serial_number', 'ca_id', 'serial_number', unique=True),
+        db.Index('ix_revoked_certificate_ca_id_crl_number', 'ca_id', 'crl_number'),
+    )
+    id = db.Column(GUID, primary_key=True, default=uuid4)
+    ca_id = db.Column('ca_id', GUID, db.ForeignKey('certificate_authority.id'), nullable=False)
+    certificate_id = db.Column('certificate_id', GUID, db.ForeignKey('certificate.id'))
+    serial_number = db.Column(db.BigInteger, nullable=False)
+    revoked_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    ## An x509.ReasonFlags value, None for unspecified
+    reason = db.Column(db.String(32))
+    crl_number = db.Column(db.Integer, nullable=False)
+
+    def build(self):
+        builder = x509.RevokedCertificateBuilder() \
+            .serial_number(self.serial_number) \
+            .revocation_date(self.revoked_at)
+        if self.reason is not None:
+            builder = builder.add_extension(x509.CRLReason(x509.ReasonFlags(self.reason)), critical=False)
+        return builder.build(default_backend())
+
+class PublishedCRL(db.Model, CRUDMixin):
+    """The current full or delta CRL of a CA, signed by :meth:`CRLEngine.publish`.
+
+    last_entry is the crl_number of the last revocation listed, so that a
+    delta CRL is signed again once there are newer ones.
+    """
+    __tablename__ = 'published_crl'
+    __table_args__ = (
+        db.Index('ix_published_crl_ca_id_delta', 'ca_id', 'delta', unique=True),
+    )
+    id = db.Column(GUID, primary_key=True, default=uuid4)
+    ca_id = db.Column('ca_id', GUID, db.ForeignKey('certificate_authority.id'), nullable=False)
+    delta = db.Column(db.Boolean, nullable=False)
+    crl_number = db.Column(db.Integer, nullable=False)
+    last_entry = db.Column(db.Integer, nullable=False)
+    last_update = db.Column(db.DateTime, nullable=False)
+    next_update = db.Column(db.DateTime, nullable=False)
+    der = db.deferred(db.Column(db.LargeBinary, nullable=False))
+
+class SignedCRL(object):
+    def __init__(self, der, crl_number, last_update, next_update):
+        self.der = der
+        self.crl_number = crl_number
+        self.last_update = last_update
+        self.next_update = next_update
+
+class CRLEngine(object):
+    """Signs, stores and serves the full and delta CRLs of the CAs.
+
+    CRLs are only signed by writers: when a CA is created, when a certificate
+    is revoked and by :meth:`refresh`, which cuts a new full CRL once the
+    current one has reached half of CRL_FULL_INTERVAL and signs the delta CRL
+    again before it expires. Every CRL gets a new number from the CA's
+    last_crl_number, full and delta CRLs share the sequence (RFC 5280, 5.2.3).
+    Serving a CRL only reads: the signed CRLs are cached per process by
+    number.
+
+    The revoked entries of each CA are kept in memory and extended with the
+    entries added since they were last read, using the crl_number index of
+    RevokedCertificate, so signing a CRL never reads the whole revocation
+    table, let alone the certificates. Entries read within a transaction are
+    only shared with other sessions of this process once it has been
+    committed, like the serial number leases: a rolled back revocation must
+    not end up in the CRLs.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        ## ca id -> (highest crl_number read, [(crl_number, x509.RevokedCertificate), ...])
+        self._entries = {}
+        ## (ca id, delta, CRL number) -> SignedCRL
+        self.cache = LRUCache()
+
+    def entries(self, ca, upto, after=0):
+        "Revoked entries of ca with after < crl_number <= upto"
+        pending = db.session().info.setdefault(ENTRIES_KEY, {})
+        with self._lock:
+            read, entries = pending.get(ca.id) or self._entries.get(ca.id, (0, []))
+
+        if upto > read:
+            rows = RevokedCertificate.query \
+                .filter(RevokedCertificate.ca_id == ca.id) \
+                .filter(RevokedCertificate.crl_number > read) \
+                .order_by(RevokedCertificate.crl_number) \
+                .all()
+            new_entries = [(row.crl_number, row.build()) for row in rows]
+            read = max([read] + [number for number, entry in new_entries])
+            entries = entries + new_entries
+            pending[ca.id] = (read, entries)
+
+        return [entry for number, entry in entries if after < number <= upto]
+
+    def committed(self, session):
+        with self._lock:
+            for ca_id, (read, entries) in session.info.pop(ENTRIES_KEY, {}).items():
+                if read > self._entries.get(ca_id, (0, []))[0]:
+                    self._entries[ca_id] = (read, entries)
+
+    def discarded(self, session):
+        session.info.pop(ENTRIES_KEY, None)
+
+    def full_crl(self, ca):
+        "The current full CRL of ca"
+        return self._published(ca, delta=False)
+
+    def delta_crl(self, ca):
+        "The current delta CRL of ca, with the revocations since the full CRL"
+        return self._published(ca, delta=True)
+
+    def _published(self, ca, delta):
+        row = db.session.query(PublishedCRL.id, PublishedCRL.crl_number).filter_by(ca_id=ca.id, delta=delta).first()
+        if row is None:
+            # Only CAs from before CRLs were published have none
+            self.refresh(ca)
+            row = db.session.query(PublishedCRL.id, PublishedCRL.crl_number).filter_by(ca_id=ca.id, delta=delta).one()
+
+        key = (ca.id, delta, row.crl_number)
+        crl = self.cache.get(key)
+        if crl is None:
+            published = PublishedCRL.query.options(db.undefer('der')).get(row.id)
+            crl = SignedCRL(published.der, published.crl_number, published.last_update, published.next_update)
+            self.cache.discard_where(lambda k: k[:2] == key[:2])
+            self.cache.set(key, crl)
+        return crl
+
+    def _due(self, ca, published, now):
+        "Whether the full CRL and whether the delta CRL of ca need to be signed"
+        full, delta = published.get(False), published.get(True)
+        full_due = full is None or ca.crl_base_at is None or \
+            now - ca.crl_base_at >= timedelta(seconds=current_app.config['CRL_FULL_INTERVAL']) / 2
+        delta_due = full_due or delta is None or delta.last_entry != ca.crl_number or \
+            delta.next_update - now < timedelta(seconds=current_app.config['CRL_DELTA_INTERVAL']) / 2
+        return full_due, delta_due
+
+    def _published_rows(self, ca):
+        return dict((row.delta, row) for row in PublishedCRL.query.filter_by(ca_id=ca.id))
+
+    def publish(self, ca):
+        """Sign the CRLs of ca that are due, returns how many were signed.
+
+        ca must be locked, see CertificateAuthority._locked(), the caller commits.
+        """
+        now = datetime.utcnow().replace(microsecond=0)
+        published = self._published_rows(ca)
+        full_due, delta_due = self._due(ca, published, now)
+
+        if full_due:
+            ca.crl_base_number = ca.crl_number
+            ca.crl_base_at = now
+            next_update = now + timedelta(seconds=current_app.config['CRL_FULL_INTERVAL'])
+            published[False] = self._store(ca, published.get(False), False, ca.crl_base_number,
+                self._sign(ca, now, next_update, self.entries(ca, upto=ca.crl_base_number)))
+
+        if delta_due:
+            next_update = now + timedelta(seconds=current_app.config['CRL_DELTA_INTERVAL'])
+            base_number = published[False].crl_number
+            self._store(ca, published.get(True), True, ca.crl_number,
+                self._sign(ca, now, next_update, self.entries(ca, upto=ca.crl_number, after=ca.crl_base_number),
+                    base_number=base_number))
+
+        return int(full_due) + int(delta_due)
+
+    def refresh(self, ca):
+        "Sign the CRLs of ca that are due and commit, returns how many were signed"
+        published = self._published_rows(ca)
+        if not any(self._due(ca, published, datetime.utcnow().replace(microsecond=0))):
+            return 0
+        count = self.publish(ca._locked())
+        db.session.commit()
+        return count
+
+    def refresh_all(self):
+        "Sign the due CRLs of all CAs, returns how many were signed"
+        from . import CertificateAuthority
+        count = sum(self.refresh(ca) for ca in CertificateAuthority.query.all())
+        if count:
+            current_app.logger.info("CRL: signed {0} CRLs".format(count))
+        return count
+
+    def run(self, interval=None):
+        "Refresh forever, checking every interval seconds"
+        if interval is None:
+            interval = current_app.config['CRL_REFRESH_INTERVAL']
+        while True:
+            self.refresh_all()
+            db.session.remove()
+            time.sleep(interval)
+
+    def _sign(self, ca, last_update, next_update, entries, base_number=None):
+        ca.last_crl_number = (ca.last_crl_number or 0) + 1
+        crl_number = ca.last_crl_number
+
+        signer = ca.certificate.signer()
+        builder = x509.CertificateRevocationListBuilder() \
+            .issuer_name(signer.subject) \
+            .last_update(last_update) \
+            .next_update(next_update) \
+            .add_extension(x509.CRLNumber(crl_number), critical=False)
+        if base_number is not None:
+            builder = builder.add_extension(x509.DeltaCRLIndicator(base_number), critical=True)
+        else:
+            delta_urls = ca.crl_urls(DELTA_CRL_PATH)
+            if delta_urls:
+                builder = builder.add_extension(crl_distribution_points(delta_urls, x509.FreshestCRL), critical=False)
+        for entry in entries:
+            builder = builder.add_revoked_certificate(entry)
+
+        with timed("sign_crl"):
+            crl = signer.sign_crl(builder)
+        return SignedCRL(crl.public_bytes(serialization.Encoding.DER), crl_number, last_update, next_update)
+
+    def _store(self, ca, row, delta, last_entry, crl):
+        if row is None:
+            row = PublishedCRL(ca_id=ca.id, delta=delta)
+            db.session.add(row)
+        row.crl_number = crl.crl_number
+        row.last_entry = last_entry
+        row.last_update = crl.last_update
+        row.next_update = crl.next_update
+        row.der = crl.der
+        return row
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+        self.cache.clear()
+
+crl_engine = CRLEngine()
+
+@event.listens_for(Session, 'after_commit')
+def _crl_entries_committed(session):
+    crl_engine.committed(session)
+
+@event.listens_for(Session, 'after_transaction_end')
+def _crl_entries_discarded(session, transaction):
+    # Runs after after_commit, so anything left was rolled back or closed
+    if transaction.parent is None:
+        crl_engine.discarded(session)
+
+def crl_distribution_points(urls, extension=x509.CRLDistributionPoints):
+    return extension([
+        x509.DistributionPoint(full_name=[x509.UniformResourceIdentifier(url)],
+            relative_name=None, reasons=None, crl_issuer=None)
+        for url in urls
+    ])
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# ipsec-me (c) Henryk Plötz
+
+from flask_diamond.facets.database import db
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+import threading
+import os
+
+LEASES_KEY = 'serial_number_leases'
+
+class SerialNumberLease(object):
+    "A range [next, end) of serial numbers that has been reserved on a CA row"
+
+    def __init__(self, model, ca_id, start, end):
+        self.model = model
+        self.ca_id = ca_id
+        self.next = start
+        self.end = end
+
+    @property
+    def available(self):
+        return self.next < self.end
+
+    def take(self):
+        serial_number = self.next
+        self.next += 1
+        return serial_number
+
+class SerialNumberAllocator(object):
+    """Hands out serial numbers from ranges leased from the CA's next_serial_number counter.
+
+    A new range is reserved within the caller's transaction and only shared
+    with other sessions of this process after that transaction has been
+    committed. If it is rolled back, the reservation is undone in the database
+    and the range is forgotten. Serial numbers of a committed range that are
+    never used, e.g. because the process exits, are simply skipped: they are
+    never handed out again, so serial numbers stay unique.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._leases = {}
+        self._pid = os.getpid()
+
+    def _check_fork(self):
+        # A forked child must not use the leases of its parent, which keeps using them
+        if os.getpid() != self._pid:
+            self._leases = {}
+            self._pid = os.getpid()
+
+    def allocate(self, ca, lease_size):
+        pending = db.session().info.setdefault(LEASES_KEY, {})
+
+        with self._lock:
+            self._check_fork()
+            for lease in [pending.get(ca.id)] + self._leases.get(ca.id, []):
+                if lease is not None and lease.available:
+                    return lease.take()
+
+        serial_numbers = ca.get_next_serial_numbers(lease_size)
+        lease = SerialNumberLease(ca.__class__, ca.id, serial_numbers.start, serial_numbers.stop)
+        pending[ca.id] = lease
+        return lease.take()
+
+    def committed(self, session):
+        with self._lock:
+            self._check_fork()
+            for ca_id, lease in session.info.pop(LEASES_KEY, {}).items():
+                if lease.available:
+                    leases = [l for l in self._leases.get(ca_id, []) if l.available]
+                    self._leases[ca_id] = leases + [lease]
+
+    def discarded(self, session):
+        session.info.pop(LEASES_KEY, None)
+
+    def release_all(self):
+        """Give unused serial numbers back to their CA, if no other lease has been taken since.
+
+        Call on orderly shutdown, needs an application context.
+        """
+        with self._lock:
+            self._check_fork()
+            leases = [lease for leases in self._leases.values() for lease in leases if lease.available]
+            self._leases = {}
+
+        for lease in leases:
+            db.session.query(lease.model) \
+                .filter_by(id=lease.ca_id, next_serial_number=lease.end) \
+                .update({'next_serial_number': lease.next}, synchronize_session=False)
+        db.session.commit()
+
+serial_number_allocator = SerialNumberAllocator()
+
+@event.listens_for(Session, 'after_commit')
+def _serial_number_leases_committed(session):
+    serial_number_allocator.committed(session)
+
+@event.listens_for(Session, 'after_transaction_end')
+def _serial_number_leases_discarded(session, transaction):
+    # Runs after after_commit, so anything left was rolled back or closed
+    if transaction.parent is None:
+        serial_number_allocator.discarded(session)
@@ -1,4 +1,5 @@
-from sqlalchemy.types import TypeDecorator, CHAR
+from sqlalchemy import column, table, select
+from sqlalchemy.types import TypeDecorator, CHAR, BINARY, VARBINARY
 from sqlalchemy.dialects.postgresql import UUID
 import uuid
 
@@ -6,33 +7,106 @@ class GUID(TypeDecorator):
     """Platform-independent GUID type.
 
     Uses PostgreSQL's UUID type, otherwise uses
-    CHAR(32), storing as stringified hex values.
+    CHAR(32), storing as stringified hex values,
+    or BINARY(16), storing the raw 16 bytes if
+    ``GUID.binary`` is set (``GUID_STORAGE = "binary"``).
 
     """
     impl = CHAR
 
+    ## Set by create_app from the GUID_STORAGE setting, before any table is used
+    binary = False
+
     def load_dialect_impl(self, dialect):
         if dialect.name == 'postgresql':
             return dialect.type_descriptor(UUID())
+        elif self.binary:
+            return dialect.type_descriptor(BINARY(16))
         else:
             return dialect.type_descriptor(CHAR(32))
 
     def process_bind_param(self, value, dialect):
         if value is None:
             return value
-        elif dialect.name == 'postgresql':
+        if not isinstance(value, uuid.UUID):
+            value = uuid.UUID(value)
+
+        if dialect.name == 'postgresql':
             return str(value)
+        elif self.binary:
+            return value.bytes
         else:
-            if not isinstance(value, uuid.UUID):
-                return "%.32x" % uuid.UUID(value).int
-            else:
-                # hexstring
-                return "%.32x" % value.int
+            # hexstring
+            return value.hex
 
     def process_result_value(self, value, dialect):
-        if value is None:
+        if value is None or isinstance(value, uuid.UUID):
             return value
+        elif isinstance(value, bytes) and len(value) == 16:
+            return uuid.UUID(bytes=value)
         else:
-            if not isinstance(value, uuid.UUID):
-                value = uuid.UUID(value)
-            return value
+            return uuid.UUID(value)
+
+
+def guid_columns(metadata):
+    "[(table, column), ...] of all GUID columns in metadata"
+    return [(t, c) for t in metadata.sorted_tables for c in t.columns if isinstance(c.type, GUID)]
+
+def _to_binary(value):
+    if isinstance(value, bytes) and len(value) == 16:
+        return value
+    if isinstance(value, bytes):
+        value = value.decode("US-ASCII")
+    return uuid.UUID(value).bytes
+
+def _to_char(value):
+    if isinstance(value, bytes) and len(value) == 16:
+        return uuid.UUID(bytes=value).hex
+    if isinstance(value, bytes):
+        return value.decode("US-ASCII")
+    return value
+
+def _convert_values(connection, columns, convert):
+    # Columns are read untyped, so values come back as stored. Old and new
+    # representations never collide, so rows can be converted one value at a time.
+    for t, c in columns:
+        untyped = column(c.name)
+        untyped_table = table(t.name, untyped)
+        values = [row[0] for row in connection.execute(select([untyped]).select_from(untyped_table).distinct()) if row[0] is not None]
+        for value in values:
+            converted = convert(value)
+            if converted != value:
+                connection.execute(untyped_table.update().where(untyped == value).values({c.name: converted}))
+
+def _alter_columns(connection, columns, type_):
+    quote = connection.dialect.identifier_preparer.quote
+    for t, c in columns:
+        connection.execute("ALTER TABLE {0} MODIFY {1} {2}{3}".format(quote(t.name), quote(c.name),
+            type_.compile(dialect=connection.dialect), "" if c.nullable else " NOT NULL"))
+
+def convert_guid_storage(connection, metadata, binary):
+    """Convert the stored values of all GUID columns in metadata to BINARY(16) or CHAR(32).
+
+    Nothing to do on PostgreSQL, which has a native UUID type. On MySQL the
+    column types are changed, on SQLite only the stored values. Converting
+    values that are already stored that way is harmless. GUID_STORAGE has to
+    be changed accordingly before the application is started again.
+    """
+    if connection.dialect.name == 'postgresql':
+        return
+    columns = guid_columns(metadata)
+    convert = _to_binary if binary else _to_char
+
+    if connection.dialect.name == 'sqlite':
+        # Column types are only advisory, values keep the storage class they were written with
+        _convert_values(connection, columns, convert)
+        return
+
+    # Needs a column type that holds both representations during the conversion
+    connection.execute("SET FOREIGN_KEY_CHECKS=0")
+    try:
+        _alter_columns(connection, columns, VARBINARY(32))
+        _convert_values(connection, columns, convert)
+        _alter_columns(connection, columns, BINARY(16) if binary else CHAR(32))
+    finally:
+        connection.execute("SET FOREIGN_KEY_CHECKS=1")
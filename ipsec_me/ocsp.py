@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+# ipsec-me (c) Henryk Plötz
+
+from flask import current_app
+from flask_diamond.facets.database import db
+from datetime import datetime, timedelta
+import threading
+import time
+
+from cryptography import x509
+from cryptography.x509 import ocsp
+from cryptography.hazmat.primitives import hashes, serialization
+
+from .models import CertificateAuthority, Certificate, CertificateStatus, RevokedCertificate
+from .models.ocsp import OCSPResponse
+from .models.keys import signature_hash
+from .cache import LRUCache
+from .metrics import timed
+
+## CertID hash algorithms responses can be signed for, by name, see OCSP_CERT_ID_HASHES
+CERT_ID_HASHES = dict((algorithm.name, algorithm) for algorithm in (hashes.SHA1, hashes.SHA256, hashes.SHA384, hashes.SHA512))
+
+def cert_id_hashes():
+    "Names of the configured CertID hash algorithms"
+    return [name for name in current_app.config['OCSP_CERT_ID_HASHES'] if name in CERT_ID_HASHES]
+
+def _unsuccessful(status):
+    return ocsp.OCSPResponseBuilder.build_unsuccessful(status).public_bytes(serialization.Encoding.DER)
+
+MALFORMED_REQUEST = _unsuccessful(ocsp.OCSPResponseStatus.MALFORMED_REQUEST)
+UNAUTHORIZED = _unsuccessful(ocsp.OCSPResponseStatus.UNAUTHORIZED)
+TRY_LATER = _unsuccessful(ocsp.OCSPResponseStatus.TRY_LATER)
+
+
+class OCSPRefresher(object):
+    """Signs the OCSP responses of all certificates issued by the CAs ahead of time.
+
+    Responses are valid for ``OCSP_VALIDITY`` seconds and signed again once
+    less than ``OCSP_REFRESH_MARGIN`` seconds are left, or right away when the
+    status of their certificate changed. Needs an application context.
+    """
+
+    def __init__(self, batch_size=None):
+        self.batch_size = batch_size or current_app.config['OCSP_BATCH_SIZE']
+
+    def refresh(self):
+        "Sign missing and expiring responses of all CAs, returns the number of responses signed"
+        return sum(self.refresh_ca(ca) for ca in CertificateAuthority.query.all())
+
+    def refresh_ca(self, ca):
+        now = datetime.utcnow()
+        due = now + timedelta(seconds=current_app.config['OCSP_REFRESH_MARGIN'])
+        algorithms = cert_id_hashes()
+
+        responses = dict(((response.certificate_id, response.hash_algorithm), response) for response in OCSPResponse.query
+            .filter(OCSPResponse.ca_id == ca.id, OCSPResponse.next_update <= due, OCSPResponse.hash_algorithm.in_(algorithms)))
+        expiring = dict((certificate.id, certificate) for certificate in
+            Certificate.query.filter(Certificate.id.in_(set(certificate_id for certificate_id, algorithm in responses))).all()) \
+            if responses else {}
+        work = [(expiring[certificate_id], algorithm) for certificate_id, algorithm in responses]
+        for algorithm in algorithms:
+            missing = ca.certificates() \
+                .outerjoin(OCSPResponse, db.and_(OCSPResponse.certificate_id == Certificate.id, OCSPResponse.hash_algorithm == algorithm)) \
+                .filter(OCSPResponse.id == None) \
+                .all()
+            work = [(certificate, algorithm) for certificate in missing] + work
+
+        signer = None
+        count = 0
+        for certificate, algorithm in work:
+            if certificate.status is CertificateStatus.REQUEST or not ca.issued(certificate):
+                continue
+            if signer is None:
+                # OCSP responses can't be rebuilt from their encoding, the signing daemon can't sign them
+                signer = ca.certificate.signer(local=True)
+
+            response = responses.get((certificate.id, algorithm))
+            if response is None:
+                response = OCSPResponse(ca_id=ca.id, certificate_id=certificate.id, hash_algorithm=algorithm)
+                db.session.add(response)
+            self.sign(ca, signer, certificate, response)
+
+            count += 1
+            if count % self.batch_size == 0:
+                db.session.commit()
+        db.session.commit()
+
+        if count:
+            current_app.logger.info("OCSP: signed {0} responses for {1}".format(count, ca))
+        return count
+
+    def sign(self, ca, signer, certificate, response):
+        now = datetime.utcnow().replace(microsecond=0)
+        cert = certificate._certificate
+
+        cert_status, revocation_time, revocation_reason = ocsp.OCSPCertStatus.GOOD, None, None
+        if certificate.status is CertificateStatus.REVOKED:
+            entry = RevokedCertificate.query.filter_by(ca_id=ca.id, serial_number=cert.serial_number).first()
+            cert_status = ocsp.OCSPCertStatus.REVOKED
+            revocation_time = entry.revoked_at if entry is not None else now
+            if entry is not None and entry.reason is not None:
+                revocation_reason = x509.ReasonFlags(entry.reason)
+
+        response.serial_number = cert.serial_number
+        response.this_update = now
+        response.next_update = now + timedelta(seconds=current_app.config['OCSP_VALIDITY'])
+        builder = ocsp.OCSPResponseBuilder() \
+            .add_response(cert=cert, issuer=ca.certificate._certificate, algorithm=CERT_ID_HASHES[response.hash_algorithm](),
+                cert_status=cert_status, this_update=response.this_update, next_update=response.next_update,
+                revocation_time=revocation_time, revocation_reason=revocation_reason) \
+            .responder_id(ocsp.OCSPResponderEncoding.HASH, ca.certificate._certificate)
+        with timed("sign_ocsp"):
+            response.response = builder.sign(signer.private_key, signature_hash(signer.private_key)) \
+                .public_bytes(serialization.Encoding.DER)
+
+    def run(self, interval=None):
+        "Refresh forever, checking every interval seconds"
+        if interval is None:
+            interval = current_app.config['OCSP_REFRESH_INTERVAL']
+        while True:
+            self.refresh()
+            db.session.remove()
+            time.sleep(interval)
+
+
+class CachedResponse(object):
+    def __init__(self, response, expires):
+        self.response = response
+        self.expires = expires
+
+class OCSPResponder(object):
+    """Answers OCSP requests with the responses signed by :class:`OCSPRefresher`.
+
+    Never signs anything: requests for unknown issuers are answered with
+    unauthorized, requests without a current response with tryLater.
+    Responses are cached per process for at most ``OCSP_CACHE_TTL`` seconds,
+    so that a revocation reaches all processes within that time.
+    """
+
+    def __init__(self):
+        self.cache = LRUCache()
+        self._lock = threading.Lock()
+        ## (hash algorithm name, issuer key hash) -> CA id
+        self._issuers = {}
+        self._issuers_loaded = None
+
+    def clear(self):
+        "Forget the cached responses and issuers"
+        self.cache.clear()
+        with self._lock:
+            self._issuers = {}
+            self._issuers_loaded = None
+
+    def _load_issuers(self):
+        issuers = {}
+        for ca in CertificateAuthority.query.all():
+            ca_certificate = ca.certificate._certificate
+            for name in cert_id_hashes():
+                request = ocsp.OCSPRequestBuilder().add_certificate(ca_certificate, ca_certificate, CERT_ID_HASHES[name]()).build()
+                issuers[(name, request.issuer_key_hash)] = ca.id
+        with self._lock:
+            self._issuers = issuers
+            self._issuers_loaded = time.time()
+
+    def issuer(self, request):
+        "Id of the CA a request is for, None if unknown"
+        key = (request.hash_algorithm.name, request.issuer_key_hash)
+        ca_id = self._issuers.get(key)
+        # New CAs are picked up, but unknown issuers don't reload the CAs on every request
+        if ca_id is None and (self._issuers_loaded is None or time.time() - self._issuers_loaded > current_app.config['OCSP_CACHE_TTL']):
+            self._load_issuers()
+            ca_id = self._issuers.get(key)
+        return ca_id
+
+    def respond(self, data):
+        "DER encoded response to a DER encoded request"
+        try:
+            request = ocsp.load_der_ocsp_request(data)
+        except ValueError:
+            return MALFORMED_REQUEST
+
+        ca_id = self.issuer(request)
+        if ca_id is None:
+            return UNAUTHORIZED
+
+        # Clients match the response by CertID, it has to use the hash algorithm of the request
+        key = (ca_id, request.serial_number, request.hash_algorithm.name)
+        now = datetime.utcnow()
+        cached = self.cache.get(key)
+        if cached is None or cached.expires <= now:
+            row = db.session.query(OCSPResponse.response, OCSPResponse.next_update) \
+                .filter_by(ca_id=ca_id, serial_number=request.serial_number, hash_algorithm=request.hash_algorithm.name) \
+                .first()
+            if row is None or row.next_update <= now:
+                self.cache.pop(key)
+                return TRY_LATER
+            cached = CachedResponse(row.response, min(row.next_update, now + timedelta(seconds=current_app.config['OCSP_CACHE_TTL'])))
+            self.cache.set(key, cached)
+
+        return cached.response
+
+ocsp_responder = OCSPResponder()
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# ipsec-me (c) Henryk Plötz
+
+from concurrent.futures import ThreadPoolExecutor
+from flask_diamond.facets.database import db
+
+from .models.provisioning import ProvisioningJob
+
+
+class ProvisioningQueue(object):
+    """Executes :class:`ProvisioningJob` objects on a local pool of worker threads.
+
+    Jobs are passed by id, each worker loads them in its own application
+    context and database session. With ``workers=0`` jobs are executed
+    synchronously on submit, which is mostly useful for tests.
+    """
+
+    def __init__(self, app, workers):
+        self.app = app
+        self.workers = workers
+        self._executor = None
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    def submit(self, job):
+        if self.workers == 0:
+            return job.run()
+        return self.executor.submit(self._run, job.id)
+
+    def submit_pending(self):
+        "Resubmit all jobs that are still waiting, e.g. after a restart"
+        for job in ProvisioningJob.pending().all():
+            self.submit(job)
+
+    def _run(self, job_id):
+        with self.app.app_context():
+            try:
+                job = ProvisioningJob.find(id=job_id)
+                if job is not None:
+                    job.run()
+            finally:
+                db.session.remove()
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
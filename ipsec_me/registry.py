@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# ipsec-me (c) Henryk Plötz
+
+from collections import OrderedDict
+
+
+class DeviceRegistry(object):
+    """Device types with their setup templates and provisioning artifacts.
+
+    Device classes are registered when they are defined, artifact views when
+    the frontend is imported. resolve() then computes, once at startup, the
+    setup template of each class and the artifacts it supports, both
+    inherited along the class hierarchy. Device types registered later, e.g.
+    by plugins, are resolved immediately.
+    """
+
+    TEMPLATE = 'frontend/devices/{0}.html'
+    UNRESOLVED = (None, frozenset())
+
+    def __init__(self):
+        self._classes = OrderedDict()
+        self._artifacts = {}
+        self._templates = None
+        self._resolved = {}
+
+    def register(self, device_class):
+        "Register a device class by its DEVICE_TYPE"
+        self._classes[device_class.DEVICE_TYPE] = device_class
+        if self._templates is not None:
+            self._resolve(device_class)
+        return device_class
+
+    def register_artifact(self, device_class, name):
+        "Declare that device_class and its subclasses provide the artifact view name"
+        self._artifacts.setdefault(device_class, []).append(name)
+        if self._templates is not None:
+            for cls in self._classes.values():
+                self._resolve(cls)
+
+    def resolve(self, jinja_env):
+        "Resolve templates and artifacts of all registered classes, needs the application's template loader"
+        self._templates = set(jinja_env.list_templates())
+        self._resolved = {}
+        for device_class in self._classes.values():
+            self._resolve(device_class)
+
+    def _resolve(self, device_class):
+        mro = device_class.mro()
+        template = next((self.TEMPLATE.format(cls.__name__) for cls in mro
+            if self.TEMPLATE.format(cls.__name__) in self._templates), None)
+        artifacts = frozenset(name for cls in mro for name in self._artifacts.get(cls, []))
+        self._resolved[device_class] = (template, artifacts)
+
+    def device_class(self, device_type):
+        return self._classes.get(device_type)
+
+    def template(self, device_class):
+        "Name of the setup page template of device_class, None if there is none"
+        return self._resolved.get(device_class, self.UNRESOLVED)[0]
+
+    def artifacts(self, device_class):
+        return self._resolved.get(device_class, self.UNRESOLVED)[1]
+
+    def supports(self, device_class, name):
+        return name in self.artifacts(device_class)
+
+    def __iter__(self):
+        "Registered device classes, in order of registration"
+        return iter(self._classes.values())
+
+device_registry = DeviceRegistry()
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+# ipsec-me (c) Henryk Plötz
+
+from flask import current_app, request
+from flask_sqlalchemy import SignallingSession, connection_stack
+from flask_diamond.facets.database import db
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.orm import scoped_session, Session
+from werkzeug.http import parse_cookie
+from functools import partial
+from itertools import count
+import threading
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+READ_METHODS = ('GET', 'HEAD')
+
+## Set by the client after a request of theirs wrote, holds the time until which they read from the primary
+PIN_COOKIE = 'ipsec_me_primary'
+
+## Whether the request of this thread may read from a replica
+_routing = threading.local()
+
+def read_only(view):
+    "Mark a view whose GET and HEAD requests read from a replica, see REPLICA_URLS"
+    view.read_only = True
+    return view
+
+def engine_options(config, replica=False):
+    "create_engine() options for the primary or the replicas"
+    prefix = 'REPLICA_' if replica else 'SQLALCHEMY_'
+    options = {}
+    for option, key in (('pool_size', prefix + 'POOL_SIZE'), ('max_overflow', prefix + 'MAX_OVERFLOW'),
+            ('pool_timeout', 'SQLALCHEMY_POOL_TIMEOUT'), ('pool_recycle', 'SQLALCHEMY_POOL_RECYCLE')):
+        if config.get(key) is not None:
+            options[option] = config[key]
+    if config.get('SQLALCHEMY_POOL_PRE_PING'):
+        options['pool_pre_ping'] = True
+    return options
+
+
+class Replica(object):
+    def __init__(self, url, engine):
+        self.url = url
+        self.engine = engine
+        self.usable = True
+        self.checked_at = None
+
+class ReplicaRouter(object):
+    """Sends the queries of read-only requests to the read replicas.
+
+    GET and HEAD requests start out on a replica, so that the URL converters
+    read from it. Once the endpoint is known, only views marked with
+    :func:`read_only` stay there. Anything that flushes or locks rows goes to
+    the primary, and so does every query of the request after a flush. A
+    client whose request wrote reads from the primary for REPLICA_PIN_SECONDS,
+    so that they see their own changes despite replication lag. Lookups
+    that find nothing on a replica are tried again on the primary, see
+    :meth:`fallback`, for clients that didn't write themselves.
+
+    With a REPLICA_LAG_QUERY, replicas lagging more than REPLICA_MAX_LAG
+    seconds or failing the query are left out until the next check, every
+    REPLICA_CHECK_INTERVAL seconds. Without a usable replica everything goes
+    to the primary.
+    """
+
+    def __init__(self):
+        self.replicas = []
+        self._next = count()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        self.configure(app.config['REPLICA_URLS'])
+
+        # Pool settings for the primary engine that Flask-SQLAlchemy has no configuration for
+        apply_pool_defaults = db.apply_pool_defaults
+        def _apply_pool_defaults(app, options):
+            apply_pool_defaults(app, options)
+            options.update(engine_options(app.config))
+        db.apply_pool_defaults = _apply_pool_defaults
+
+        db.session = scoped_session(partial(RoutingSession, db), scopefunc=connection_stack.__ident_func__)
+
+        app.wsgi_app = self._middleware(app.wsgi_app)
+        app.before_request(self._start_request)
+        app.after_request(self._pin_writer)
+
+    def configure(self, urls):
+        for replica in self.replicas:
+            replica.engine.dispose()
+        self.replicas = [Replica(url, create_engine(url, **engine_options(self.app.config, replica=True))) for url in urls or ()]
+
+    def _middleware(self, wsgi_app):
+        def middleware(environ, start_response):
+            _routing.replica = bool(self.replicas) and environ['REQUEST_METHOD'] in READ_METHODS \
+                and not self._pinned(environ)
+            try:
+                return wsgi_app(environ, start_response)
+            finally:
+                _routing.replica = False
+        return middleware
+
+    def _pinned(self, environ):
+        try:
+            return float(parse_cookie(environ).get(PIN_COOKIE, 0)) > time.time()
+        except ValueError:
+            return False
+
+    def _start_request(self):
+        db.session().info.pop('wrote', None)
+        if getattr(_routing, 'replica', False):
+            view = current_app.view_functions.get(request.url_rule.endpoint) if request.url_rule else None
+            _routing.replica = getattr(view, 'read_only', False)
+
+    def _pin_writer(self, response):
+        if self.replicas and db.session().info.get('wrote'):
+            seconds = self.app.config['REPLICA_PIN_SECONDS']
+            response.set_cookie(PIN_COOKIE, str(int(time.time() + seconds)), max_age=seconds, httponly=True)
+        return response
+
+    def fallback(self, lookup):
+        "Result of lookup(), run again on the primary if it found nothing on a replica"
+        result = lookup()
+        if result is None and getattr(_routing, 'replica', False):
+            # Possibly not replicated yet, the rest of the request has to see it as well
+            _routing.replica = False
+            result = lookup()
+        return result
+
+    def engine(self):
+        "Engine of the next usable replica, None if there is none or the request must use the primary"
+        if not getattr(_routing, 'replica', False):
+            return None
+        for attempt in range(len(self.replicas)):
+            replica = self.replicas[next(self._next) % len(self.replicas)]
+            self._check(replica)
+            if replica.usable:
+                return replica.engine
+        return None
+
+    def _check(self, replica):
+        query = self.app.config['REPLICA_LAG_QUERY']
+        if query is None:
+            return
+        with self._lock:
+            now = time.time()
+            if replica.checked_at is not None and now - replica.checked_at < self.app.config['REPLICA_CHECK_INTERVAL']:
+                return
+            replica.checked_at = now
+
+        usable = replica.usable
+        try:
+            with replica.engine.connect() as connection:
+                lag = connection.scalar(text(query))
+            replica.usable = lag is not None and lag <= self.app.config['REPLICA_MAX_LAG']
+        except Exception as e:
+            logger.warning("Replica {0} failed: {1}".format(replica.engine.url, e))
+            replica.usable = False
+        if replica.usable != usable:
+            logger.warning("Replica {0} is {1}".format(replica.engine.url, "back" if replica.usable else "lagging, using the primary"))
+
+replica_router = ReplicaRouter()
+
+
+class RoutingSession(SignallingSession):
+    "Session that reads from a replica when replica_router allows it"
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and getattr(clause, '_for_update_arg', None) is None:
+            engine = replica_router.engine()
+            if engine is not None:
+                return engine
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+@event.listens_for(Session, 'after_flush')
+def _session_wrote(session, flush_context):
+    # Read your own writes: the rest of the request uses the primary
+    session.info['wrote'] = True
+    _routing.replica = False
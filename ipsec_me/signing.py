@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+# ipsec-me (c) Henryk Plötz
+
+from concurrent.futures import Future
+import multiprocessing
+from base64 import b64encode, b64decode
+import json
+import logging
+import os
+import queue
+import signal
+import socket
+import socketserver
+import struct
+import threading
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+
+from .models.keys import load_private_key, signature_hash
+
+logger = logging.getLogger(__name__)
+
+## Messages are JSON objects, each preceded by its length as a 32 bit big endian number
+_LENGTH = struct.Struct(">I")
+MAX_MESSAGE_SIZE = 1024*1024
+
+class SigningError(Exception):
+    pass
+
+def _send_message(sock, message):
+    data = json.dumps(message).encode("UTF-8")
+    sock.sendall(_LENGTH.pack(len(data)) + data)
+
+def _receive_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError
+        data += chunk
+    return data
+
+def _receive_message(sock):
+    size, = _LENGTH.unpack(_receive_exactly(sock, _LENGTH.size))
+    if size > MAX_MESSAGE_SIZE:
+        raise SigningError("Message of {0} bytes is too large".format(size))
+    return json.loads(_receive_exactly(sock, size).decode("UTF-8"))
+
+
+## Certificates and CRLs travel to the daemon signed with a throwaway key,
+## the daemon copies everything but the signature into a new builder and
+## signs that with the CA key. Parsing is the only way to get a builder's
+## contents across: cryptography has no serialization of unsigned builders.
+
+_placeholder_key = None
+
+def _placeholder_sign(builder):
+    global _placeholder_key
+    if _placeholder_key is None:
+        _placeholder_key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+    return builder.sign(_placeholder_key, hashes.SHA256(), default_backend()).public_bytes(serialization.Encoding.DER)
+
+def _certificate_builder(placeholder):
+    certificate = x509.load_der_x509_certificate(placeholder, default_backend())
+    return x509.CertificateBuilder(
+        issuer_name=certificate.issuer,
+        subject_name=certificate.subject,
+        public_key=certificate.public_key(),
+        serial_number=certificate.serial_number,
+        not_valid_before=certificate.not_valid_before,
+        not_valid_after=certificate.not_valid_after,
+        extensions=list(certificate.extensions),
+    )
+
+def _crl_builder(placeholder):
+    crl = x509.load_der_x509_crl(placeholder, default_backend())
+    return x509.CertificateRevocationListBuilder(
+        issuer_name=crl.issuer,
+        last_update=crl.last_update,
+        next_update=crl.next_update,
+        extensions=list(crl.extensions),
+        revoked_certificates=list(crl),
+    )
+
+BUILDERS = {
+    'certificate': _certificate_builder,
+    'crl': _crl_builder,
+}
+
+
+class RemoteSigner(object):
+    """Signs with the key of a CA certificate held by the signing daemon.
+
+    Has the interface of :class:`~ipsec_me.models.certificate.CertificateSigner`
+    except for the private key, see :meth:`Certificate.signer`. Each thread
+    keeps one connection to the daemon.
+    """
+
+    _local = threading.local()
+
+    def __init__(self, path, subject, fingerprint, timeout=None):
+        self.path = path
+        self.subject = subject
+        self.fingerprint = fingerprint
+        self.timeout = timeout
+
+    def _connection(self):
+        connections = self._local.__dict__.setdefault('connections', {})
+        sock = connections.get(self.path)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+            connections[self.path] = sock
+        return sock
+
+    def _close(self):
+        sock = self._local.__dict__.get('connections', {}).pop(self.path, None)
+        if sock is not None:
+            sock.close()
+
+    def _sign(self, kind, builder):
+        request = {'kind': kind, 'ca': self.fingerprint, 'tbs': b64encode(_placeholder_sign(builder)).decode("US-ASCII")}
+        for attempt in (1, 2):
+            try:
+                sock = self._connection()
+                _send_message(sock, request)
+                response = _receive_message(sock)
+                break
+            except (OSError, EOFError) as e:
+                # The daemon may have been restarted since the connection was opened
+                self._close()
+                if attempt == 2:
+                    raise SigningError("Signing daemon at {0} not available: {1}".format(self.path, e))
+
+        if 'error' in response:
+            raise SigningError(response['error'])
+        return b64decode(response['signed'])
+
+    def sign_certificate(self, cert_builder):
+        return x509.load_der_x509_certificate(self._sign('certificate', cert_builder.issuer_name(self.subject)), default_backend())
+
+    def sign_crl(self, crl_builder):
+        return x509.load_der_x509_crl(self._sign('crl', crl_builder), default_backend())
+
+
+## State of the pool processes of the daemon
+_keys = {}
+
+def _init_worker(keys):
+    _keys.update((fingerprint, load_private_key(key)) for fingerprint, key in keys.items())
+
+def _sign_batch(batch):
+    "Sign a list of requests in a pool process, returns a list of responses"
+    results = []
+    for request in batch:
+        try:
+            key = _keys.get(request['ca'])
+            if key is None:
+                raise SigningError("Unknown CA {0}".format(request['ca']))
+            builder = BUILDERS[request['kind']](b64decode(request['tbs']))
+            signed = builder.sign(key, signature_hash(key), default_backend())
+            results.append({'signed': b64encode(signed.public_bytes(serialization.Encoding.DER)).decode("US-ASCII")})
+        except Exception as e:
+            results.append({'error': "{0}: {1}".format(e.__class__.__name__, e)})
+    return results
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                request = _receive_message(self.request)
+            except (EOFError, OSError):
+                return
+            except (SigningError, ValueError) as e:
+                _send_message(self.request, {'error': str(e)})
+                return
+            _send_message(self.request, self.server.signing_daemon.submit(request).result())
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class SigningDaemon(object):
+    """Holds the CA private keys and signs for the web workers over a Unix socket.
+
+    Requests from all connections go through one queue and are handed to a
+    pool of worker processes in batches of up to batch_size, at most one
+    batch per worker at a time, so under load the batches grow and the
+    per-batch overhead shrinks. load_keys returns a dictionary CA certificate
+    fingerprint -> DER private key, it is called again when a request names
+    an unknown CA.
+    """
+
+    def __init__(self, path, load_keys, workers=None, batch_size=16):
+        self.path = path
+        self.load_keys = load_keys
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self._queue = queue.Queue()
+        self._slots = threading.Semaphore(self.workers)
+        self._lock = threading.Lock()
+        self._keys = {}
+        self._pool = None
+        self._server = None
+        self._dispatcher = None
+
+    def _start_pool(self):
+        "(Re)start the worker processes if the CA keys changed"
+        with self._lock:
+            keys = self.load_keys()
+            if self._pool is not None and keys == self._keys:
+                return
+            old, self._keys = self._pool, keys
+            self._pool = multiprocessing.Pool(self.workers, initializer=_init_worker, initargs=(keys,))
+        if old is not None:
+            # Batches already submitted still finish
+            old.close()
+        logger.info("Signing with the keys of {0} CAs in {1} processes".format(len(keys), self.workers))
+
+    def submit(self, request):
+        "Queue a request, returns a Future of the response"
+        if request.get('ca') not in self._keys:
+            self._start_pool()
+        result = Future()
+        self._queue.put((request, result))
+        return result
+
+    def _dispatch(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            self._slots.acquire()
+            batch = [item]
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                batch.append(item)
+
+            with self._lock:
+                self._pool.apply_async(_sign_batch, ([request for request, result in batch],),
+                    callback=lambda responses, batch=batch: self._done(batch, responses),
+                    error_callback=lambda e, batch=batch: self._done(batch, [{'error': "Signing failed: {0}".format(e)}] * len(batch)))
+
+    def _done(self, batch, responses):
+        self._slots.release()
+        for (request, result), response in zip(batch, responses):
+            result.set_result(response)
+
+    def start(self):
+        self._start_pool()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        # Only the user running the daemon may connect
+        umask = os.umask(0o077)
+        try:
+            self._server = _Server(self.path, _Handler)
+        finally:
+            os.umask(umask)
+        self._server.signing_daemon = self
+        self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self._dispatcher.start()
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def run(self):
+        "Serve until interrupted or terminated"
+        stopped = threading.Event()
+        signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+        self.start()
+        try:
+            while not stopped.wait(1):
+                pass
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._queue.put(None)
+        self._dispatcher.join()
+        self._pool.close()
+        self._pool.join()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
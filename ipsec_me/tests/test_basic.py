@@ -2,7 +2,18 @@
 # ipsec-me (c) Henryk Plötz
 
 from nose.plugins.attrib import attr
+from nose.plugins.skip import SkipTest
 from .mixins import DiamondTestCase
+from ..benchmark import summarize, compare
+from ..importtime import import_report
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 
 class BasicTestCase(DiamondTestCase):
@@ -13,3 +24,65 @@ class BasicTestCase(DiamondTestCase):
     @attr("skip")
     def test_skip(self):
         assert False
+
+
+class BenchmarkTestCase(DiamondTestCase):
+    def test_compare(self):
+        "benchmark results are summarized as percentiles and compared to a baseline"
+        stats = summarize([i / 1000.0 for i in range(1, 101)])
+        assert stats['iterations'] == 100
+        assert round(stats['p50']) == 50 and round(stats['p99']) == 99
+
+        baseline = {'benchmarks': {'a': stats, 'b': stats}}
+        results = {'benchmarks': {'a': dict(stats, p50=60.0), 'b': dict(stats, p50=70.0), 'c': stats}}
+        regressions = compare(results, baseline, tolerance=0.25)
+        assert len(regressions) == 1
+        assert regressions[0].startswith("b:")
+
+
+class CliProfileTestCase(DiamondTestCase):
+    "manage.py commands run with the cli profile, without the views"
+
+    def manage(self, *args):
+        "Run manage.py against a database of its own, returns its output"
+        env = dict(os.environ, SETTINGS=self.settings, SILENCE_DEPRECATION="1")
+        return subprocess.run([sys.executable, os.path.join("bin", "manage.py")] + list(args), cwd=ROOT, env=env,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, check=True).stdout
+
+    def setUp(self):
+        super(CliProfileTestCase, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.database = os.path.join(self.directory, "ipsec-me.db")
+        self.settings = os.path.join(self.directory, "settings.conf")
+        with open(os.environ['SETTINGS']) as f:
+            settings = f.read()
+        with open(self.settings, "w") as f:
+            f.write(settings)
+            f.write("\nSQLALCHEMY_DATABASE_URI = {0!r}\n".format("sqlite:///" + self.database))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(CliProfileTestCase, self).tearDown()
+
+    def test_model_commands(self):
+        "migrations and model commands work without blueprints and admin interface"
+        self.manage("init_db")
+        assert "(head)" in self.manage("db", "current")
+        self.manage("user_add", "-e", "cli@example.com", "-p", "a_password")
+        with sqlite3.connect(self.database) as connection:
+            assert connection.execute("SELECT count(*) FROM user WHERE email = 'cli@example.com'").fetchone() == (1,)
+
+    def test_import_report(self):
+        "the cli profile loads no views, the import report lists what it loads"
+        if sys.version_info < (3, 7):
+            raise SkipTest("import timing needs Python 3.7")
+        report = import_report(profile="cli")
+        names = [name for name, self_seconds, cumulative, level in report.modules]
+        assert "ipsec_me.models" in names
+        assert not [name for name in names if name.startswith("ipsec_me.views")]
+        assert report.import_seconds > 0 and report.create_app_seconds > 0
+        assert report.slowest()[0][1] >= report.slowest()[-1][1]
+        assert "ipsec_me" in dict(report.by_package())
+
+        names = [name for name, self_seconds, cumulative, level in import_report(profile="web").modules]
+        assert "ipsec_me.views.frontend" in names
@@ -2,8 +2,14 @@
 # ipsec-me (c) Henryk Plötz
 
 from nose.plugins.attrib import attr
-from ..models import User, DeviceBase
+from ..models import User, DeviceBase, VPNServer, PooledKey, CERTIFICATE_SETTINGS_IPSEC_DEVICE
+from ..models.keypool import keypool_key_types
+from ..keypool import KeyPoolFiller
+from ..models.utils import GUID, guid_columns, convert_guid_storage
 from .mixins import DiamondTestCase
+from .. import db
+from sqlalchemy.dialects import sqlite
+import uuid
 
 
 class UserTestCase(DiamondTestCase):
@@ -24,3 +30,64 @@ class DeviceBaseTestCase(DiamondTestCase):
         a = list(DeviceBase.all_subclasses())
         assert len(a) > 5
         assert "linux_deb" in [e.DEVICE_TYPE for e in a]
+
+class GUIDTestCase(DiamondTestCase):
+    "Coverage for the GUID column type"
+
+    def test_storage(self):
+        "GUIDs are stored as hex strings or raw bytes"
+        value, dialect = uuid.uuid4(), sqlite.dialect()
+
+        guid = GUID()
+        assert guid.process_bind_param(str(value), dialect) == value.hex
+        assert guid.process_result_value(value.hex, dialect) == value
+
+        guid.binary = True
+        assert guid.process_bind_param(value, dialect) == value.bytes
+        assert guid.process_result_value(value.bytes, dialect) == value
+        assert guid.load_dialect_impl(dialect).length == 16
+
+    def test_convert_storage(self):
+        "all GUID columns of the schema are converted between hex strings and raw bytes"
+        columns = set((t.name, c.name) for t, c in guid_columns(db.metadata))
+        assert {('certificate_authority', 'parent_id'), ('change_journal', 'device_id'), ('ocsp_response', 'ca_id')} <= columns
+
+        server_id = VPNServer.create(name="VPN", external_hostname="vpn.example.com").id
+        db.session.remove()
+        def stored():
+            with db.engine.connect() as connection:
+                return connection.execute("SELECT id FROM vpn_server").scalar()
+        try:
+            with db.engine.begin() as connection:
+                convert_guid_storage(connection, db.metadata, binary=True)
+            assert stored() == server_id.bytes
+            GUID.binary = True
+            assert VPNServer.find(name="VPN").certificate is not None
+            db.session.remove()
+        finally:
+            GUID.binary = False
+            with db.engine.begin() as connection:
+                convert_guid_storage(connection, db.metadata, binary=False)
+        assert stored() == server_id.hex
+        assert VPNServer.find(name="VPN").certificate is not None
+
+class KeyPoolTestCase(DiamondTestCase):
+    "Coverage for the pre-generated key pool"
+
+    def setUp(self):
+        super(KeyPoolTestCase, self).setUp()
+        self.app.config['KEYPOOL_DEPTH'] = 2
+
+    def test_fill_and_take(self):
+        "certificates use keys from the pool, falling back to inline generation"
+        key_type = keypool_key_types()[0]
+        assert KeyPoolFiller(workers=0).fill() == {key_type: 2}
+        assert PooledKey.depth() == {key_type: 2}
+        assert KeyPoolFiller(workers=0).fill() == {}
+
+        VPNServer.create(name="VPN", external_hostname="vpn.example.com")
+        assert PooledKey.depth() == {}
+        assert PooledKey.stats()[key_type]['drain_rate'] == 2
+
+        ca = VPNServer.query.first().CAs[0]
+        assert ca.create_child(CERTIFICATE_SETTINGS_IPSEC_DEVICE, rdn="CN=Fnord")
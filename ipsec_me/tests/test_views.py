@@ -2,7 +2,30 @@
 # ipsec-me (c) Henryk Plötz
 
 from nose.plugins.attrib import attr
+import re
+import uuid
+from ..models import VPNServer, User, CertificateStatus, AndroidStrongswanDevice, LinuxDebDevice, Ios10Device
+from ..registry import device_registry
+from ..provisioning import ProvisioningQueue
+from ..metrics import metrics
+from ..models.chain import chain_cache
+from ..replicas import replica_router, PIN_COOKIE
+from ..admission import issuance_limiter
+from sqlalchemy import event
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from base64 import b64encode, b64decode
+import flask
+import json
+import fcntl
+import os
+import shutil
+import tempfile
+from .. import db
+from datetime import datetime
 from .mixins import DiamondTestCase
+from .fixtures import typical_workflow
 
 
 class ViewTestCase(DiamondTestCase):
@@ -15,3 +38,273 @@ class ViewTestCase(DiamondTestCase):
         "ensure index is redirecting"
         rv = self.client.get('/')
         assert rv.status_code == 302
+
+
+class FrontendViewTestCase(DiamondTestCase):
+    def setUp(self):
+        super(FrontendViewTestCase, self).setUp()
+        typical_workflow()
+        self.client.post('/user/login', data={'email': 'guest@example.com', 'password': 'guest'})
+        self.vpn_server = VPNServer.query.first()
+
+    def test_dashboard(self):
+        "the index page lists the user's VPNs and devices"
+        self.vpn_server.find_user(User.find(email='guest@example.com')).add_device(name="Fnord", device_type="generic_psk_xauth")
+        rv = self.client.get('/')
+        assert rv.status_code == 200
+        assert self.vpn_server.name in rv.data.decode("UTF-8")
+        assert "Fnord" in rv.data.decode("UTF-8")
+
+    def test_device_registry(self):
+        "device types resolve to their class, setup template and artifacts"
+        assert device_registry.device_class("ios_10") is Ios10Device
+        assert device_registry.template(LinuxDebDevice) == 'frontend/devices/GenericUserCertificateDevice.html'
+        assert device_registry.template(Ios10Device) == 'frontend/devices/Ios10Device.html'
+        assert {'device_generic_pkcs12', 'device_android_strongswan_profile'} <= device_registry.artifacts(AndroidStrongswanDevice)
+        assert not device_registry.supports(AndroidStrongswanDevice, 'device_ios10_profile')
+
+        rv = self.client.get('/vpn/{0}/add_device'.format(self.vpn_server.id))
+        assert rv.status_code == 200
+        assert Ios10Device.__doc__ in rv.data.decode("UTF-8")
+
+    def test_crl(self):
+        "CRLs are served without login, with conditional GET"
+        ca = self.vpn_server.CAs[0]
+        self.client.get('/user/logout')
+        for path in ('/crl/{0}.crl', '/crl/{0}_delta.crl'):
+            rv = self.client.get(path.format(ca.id))
+            assert rv.status_code == 200
+            assert rv.mimetype == 'application/pkix-crl'
+
+            rv = self.client.get(path.format(ca.id), headers={'If-None-Match': rv.headers['ETag']})
+            assert rv.status_code == 304
+
+        rv = self.client.get('/crl/{0}.crl'.format(uuid.uuid4()))
+        assert rv.status_code == 404
+
+    def test_metrics(self):
+        "request and operation timings are exposed in the Prometheus text format"
+        metrics.clear()
+        self.vpn_server.find_user(User.find(email='guest@example.com')).add_device(name="Fnord", device_type="generic_user_certificate")
+        self.client.get('/')
+        rv = self.client.get('/metrics', environ_base={'REMOTE_ADDR': '127.0.0.1'})
+        assert rv.status_code == 200
+        data = rv.data.decode("UTF-8")
+        assert 'ipsec_me_request_duration_seconds_count{method="GET",route="/",status="200"} 1' in data
+        assert 'ipsec_me_request_queries_bucket{route="/",le="+Inf"} 1' in data
+        for operation in ("keygen", "sign", "query", "render"):
+            assert 'ipsec_me_operation_duration_seconds_count{{operation="{0}"}}'.format(operation) in data
+        assert 'ipsec_me_cache_hits_total{cache="certificate"}' in data
+
+        rv = self.client.get('/metrics', environ_base={'REMOTE_ADDR': '192.0.2.1'})
+        assert rv.status_code == 403
+        # Passed on by a reverse proxy on the same host
+        rv = self.client.get('/metrics', environ_base={'REMOTE_ADDR': '127.0.0.1'}, headers={'X-Forwarded-For': '192.0.2.1'})
+        assert rv.status_code == 403
+
+    def test_add_device_async(self):
+        "adding a device in asynchronous mode redirects through the job status page"
+        queue = self.app.extensions['provisioning']
+        self.app.config['PROVISIONING_ASYNC'] = True
+        self.app.extensions['provisioning'] = ProvisioningQueue(self.app, workers=0)
+        try:
+            rv = self.client.post('/vpn/{0}/add_device/generic_user_certificate'.format(self.vpn_server.id), data={'name': 'Fnord'})
+            assert rv.status_code == 302
+            assert '/job/' in rv.location
+
+            rv = self.client.get(rv.location)
+            assert rv.status_code == 302
+            assert '/device/' in rv.location
+        finally:
+            self.app.config['PROVISIONING_ASYNC'] = False
+            self.app.extensions['provisioning'] = queue
+
+    def test_provisioning_download(self):
+        "provisioning links from the device page resolve to the device certificate"
+        d = self.vpn_server.find_user(User.find(email='guest@example.com')).add_device(name="Fnord", device_type="generic_user_certificate")
+        rv = self.client.get('/vpn/{0}/device/{1}'.format(self.vpn_server.id, d.id))
+        assert rv.status_code == 200
+
+        link = re.search(r'href="([^"]*_cert\.pem)"', rv.data.decode("UTF-8")).group(1)
+        rv = self.client.get(link)
+        assert rv.status_code == 200
+        assert rv.data == d.certificate.get_cert_pem()
+
+        rv = self.client.get(link.replace('.', 'x', 1))
+        assert rv.status_code == 404
+
+    def test_provisioning_conditional_get(self):
+        "provisioning payloads carry an ETag and are answered with 304 when unchanged"
+        d = self.vpn_server.find_user(User.find(email='guest@example.com')).add_device(name="Fnord", device_type="ios_10")
+        rv = self.client.get('/vpn/{0}/device/{1}'.format(self.vpn_server.id, d.id))
+        link = re.search(r'href="([^"]*\.mobileconfig)"', rv.data.decode("UTF-8")).group(1)
+
+        rv = self.client.get(link)
+        assert rv.status_code == 200
+        etag = rv.headers['ETag']
+        assert rv.headers['Last-Modified']
+
+        rv = self.client.get(link)
+        assert rv.headers['ETag'] == etag
+
+        rv = self.client.get(link, headers={'If-None-Match': etag})
+        assert rv.status_code == 304
+        assert not rv.data
+
+        d.certificate.status = CertificateStatus.REVOKED
+        rv = self.client.get(link, headers={'If-None-Match': etag})
+        assert rv.status_code == 200
+
+    def test_provisioning_payload_changed_elsewhere(self):
+        "payloads follow changes to the VPN server made by other processes"
+        d = self.vpn_server.find_user(User.find(email='guest@example.com')).add_device(name="Fnord", device_type="android_strongswan")
+        rv = self.client.get('/vpn/{0}/device/{1}'.format(self.vpn_server.id, d.id))
+        link = re.search(r'href="([^"]*\.sswan)"', rv.data.decode("UTF-8")).group(1)
+        rv = self.client.get(link)
+        assert json.loads(rv.data.decode("UTF-8"))['name'] == self.vpn_server.name
+
+        # Another process knows nothing of this one's caches
+        with db.engine.begin() as connection:
+            connection.execute(VPNServer.__table__.update().where(VPNServer.__table__.c.id == self.vpn_server.id)
+                .values(name="Renamed VPN", updated_at=datetime.utcnow()))
+        db.session.expire_all()
+        rv = self.client.get(link)
+        assert json.loads(rv.data.decode("UTF-8"))['name'] == "Renamed VPN"
+
+    def test_certificate_chain(self):
+        "provisioning payloads carry the chain of the device certificate up to the root"
+        from OpenSSL import crypto as crypto_openssl
+        v = VPNServer.create(name="Chain VPN", external_hostname="chain.example.com", intermediate_CAs=2)
+        vu = v.add_user(User.find(email='guest@example.com'))
+        root = [ca for ca in v.CAs if ca.parent is None][0]
+        root_der = root.certificate.certificate
+
+        chain_cache.clear()
+        d = vu.add_device(name="Phone", device_type="android_strongswan")
+        issuer = d.issuing_ca()
+        assert issuer.parent is root
+        with self.app.test_request_context():
+            urls = dict((endpoint, flask.url_for('frontend_blueprint.' + endpoint, device=d))
+                for endpoint in ('device_generic_ca', 'device_generic_pkcs12', 'device_android_strongswan_profile'))
+
+        rv = self.client.get(urls['device_generic_ca'])
+        assert rv.status_code == 200
+        pem = rv.data.split(b"-----END CERTIFICATE-----")
+        assert [x509.load_pem_x509_certificate(c + b"-----END CERTIFICATE-----", default_backend()).public_bytes(serialization.Encoding.DER)
+            for c in pem[:-1]] == [issuer.certificate.certificate, root_der]
+
+        rv = self.client.get(urls['device_generic_pkcs12'])
+        p12 = crypto_openssl.load_pkcs12(rv.data, b"")
+        assert len(p12.get_ca_certificates()) == 2
+
+        rv = self.client.get(urls['device_android_strongswan_profile'])
+        profile = json.loads(rv.data.decode("UTF-8"))
+        assert b64decode(profile['remote']['cert']) == root_der
+
+        # Later payloads reuse the cached chain
+        hits = chain_cache.hits
+        assert d.chain_bundle() is issuer.chain_bundle()
+        assert chain_cache.hits == hits + 2
+
+        e = vu.add_device(name="Tablet", device_type="ios_10")
+        with self.app.test_request_context():
+            url = flask.url_for('frontend_blueprint.device_ios10_profile', device=e)
+        rv = self.client.get(url)
+        assert rv.status_code == 200
+        data = rv.data.decode("UTF-8")
+        assert b64encode(root_der).decode("US-ASCII") in data
+        assert "com.apple.security.pkcs1" in data
+
+    def test_read_replica(self):
+        "read-only views read from a replica, writes and the writer's next requests use the primary"
+        statements = []
+        replica_router.configure([self.app.config['SQLALCHEMY_DATABASE_URI']])
+        event.listen(replica_router.replicas[0].engine, 'before_cursor_execute',
+            lambda conn, cursor, statement, *args: statements.append(statement))
+        try:
+            rv = self.client.get('/')
+            assert rv.status_code == 200
+            assert statements
+            assert PIN_COOKIE not in rv.headers.get('Set-Cookie', '')
+
+            del statements[:]
+            rv = self.client.post('/vpn/{0}/add_device/generic_user_certificate'.format(self.vpn_server.id), data={'name': 'Fnord'})
+            assert rv.status_code == 302
+            assert not [statement for statement in statements if not statement.startswith('SELECT')]
+            assert PIN_COOKIE in rv.headers['Set-Cookie']
+
+            del statements[:]
+            rv = self.client.get(rv.location)
+            assert rv.status_code == 200
+            assert not statements
+
+            self.client.set_cookie('localhost', PIN_COOKIE, '0')
+            self.app.config['REPLICA_LAG_QUERY'] = "SELECT 100"
+            rv = self.client.get('/')
+            assert rv.status_code == 200
+            assert statements == ["SELECT 100"]
+        finally:
+            self.app.config['REPLICA_LAG_QUERY'] = None
+            replica_router.configure(())
+
+    def test_read_replica_fallback(self):
+        "devices not replicated yet are looked up on the primary instead of answering 404"
+        directory = tempfile.mkdtemp()
+        replica_router.configure(["sqlite:///" + os.path.join(directory, "replica.db")])
+        # A replica that lags behind everything
+        db.metadata.create_all(replica_router.replicas[0].engine)
+        try:
+            d = self.vpn_server.find_user(User.find(email='guest@example.com')).add_device(name="Fnord", device_type="generic_user_certificate")
+            with self.app.test_request_context():
+                url = flask.url_for('frontend_blueprint.device_generic_pkcs12', device=d)
+            rv = self.client.get(url)
+            assert rv.status_code == 200
+            assert PIN_COOKIE not in rv.headers.get('Set-Cookie', '')
+
+            d.delete()
+            assert self.client.get(url).status_code == 404
+        finally:
+            replica_router.configure(())
+            shutil.rmtree(directory)
+
+    def test_issuance_admission(self):
+        "adding a device is refused with 503 and Retry-After while issuance is saturated, other pages are served"
+        path = '/vpn/{0}/add_device/generic_user_certificate'.format(self.vpn_server.id)
+        lock_dir = tempfile.mkdtemp()
+        saved = {key: self.app.config[key] for key in ('ISSUANCE_MAX_QUEUE', 'ISSUANCE_GLOBAL_PERMITS', 'ISSUANCE_LOCK_DIR', 'ISSUANCE_QUEUE_TIMEOUT')}
+        try:
+            self.app.config['ISSUANCE_MAX_QUEUE'] = 0
+            rv = self.client.post(path, data={'name': 'Fnord'})
+            assert rv.status_code == 503
+            assert rv.headers['Retry-After'] == str(self.app.config['ISSUANCE_RETRY_AFTER'])
+            assert self.client.get('/').status_code == 200
+            rv = self.client.get('/metrics', environ_base={'REMOTE_ADDR': '127.0.0.1'})
+            assert 'ipsec_me_issuance_rejected_total 1' in rv.data.decode("UTF-8")
+
+            # Another process holds the only global permit
+            self.app.config.update(ISSUANCE_MAX_QUEUE=16, ISSUANCE_GLOBAL_PERMITS=1, ISSUANCE_LOCK_DIR=lock_dir, ISSUANCE_QUEUE_TIMEOUT=0)
+            issuance_limiter.init_app(self.app)
+            # Nothing is written or locked, e.g. a serial number lease, while a request waits for its permit
+            statements, writes_before_permit = [], []
+            def record(conn, cursor, statement, *args):
+                statements.append(statement)
+            admit = issuance_limiter.admit
+            def recording_admit():
+                writes_before_permit.extend(s for s in statements if not s.startswith(('SELECT', 'PRAGMA')))
+                admit()
+            issuance_limiter.admit = recording_admit
+            event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                with open(os.path.join(lock_dir, "permit-0.lock"), "a") as lock_file:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                    assert self.client.post(path, data={'name': 'Fnord'}).status_code == 503
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record)
+                del issuance_limiter.admit
+            assert statements and not writes_before_permit, writes_before_permit
+            assert self.client.post(path, data={'name': 'Fnord'}).status_code == 302
+        finally:
+            self.app.config.update(saved)
+            issuance_limiter.init_app(self.app)
+            issuance_limiter.rejected = 0
+            shutil.rmtree(lock_dir)
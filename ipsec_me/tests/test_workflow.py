@@ -2,7 +2,30 @@
 # ipsec-me (c) Henryk Plötz
 
 from nose.plugins.attrib import attr
-from ..models import User, VPNServer
+from hashlib import sha256
+from ..models import CertificateStatus, User, UserType, VPNServer, VPNUser, ProvisioningJob, JobStatus, ChangeJournal, Certificate, CertificateAuthority, CASelection, GenericUserCertificateDevice, CERTIFICATE_SETTINGS_IPSEC_DEVICE
+from ..models.serial import serial_number_allocator
+from ..models.revocation import PublishedCRL, crl_engine
+from ..models.keys import KEY_TYPE_EC_P384, KEY_TYPE_ED25519
+from ..models.certificate import parsed_cache
+from ..models import certificate as certificate_module
+from ..provisioning import ProvisioningQueue
+from ..ocsp import OCSPRefresher, ocsp_responder
+from ..export import StrongSwanExporter, stream_ipsec_secrets
+from ..signing import SigningDaemon, RemoteSigner
+from .. import db
+from sqlalchemy import event
+from cryptography import x509
+from cryptography.x509 import ocsp
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.backends import default_backend
+from datetime import datetime, timedelta
+from base64 import b64encode
+from urllib.parse import quote
+import tempfile
+import shutil
+import os
 from .mixins import DiamondTestCase
 from .fixtures import typical_workflow
 
@@ -50,3 +73,475 @@ class WorkflowTestCase(DiamondTestCase):
         assert d.certificate.certificate
         assert d.certificate.private_key
 
+
+    def test_provisioning_job(self):
+        "create device through a provisioning job"
+        u = User.find(email='guest@example.com')
+        vu = u.vpns[0]
+
+        job = ProvisioningJob.create(vpn_user=vu, name="Fnord", device_type="generic_user_certificate")
+        assert job.status is JobStatus.PENDING
+        ProvisioningQueue(self.app, workers=0).submit(job)
+
+        job = ProvisioningJob.find(id=job.id)
+        assert job.status is JobStatus.DONE
+        assert job.device.certificate
+        assert job.device.vpn_user is vu
+
+    def test_provisioning_job_takeover(self):
+        "jobs whose worker died while RUNNING are run again after PROVISIONING_JOB_TIMEOUT"
+        vu = User.find(email='guest@example.com').vpns[0]
+        job = ProvisioningJob.create(vpn_user=vu, name="Fnord", device_type="generic_user_certificate")
+        assert job.claim()
+        assert not job.stale
+        assert job not in ProvisioningJob.pending().all()
+
+        job.update(claimed_at=job.claimed_at - timedelta(seconds=self.app.config['PROVISIONING_JOB_TIMEOUT'] + 1))
+        assert job.stale
+        assert job in ProvisioningJob.pending().all()
+        ProvisioningQueue(self.app, workers=0).submit_pending()
+
+        job = ProvisioningJob.find(id=job.id)
+        assert job.status is JobStatus.DONE
+        assert job.device.vpn_user is vu
+
+        # Queued in a process that is gone
+        job = ProvisioningJob.create(vpn_user=vu, name="Bar", device_type="generic_user_certificate")
+        assert not job.stale
+        job.update(created_at=job.created_at - timedelta(seconds=self.app.config['PROVISIONING_QUEUE_TIMEOUT'] + 1))
+        assert job.stale
+
+    def test_provisioning_job_atomic(self):
+        "a worker dying before a job is DONE leaves no device behind for the takeover to duplicate"
+        vu = User.find(email='guest@example.com').vpns[0]
+        devices = vu.devices.count()
+        job = ProvisioningJob.create(vpn_user=vu, name="Fnord", device_type="generic_user_certificate")
+        def die():
+            raise SystemExit
+        job.save = die
+        try:
+            job.run()
+        except SystemExit:
+            db.session.rollback()
+
+        job = ProvisioningJob.find(id=job.id)
+        assert job.status is JobStatus.RUNNING
+        assert vu.devices.count() == devices
+
+    def test_create_children(self):
+        "issue many certificates at once"
+        ca = VPNServer.query.first().CAs[0]
+        next_serial_number = ca.next_serial_number
+
+        children = ca.create_children([
+            dict(settings=CERTIFICATE_SETTINGS_IPSEC_DEVICE, extras={'user_emails': ['user{0}@example.com'.format(i)]})
+            for i in range(3)
+        ])
+        assert len(children) == 3
+        assert ca.next_serial_number == next_serial_number + 3
+        assert [c._certificate.serial_number for c in children] == list(range(next_serial_number, next_serial_number + 3))
+        assert children[1]._certificate.issuer == ca.certificate._certificate.subject
+        assert Certificate.query.count() == 5
+
+    def test_serial_number_lease(self):
+        "serial numbers are leased in ranges, uncommitted leases are forgotten"
+        ca = VPNServer.query.first().CAs[0]
+        lease_size = self.app.config['SERIAL_NUMBER_LEASE_SIZE']
+        self.app.config['SERIAL_NUMBER_LEASE_SIZE'] = 10
+        try:
+            serial_number_allocator.release_all()
+            first = ca.next_serial_number
+            db.session.commit()
+
+            assert ca.get_next_serial_number() == first
+            db.session.rollback()
+            assert ca.next_serial_number == first
+
+            assert ca.get_next_serial_number() == first
+            db.session.commit()
+            assert ca.next_serial_number == first + 10
+
+            assert ca.get_next_serial_number() == first + 1
+            assert ca.get_next_serial_number() == first + 2
+            assert ca.next_serial_number == first + 10
+
+            serial_number_allocator.release_all()
+            assert ca.next_serial_number == first + 3
+        finally:
+            self.app.config['SERIAL_NUMBER_LEASE_SIZE'] = lease_size
+
+    def test_parsed_cache(self):
+        "parsed certificates are cached until the blob changes"
+        certificate = VPNServer.query.first().CAs[0].certificate
+        parsed_cache.clear()
+
+        misses = parsed_cache.misses
+        first = certificate._certificate
+        assert certificate._certificate is first
+        assert parsed_cache.misses == misses + 1
+
+        other = VPNServer.query.first().certificate
+        certificate.certificate = other.certificate
+        assert len(parsed_cache) == 0
+        assert certificate._certificate == other._certificate
+
+    def test_vpn_membership(self):
+        "members are found by lookup and added in bulk, once per VPN"
+        v = VPNServer.query.first()
+        guest, admin = User.find(email='guest@example.com'), User.find(email='admin@example.com')
+        assert v.find_user(guest).user == guest
+        assert v.find_user(admin) is None
+
+        users = v.add_users([guest, admin], user_type=UserType.ADMIN)
+        assert [vu.user for vu in users] == [guest, admin]
+        assert v.users.count() == 2
+        assert v.find_user(guest).user_type == UserType.ADMIN
+        assert v.add_user(admin, user_type=UserType.ADMIN) is users[1]
+
+    def test_vpn_membership_race(self):
+        "a member added concurrently gets the requested type, the caller's other changes are kept"
+        v = VPNServer.query.first()
+        guest = User.find(email='guest@example.com')
+        v.name = "Renamed"
+        # Not found by the lookup, as if added by another request right after it
+        find_user = v.find_user
+        v.find_user = lambda user, calls=[]: calls.append(user) or (find_user(user) if len(calls) > 1 else None)
+
+        vu = v.add_user(guest, user_type=UserType.ADMIN)
+        del v.find_user
+        assert vu.user == guest and vu.user_type == UserType.ADMIN
+        db.session.remove()
+        v = VPNServer.query.first()
+        assert v.name == "Renamed"
+        assert v.find_user(guest).user_type == UserType.ADMIN
+
+    def test_revocation_lists(self):
+        "revocations show up in the delta CRL at once and in the next full CRL"
+        u = User.find(email='guest@example.com')
+        self.app.config['CRL_BASE_URL'] = "http://vpn.example.com/"
+        try:
+            d = u.vpns[0].add_device(name="Fnord", device_type="generic_user_certificate")
+        finally:
+            self.app.config['CRL_BASE_URL'] = None
+        ca = u.vpns[0].vpn_server.CAs[0]
+        cdp = d.certificate._certificate.extensions.get_extension_for_class(x509.CRLDistributionPoints)
+        assert cdp.value[0].full_name[0].value == "http://vpn.example.com/crl/{0}.crl".format(ca.id)
+
+        full = x509.load_der_x509_crl(ca.get_crl().der, default_backend())
+        assert len(full) == 0
+        full_number = ca.get_crl().crl_number
+        serial_number = d.certificate._certificate.serial_number
+
+        d.revoke(reason=x509.ReasonFlags.key_compromise)
+        assert d.certificate.status is CertificateStatus.REVOKED
+        assert ca.get_crl().crl_number == full_number
+
+        delta = x509.load_der_x509_crl(ca.get_delta_crl().der, default_backend())
+        assert delta.extensions.get_extension_for_class(x509.DeltaCRLIndicator).value.crl_number == full_number
+        delta_number = delta.extensions.get_extension_for_class(x509.CRLNumber).value.crl_number
+        assert delta_number == ca.get_delta_crl().crl_number > full_number
+        revoked = delta.get_revoked_certificate_by_serial_number(serial_number)
+        assert revoked.extensions.get_extension_for_class(x509.CRLReason).value.reason is x509.ReasonFlags.key_compromise
+        assert delta.is_signature_valid(ca.certificate._certificate.public_key())
+
+        # Serving CRLs doesn't sign anything, the refresher does
+        assert crl_engine.refresh(ca) == 0
+        PublishedCRL.query.filter_by(ca_id=ca.id, delta=True).one().next_update = datetime.utcnow()
+        db.session.commit()
+        assert crl_engine.refresh(ca) == 1
+        resigned_number = ca.get_delta_crl().crl_number
+        assert resigned_number > delta_number
+
+        ca.crl_base_at -= timedelta(seconds=self.app.config['CRL_FULL_INTERVAL'])
+        db.session.commit()
+        assert crl_engine.refresh(ca) == 2
+        full = x509.load_der_x509_crl(ca.get_crl().der, default_backend())
+        new_full_number = full.extensions.get_extension_for_class(x509.CRLNumber).value.crl_number
+        assert ca.get_delta_crl().crl_number > new_full_number > resigned_number
+        assert full.get_revoked_certificate_by_serial_number(serial_number) is not None
+        delta = x509.load_der_x509_crl(ca.get_delta_crl().der, default_backend())
+        assert len(delta) == 0
+        assert delta.extensions.get_extension_for_class(x509.DeltaCRLIndicator).value.crl_number == new_full_number
+
+        assert d.revoke().crl_number == 1
+
+    def test_revocation_rollback(self):
+        "a revocation that is rolled back doesn't show up in later CRLs"
+        u = User.find(email='guest@example.com')
+        first = u.vpns[0].add_device(name="Fnord", device_type="generic_user_certificate")
+        second = u.vpns[0].add_device(name="Bar", device_type="generic_user_certificate")
+        ca = u.vpns[0].vpn_server.CAs[0]
+
+        ca.revoke(first.certificate, _commit=False)
+        db.session.rollback()
+        second.revoke()
+
+        delta = x509.load_der_x509_crl(ca.get_delta_crl().der, default_backend())
+        assert delta.get_revoked_certificate_by_serial_number(first.certificate._certificate.serial_number) is None
+        assert delta.get_revoked_certificate_by_serial_number(second.certificate._certificate.serial_number) is not None
+
+    def test_certificate_metadata(self):
+        "certificates are found by serial number and expiry without parsing them"
+        u = User.find(email='guest@example.com')
+        ca = u.vpns[0].vpn_server.CAs[0]
+        d = u.vpns[0].add_device(name="Fnord", device_type="generic_user_certificate",
+            certificate=ca.create_child(settings=CERTIFICATE_SETTINGS_IPSEC_DEVICE, extras={
+                'user_emails': ['guest@example.com'], 'not_valid_after': datetime.utcnow() + timedelta(days=10)}))
+        cert = d.certificate._certificate
+        assert d.certificate.subject_dn == "CN=guest@example.com"
+        assert d.certificate.issuer_dn == ca.certificate.subject_dn
+        assert d.certificate.not_after == cert.not_valid_after
+        assert d.certificate.key_algorithm == ca.child_key_type
+        assert ca.issued(d.certificate)
+
+        db.session.expire_all()
+        assert Certificate.find_by_serial(cert.serial_number, issuer_dn=ca.certificate.subject_dn) == [d.certificate]
+        assert Certificate.expiring(datetime.utcnow() + timedelta(days=30)).all() == [d.certificate]
+
+    def test_signing_daemon(self):
+        "certificates and CRLs are signed by the daemon holding the CA keys"
+        u = User.find(email='guest@example.com')
+        ca = u.vpns[0].vpn_server.CAs[0]
+        keys = CertificateAuthority.signing_keys()
+        assert list(keys) == [ca.certificate.fingerprint]
+        directory = tempfile.mkdtemp()
+        daemon = SigningDaemon(os.path.join(directory, "signing.sock"), lambda: keys, workers=1)
+        daemon.start()
+        self.app.config['SIGNING_SOCKET'] = daemon.path
+        try:
+            assert isinstance(ca.certificate.signer(), RemoteSigner)
+            d = u.vpns[0].add_device(name="Fnord", device_type="generic_user_certificate")
+            d.revoke()
+            crl = x509.load_der_x509_crl(ca.get_delta_crl().der, default_backend())
+        finally:
+            self.app.config['SIGNING_SOCKET'] = None
+            daemon.stop()
+            shutil.rmtree(directory)
+
+        cert = d.certificate._certificate
+        assert ca.issued(d.certificate)
+        ca.certificate._certificate.public_key().verify(cert.signature, cert.tbs_certificate_bytes,
+            padding.PKCS1v15(), cert.signature_hash_algorithm)
+        assert cert.extensions.get_extension_for_class(x509.SubjectAlternativeName).value.get_values_for_type(x509.RFC822Name) == ['guest@example.com']
+        assert crl.is_signature_valid(ca.certificate._certificate.public_key())
+        assert crl.get_revoked_certificate_by_serial_number(cert.serial_number) is not None
+
+    def test_ocsp(self):
+        "OCSP requests are answered from responses signed ahead of time"
+        u = User.find(email='guest@example.com')
+        d = u.vpns[0].add_device(name="Fnord", device_type="generic_user_certificate")
+        ca = u.vpns[0].vpn_server.CAs[0]
+        request = ocsp.OCSPRequestBuilder().add_certificate(d.certificate._certificate,
+            ca.certificate._certificate, hashes.SHA1()).build().public_bytes(serialization.Encoding.DER)
+        def status():
+            rv = self.client.post('/ocsp', data=request, content_type='application/ocsp-request')
+            assert rv.mimetype == 'application/ocsp-response'
+            response = ocsp.load_der_ocsp_response(rv.data)
+            if response.response_status is ocsp.OCSPResponseStatus.SUCCESSFUL:
+                return response.certificate_status
+            return response.response_status
+
+        ocsp_responder.clear()
+        assert status() is ocsp.OCSPResponseStatus.TRY_LATER
+        assert OCSPRefresher().refresh() == 4 # server and device, SHA-1 and SHA-256
+        assert OCSPRefresher().refresh() == 0
+        assert status() is ocsp.OCSPCertStatus.GOOD
+
+        d.revoke()
+        ocsp_responder.clear()
+        assert status() is ocsp.OCSPResponseStatus.TRY_LATER
+        assert OCSPRefresher().refresh() == 2
+        assert status() is ocsp.OCSPCertStatus.REVOKED
+
+    def test_ocsp_get(self):
+        "OCSP requests in the URL are answered with the CertID hash algorithm of the request"
+        u = User.find(email='guest@example.com')
+        d = u.vpns[0].add_device(name="Fnord", device_type="generic_user_certificate")
+        ca = u.vpns[0].vpn_server.CAs[0]
+        ocsp_responder.clear()
+        OCSPRefresher().refresh()
+
+        for algorithm in (hashes.SHA1, hashes.SHA256):
+            request = ocsp.OCSPRequestBuilder().add_certificate(d.certificate._certificate,
+                ca.certificate._certificate, algorithm()).build().public_bytes(serialization.Encoding.DER)
+            rv = self.client.get('/ocsp/' + quote(b64encode(request).decode("US-ASCII"), safe=''))
+            assert rv.status_code == 200
+            response = ocsp.load_der_ocsp_response(rv.data)
+            assert response.response_status is ocsp.OCSPResponseStatus.SUCCESSFUL
+            assert response.certificate_status is ocsp.OCSPCertStatus.GOOD
+            assert isinstance(response.hash_algorithm, algorithm)
+            assert response.serial_number == d.certificate._certificate.serial_number
+
+        request = ocsp.OCSPRequestBuilder().add_certificate(d.certificate._certificate,
+            ca.certificate._certificate, hashes.SHA512()).build().public_bytes(serialization.Encoding.DER)
+        rv = self.client.get('/ocsp/' + quote(b64encode(request).decode("US-ASCII"), safe=''))
+        assert ocsp.load_der_ocsp_response(rv.data).response_status is ocsp.OCSPResponseStatus.UNAUTHORIZED
+
+    def test_strongswan_export(self):
+        "gateway exports rewrite only what changed since the last export"
+        u = User.find(email='guest@example.com')
+        vu = u.vpns[0]
+        first = vu.add_device(name="Fnord", device_type="generic_psk_xauth")
+        directory = tempfile.mkdtemp()
+        overlap = self.app.config['EXPORT_OVERLAP']
+        # Only what changed after the previous export, to count the files written
+        self.app.config['EXPORT_OVERLAP'] = 0
+        try:
+            exporter = StrongSwanExporter(vu.vpn_server, directory)
+            assert exporter.export()
+            assert exporter.written == 7 # conf, secrets, CA, server cert and key, device, state
+            with open(os.path.join(directory, "ipsec.secrets")) as f:
+                assert vu.vpn_server.psk in f.read()
+
+            second = vu.add_device(name="Bar", device_type="android_native")
+            vu.add_device(name="Baz", device_type="generic_user_certificate")
+            exporter = StrongSwanExporter(vu.vpn_server, directory)
+            assert not exporter.export()
+            assert exporter.written == 2 # Bar and state
+            with open(os.path.join(directory, "ipsec.secrets.d", "{0}.secrets".format(second.id))) as f:
+                assert second.password in f.read()
+
+            first.delete()
+            before = datetime.utcnow()
+            exporter = StrongSwanExporter(vu.vpn_server, directory)
+            exporter.export()
+            assert (exporter.written, exporter.removed) == (1, 1)
+            assert sorted(os.listdir(os.path.join(directory, "ipsec.secrets.d"))) == ["{0}.secrets".format(second.id)]
+
+            assert "".join(stream_ipsec_secrets(vu.vpn_server)).count("XAUTH") == 1
+
+            # An entry that got its id before the last export but committed after it
+            self.app.config['EXPORT_OVERLAP'] = overlap
+            late = vu.add_device(name="Late", device_type="generic_psk_xauth")
+            head = ChangeJournal.head(vu.vpn_server.id)
+            with db.engine.begin() as connection:
+                connection.execute(ChangeJournal.__table__.update()
+                    .where(ChangeJournal.id == head).values(id=0, changed_at=before))
+            exporter = StrongSwanExporter(vu.vpn_server, directory)
+            exporter.export()
+            assert os.path.exists(os.path.join(directory, "ipsec.secrets.d", "{0}.secrets".format(late.id)))
+
+            # Entries missed during a longer pause may have been pruned
+            assert ChangeJournal.prune(datetime.utcnow() + timedelta(seconds=1)) > 0
+            assert ChangeJournal.head(vu.vpn_server.id) == 0
+            last_id, last_at = exporter.last_exported()
+            with open(os.path.join(directory, ".ipsec-me-export"), "w") as f:
+                f.write("{0} {1:%Y-%m-%dT%H:%M:%S.%f}\n".format(last_id, last_at - timedelta(seconds=self.app.config['JOURNAL_RETENTION'])))
+            assert StrongSwanExporter(vu.vpn_server, directory).export()
+        finally:
+            self.app.config['EXPORT_OVERLAP'] = overlap
+            shutil.rmtree(directory)
+
+    def test_dashboard(self):
+        "the dashboard of a user is loaded with a constant number of queries"
+        u = User.find(email='guest@example.com')
+        for name in ("Fnord", "Bar"):
+            u.vpns[0].add_device(name=name, device_type="generic_psk_xauth")
+        v = VPNServer.create(name="Another VPN", external_hostname="another.example.com")
+        v.add_user(u).add_device(name="Baz", device_type="generic_psk_xauth")
+        db.session.expunge_all()
+
+        statements = []
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            dashboard = VPNUser.dashboard(User.find(email='guest@example.com'))
+            names = [(vu.vpn_server.name, [d.name for d in devices]) for vu, devices in dashboard]
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+
+        assert names == [("Another VPN", ["Baz"]), ("VPN CA 1", ["Bar", "Fnord"])]
+        assert len(statements) == 3 # the user, memberships with servers, devices
+
+    def test_device_secure_lookup(self):
+        "devices are found by id and certificate fingerprint"
+        u = User.find(email='guest@example.com')
+        d = u.vpns[0].add_device(name="Fnord", device_type="generic_user_certificate")
+
+        assert d.certificate.fingerprint == sha256(d.certificate.certificate).hexdigest()
+        assert GenericUserCertificateDevice.find_by_fingerprint(id=d.id, fingerprint=d.certificate.fingerprint) is d
+        assert GenericUserCertificateDevice.find_by_fingerprint(id=d.id, fingerprint="0"*64) is None
+
+    def test_issuance_without_subprocess(self):
+        "creating a certificate never runs openssl, rendering happens in-process on demand"
+        def fail(*args, **kwargs):
+            raise AssertionError("subprocess started")
+
+        run = certificate_module.run
+        certificate_module.run = fail
+        try:
+            ca = VPNServer.query.first().CAs[0]
+            c = ca.create_child(CERTIFICATE_SETTINGS_IPSEC_DEVICE, rdn="CN=Fnord")
+            assert "tbsCertificate" in c.prettyPrint()
+        finally:
+            certificate_module.run = run
+
+    def test_key_types(self):
+        "CAs and device classes select the key type of new certificates"
+        u = User.find(email='guest@example.com')
+        v = VPNServer.create(name="EC VPN", external_hostname="ec.example.com",
+            CA_params={'key_type': KEY_TYPE_EC_P384})
+        vu = v.add_user(u)
+
+        assert v.CAs[0].certificate.key_type == KEY_TYPE_EC_P384
+        assert v.certificate.key_type == KEY_TYPE_EC_P384
+
+        d = vu.add_device(name="Phone", device_type="ios_10")
+        assert d.certificate.key_type == KEY_TYPE_EC_P384
+        assert d.certificate_type == "ECDSA384"
+        assert d.certificate.get_pkcs12(include_chain=False)
+
+        v.CAs[0].key_type = KEY_TYPE_ED25519
+        d = vu.add_device(name="Laptop", device_type="linux")
+        assert d.certificate.key_type == KEY_TYPE_ED25519
+        assert b"BEGIN PRIVATE KEY" in d.certificate.get_key_pem()
+        assert not d.certificate.supports_pkcs12()
+
+        d = vu.add_device(name="Phone 2", device_type="android_strongswan")
+        assert d.certificate.key_type.startswith("rsa:")
+
+    def test_ca_selection(self):
+        "new certificates are spread over the issuing intermediate CAs of a VPN"
+        u = User.find(email='guest@example.com')
+        v = VPNServer.create(name="Multi CA VPN", external_hostname="multi.example.com", intermediate_CAs=2)
+        vu = v.add_user(u)
+        root = [ca for ca in v.CAs if ca.parent is None][0]
+        intermediates = [ca for ca in v.CAs if ca.parent is root]
+        assert len(intermediates) == 2 and not root.issuing
+        assert v.ca_selection == CASelection.ROUND_ROBIN
+
+        issuers = set()
+        for number in range(4):
+            d = vu.add_device(name="Laptop {0}".format(number), device_type="linux")
+            issuers.add(d.certificate.issuer_dn)
+        assert issuers == set(ca.certificate.subject_dn for ca in intermediates)
+        for ca in intermediates:
+            assert ca.certificate.issuer_dn == root.certificate.subject_dn
+        assert set(v.trusted_CAs()) == set([root] + intermediates)
+
+        # Devices revoke with the intermediate that signed them
+        entry = d.revoke()
+        assert entry.ca_id in [ca.id for ca in intermediates]
+
+        busy, idle = intermediates
+        busy.next_serial_number = idle.next_serial_number + 1000
+        v.ca_selection = CASelection.LEAST_ISSUED
+        assert v.get_signing_ca() is idle
+
+        # Retired CAs stay trusted, but don't sign anymore
+        retired, remaining = idle, busy
+        retired.issuing = False
+        assert all(v.get_signing_ca() is remaining for number in range(3))
+        assert retired in v.trusted_CAs()
+
+        retired.issuing = True
+        retired.device_types = "ios_10"
+        v.ca_selection = CASelection.DEVICE_TYPE
+        assert v.get_signing_ca(device_type="ios_10") is retired
+        assert v.get_signing_ca(device_type="linux") is remaining
+
+        for ca in v.CAs:
+            ca.issuing = False
+        with self.assertRaises(ValueError):
+            v.get_signing_ca()
@@ -5,7 +5,7 @@ import flask
 import flask_security as security
 from flask_admin import expose
 from flask_diamond import db
-from flask_diamond.facets.administration import AuthModelView, AdminIndexView
+from flask_diamond.facets.administration import AuthModelView, AdminModelView, AdminIndexView
 
 
 adminbaseview = flask.Blueprint('adminbaseview', __name__,
@@ -22,3 +22,13 @@ class RedirectView(AdminIndexView):
     @expose('/')
     def index(self):
         return flask.redirect(flask.url_for('user.list_view'))
+
+
+class CertificateModelView(AdminModelView):
+    "Read-only list of certificates, searched and sorted on the indexed metadata columns"
+    can_create = False
+    can_edit = False
+    can_delete = False
+    column_list = ('subject_dn', 'issuer_dn', 'serial_number', 'not_before', 'not_after', 'key_algorithm', 'status', 'fingerprint')
+    column_searchable_list = ('subject_dn', 'serial_number', 'fingerprint')
+    column_default_sort = 'not_after'
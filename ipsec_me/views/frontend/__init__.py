@@ -3,12 +3,20 @@
 
 import flask
 from flask_security import login_required, current_user
-from ...models import DeviceBase
+from ...models import VPNUser, CertificateAuthority, ProvisioningJob, JobStatus, GenericUserCertificateDevice, AndroidStrongswanDevice, Ios10Device
+from ...registry import device_registry
+from ...ocsp import ocsp_responder
+from ...metrics import metrics
+from ...replicas import read_only
+from ...admission import issuance_limiter
 from .forms import NewDeviceForm
+from .artifacts import cached_artifact, device_artifact
 
-from jinja2.exceptions import TemplateNotFound
 from uuid import uuid4
-from base64 import b64encode
+from base64 import b64encode, b64decode
+from urllib.parse import unquote
+from hashlib import sha256
+import binascii
 from passlib import pwd
 
 frontend_blueprint = flask.Blueprint(
@@ -20,27 +28,58 @@ frontend_blueprint = flask.Blueprint(
 )
 
 @frontend_blueprint.route('/')
+@read_only
 @login_required
 def index():
-	return flask.render_template('frontend/index.html')
+	return flask.render_template('frontend/index.html', dashboard=VPNUser.dashboard(current_user))
 
 @frontend_blueprint.route('/vpn/<vpn_server:vpn_server>/add_device')
 @frontend_blueprint.route('/vpn/<vpn_server:vpn_server>/add_device/<device_class:device_class>', methods=['GET', 'POST', 'OPTIONS', 'HEAD'])
 @login_required
 def vpn_add_device(vpn_server, device_class=None):
 	if device_class is None:
-		return flask.render_template('frontend/choose_device_type.html', vpn_server=vpn_server, DeviceBase=DeviceBase)
+		return flask.render_template('frontend/choose_device_type.html', vpn_server=vpn_server, device_classes=list(device_registry))
 
 	else:
 		form = NewDeviceForm()
 		if form.validate_on_submit():
+			issuance_limiter.admit()
 			vu = vpn_server.find_user(current_user)
+
+			if flask.current_app.config['PROVISIONING_ASYNC']:
+				job = ProvisioningJob.create(vpn_user=vu, name=form.name.data, device_type=device_class.DEVICE_TYPE)
+				flask.current_app.extensions['provisioning'].submit(job)
+				return flask.redirect(flask.url_for('.provisioning_job_show', vpn_server=vpn_server, job_id=job.id))
+
 			d = vu.add_device(name=form.name.data, device_type=device_class)
 			return flask.redirect(flask.url_for('.device_show', vpn_server=vpn_server, device=d))
 
 		return flask.render_template('frontend/vpn_add_device.html', form=form, vpn_server=vpn_server, device_class=device_class)
 
+@frontend_blueprint.route('/vpn/<vpn_server:vpn_server>/job/<uuid:job_id>')
+@read_only
+@login_required
+def provisioning_job_show(vpn_server, job_id):
+	job = ProvisioningJob.find(id=job_id)
+	if job is None or not job.vpn_user.vpn_server is vpn_server:
+		flask.abort(404)
+
+	if not job.vpn_user.user.id == current_user.id:
+		flask.abort(404)
+
+	if job.status is JobStatus.DONE:
+		return flask.redirect(flask.url_for('.device_show', vpn_server=vpn_server, device=job.device))
+
+	if job.stale:
+		# Its process or worker died, let one of ours take it over
+		flask.current_app.extensions['provisioning'].submit(job)
+
+	return flask.render_template('frontend/provisioning_job.html', job=job, vpn_server=vpn_server,
+		device_class=device_registry.device_class(job.device_type),
+		poll_interval=flask.current_app.config['PROVISIONING_POLL_INTERVAL'])
+
 @frontend_blueprint.route('/vpn/<vpn_server:vpn_server>/device/<device:device>')
+@read_only
 @login_required
 def device_show(vpn_server, device):
 	if not device.vpn_user.vpn_server is vpn_server:
@@ -49,56 +88,126 @@ def device_show(vpn_server, device):
 	if not device.vpn_user.user.id == current_user.id: ## FIXME Admin access
 		flask.abort(404)
 
-	for cls in type(device).mro():
-		if issubclass(cls, DeviceBase):
-			try:
-				return flask.render_template('frontend/devices/{0}.html'.format(cls.__name__), device=device, vpn_server=vpn_server)
-			except TemplateNotFound:
-				flask.current_app.logger.warn("Trying to access device setup page for %s which doesn't exist", cls.__name__)
+	template = device_registry.template(type(device))
+	if template is None:
+		flask.current_app.logger.warn("Trying to access device setup page for %s which doesn't exist", type(device).__name__)
+		flask.abort(500)
 
+	return flask.render_template(template, device=device, vpn_server=vpn_server)
 
-	flask.abort(500)
+def crl_response(crl):
+	response = flask.Response(response=crl.der, mimetype='application/pkix-crl')
+	response.set_etag(sha256(crl.der).hexdigest())
+	response.last_modified = crl.last_update
+	response.expires = crl.next_update
+	return response.make_conditional(flask.request)
+
+@frontend_blueprint.route('/crl/<uuid:ca_id>.crl')
+def crl_full(ca_id):
+	ca = CertificateAuthority.find(id=ca_id)
+	if ca is None:
+		flask.abort(404)
+	return crl_response(ca.get_crl())
+
+@frontend_blueprint.route('/crl/<uuid:ca_id>_delta.crl')
+def crl_delta(ca_id):
+	ca = CertificateAuthority.find(id=ca_id)
+	if ca is None:
+		flask.abort(404)
+	return crl_response(ca.get_delta_crl())
+
+def ocsp_response(data):
+	return flask.Response(response=data, mimetype='application/ocsp-response')
+
+@frontend_blueprint.route('/ocsp', methods=['POST'])
+def ocsp_post():
+	return ocsp_response(ocsp_responder.respond(flask.request.get_data()))
+
+@frontend_blueprint.route('/ocsp/<path:request>')
+def ocsp_get(request):
+	# The URL encoding of the base64 encoded request (RFC 6960, A.1), the server may only have decoded part of it
+	try:
+		data = b64decode(unquote(request), validate=True)
+	except (ValueError, binascii.Error):
+		data = b''
+	return ocsp_response(ocsp_responder.respond(data))
+
+## Headers set by reverse proxies, see metrics_endpoint
+FORWARDING_HEADERS = ('Forwarded', 'X-Forwarded-For', 'X-Real-IP')
+
+@frontend_blueprint.route('/metrics')
+def metrics_endpoint():
+	allowed = flask.current_app.config['METRICS_ALLOWED_ADDRESSES']
+	# Behind a reverse proxy on the same host every client is local, only requests not forwarded by it count
+	forwarded = any(header in flask.request.headers for header in FORWARDING_HEADERS)
+	# Not abort(403): the error handlers redirect that to the login page, scrapers want the status
+	if allowed is not None and (forwarded or flask.request.remote_addr not in allowed):
+		return flask.Response("Forbidden\n", status=403, mimetype='text/plain')
+	return flask.Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 @frontend_blueprint.route('/provision/generic/<device_secure:device>.p12')
+@read_only
+@device_artifact(GenericUserCertificateDevice)
+@cached_artifact('pkcs12', 'application/x-pkcs12')
 def device_generic_pkcs12(device):
-	return flask.Response(response=device.certificate.get_pkcs12(include_chain=False), mimetype='application/x-pkcs12')
+	if not device.certificate.supports_pkcs12():
+		flask.abort(404)
+	return device.certificate.get_pkcs12(chain=device.chain_bundle())
 	
 @frontend_blueprint.route('/provision/generic/<device_secure:device>_ca.pem')
+@read_only
+@device_artifact(GenericUserCertificateDevice)
+@cached_artifact('ca_pem', 'application/x-pem-file')
 def device_generic_ca(device):
-	return flask.Response(response=device.certificate.get_ca_pem(), mimetype='application/x-pem-file')
+	return device.certificate.get_ca_pem(device.chain_bundle())
 	
 @frontend_blueprint.route('/provision/generic/<device_secure:device>_cert.pem')
+@read_only
+@device_artifact(GenericUserCertificateDevice)
+@cached_artifact('cert_pem', 'application/x-pem-file')
 def device_generic_cert(device):
-	return flask.Response(response=device.certificate.get_cert_pem(), mimetype='application/x-pem-file')
+	return device.certificate.get_cert_pem()
 	
 @frontend_blueprint.route('/provision/generic/<device_secure:device>_key.pem')
+@read_only
+@device_artifact(GenericUserCertificateDevice)
+@cached_artifact('key_pem', 'application/x-pem-file')
 def device_generic_key(device):
-	return flask.Response(response=device.certificate.get_key_pem(), mimetype='application/x-pem-file')
+	return device.certificate.get_key_pem()
 	
 
 @frontend_blueprint.route('/provision/android_strongswan/<device_secure:device>.sswan')
+@read_only
+@device_artifact(AndroidStrongswanDevice)
+@cached_artifact('sswan', 'application/vnd.strongswan.profile')
 def device_android_strongswan_profile(device):
+	vpn_server = device.vpn_user.vpn_server
+	server_chain = vpn_server.chain_bundle()
+	# The client trusts the root of the server certificate, or the certificate itself if it was issued elsewhere
+	remote_cert = server_chain.root[1] if server_chain is not None else vpn_server.certificate.certificate
 	response = {
 		'uuid': str(device.id),
 		'name': device.vpn_user.vpn_server.name,
 		'type': 'ikev2-cert',
 		'remote': {
 			'addr': device.vpn_user.vpn_server.external_hostname,
-			'cert': b64encode(device.vpn_user.vpn_server.certificate.certificate).decode("US-ASCII"), ## FIXME Proper CA
+			'cert': b64encode(remote_cert).decode("US-ASCII"),
 		},
 		'local': {
-			'p12': b64encode(device.certificate.get_pkcs12(include_chain=False)).decode("US-ASCII"),
+			'p12': b64encode(device.certificate.get_pkcs12(chain=device.chain_bundle())).decode("US-ASCII"),
 		},
 	}
-	return flask.Response(response=flask.json.dumps(response), mimetype='application/vnd.strongswan.profile')
+	return flask.json.dumps(response).encode("UTF-8")
 
 @frontend_blueprint.route('/provision/ios10/<device_secure:device>.mobileconfig')
+@read_only
+@device_artifact(Ios10Device)
+@cached_artifact('mobileconfig', 'application/octet-stream')
 def device_ios10_profile(device):
 	password = pwd.genword()
-	return flask.Response(
-		response=flask.render_template('frontend/devices/ios10_profile.xml', 
+	return flask.render_template('frontend/devices/ios10_profile.xml', 
 			device=device,
+			device_chain=device.chain_bundle(),
+			server_chain=device.vpn_user.vpn_server.chain_bundle(),
 			b64encode=lambda s: b64encode(s).decode('US-ASCII'),
-			password=password), 
-		mimetype='application/octet-stream')
-		#mimetype='text/xml')
+			password=password).encode("UTF-8")
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# ipsec-me (c) Henryk Plötz
+
+import flask
+from functools import wraps
+
+from ...artifacts import Artifact, artifact_cache, server_version
+from ...registry import device_registry
+
+def cached_artifact(artifact_type, mimetype):
+    """Cache the payload returned by a provisioning view and answer conditional requests from the cache.
+
+    The decorated view gets the device and returns the payload as bytes.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(device):
+            key = (device.id, device.certificate.fingerprint, device.certificate.status, server_version(device), artifact_type)
+            artifact = artifact_cache.get(key)
+            if artifact is None:
+                # Drop outdated payloads of the device, e.g. for a previous certificate
+                artifact_cache.discard_where(lambda k: k[0] == device.id and k[-1] == artifact_type)
+                artifact = Artifact(view(device), mimetype)
+                artifact_cache.set(key, artifact)
+
+            response = flask.Response(response=artifact.body, mimetype=artifact.mimetype)
+            response.set_etag(artifact.etag)
+            response.last_modified = artifact.last_modified
+            response.cache_control.private = True
+            return response.make_conditional(flask.request)
+        return wrapper
+    return decorator
+
+def device_artifact(device_class):
+    """Register the decorated view as an artifact of device_class and its subclasses.
+
+    Other devices get a 404.
+    """
+    def decorator(view):
+        device_registry.register_artifact(device_class, view.__name__)
+
+        @wraps(view)
+        def wrapper(device):
+            if not device_registry.supports(type(device), view.__name__):
+                flask.abort(404)
+            return view(device)
+        return wrapper
+    return decorator